@@ -9,22 +9,19 @@ import shutil
 import shlex
 
 from munch import Munch, munchify, unmunchify
-import ruamel.yaml as yaml
 
 import click
 from click import echo
 
+# Modules that pull in synapseclient, networkx, pandas, ruamel or sh are imported inside the
+# commands that use them, so that e.g. `--home` or `mongo stop` do not pay for loading them.
 import veoibd_synapse.cli.config as _config
-import veoibd_synapse.cli.push as _push
-import veoibd_synapse.cli.syncdb as _syncdb
 
-from veoibd_synapse.misc import process_config, update_configs
+from veoibd_synapse.misc import load_config_tree
 import veoibd_synapse.errors as e
 
 from logzero import logger as log
 
-import sh
-
 # Metadata
 __author__ = "Gus Dunn"
 __email__ = "w.gus.dunn@gmail.com"
@@ -54,17 +51,14 @@ def run(ctx=None, config=None, home=None):
     command followed by the --help option.
     """
     ctx.obj = Munch()
-    ctx.obj.CONFIG = Munch()
 
     top_lvl_confs = HOME_DIR / 'configs'
 
     # Load the factory_resets/logging.yaml as an absolute fall-back logging config
-    ctx.obj.CONFIG.LOGGING = process_config(config=top_lvl_confs / 'factory_resets/logging.yaml')
-
-    ctx.obj.CONFIG = update_configs(directory=top_lvl_confs, to_update=ctx.obj.CONFIG)
-
-    if config:
-        ctx.obj.CONFIG = update_configs(directory=config, to_update=ctx.obj.CONFIG)
+    # The merged tree is reused from a snapshot until one of these YAML files changes.
+    directories = [top_lvl_confs] + ([config] if config else [])
+    ctx.obj.CONFIG = load_config_tree(directories=directories,
+                                      defaults={'LOGGING': top_lvl_confs / 'factory_resets/logging.yaml'})
 
     setup_logging(conf_dict=ctx.obj.CONFIG.LOGGING)
 
@@ -115,6 +109,8 @@ def configs(ctx, list_, generate_configs, kind, prefix):
     log.debug("kind = {}".format(kind))
 
     if list_:
+        import ruamel.yaml as yaml
+
         log.info("Listing current configuration state.")
         conf_str = yaml.dump(unmunchify(ctx.obj.CONFIG), default_flow_style=False)
         echo(conf_str)
@@ -144,15 +140,26 @@ def configs(ctx, list_, generate_configs, kind, prefix):
               type=str,
               default=None,
               help="Provide the ID for a user listed in the 'users' config file.")
-@click.option("--push-config",
-              type=click.Path(exists=True, file_okay=True, dir_okay=False),
+@click.option("--push-config", "push_configs",
+              type=click.Path(exists=True, file_okay=True, dir_okay=True),
+              multiple=True,
+              help="Path to the file where this specific 'push' is configured, or to a directory of such files. "
+              "May be repeated; all push-configs run in one session sharing the login, project DAG and uploads.")
+@click.option("-j", "--max-concurrent-uploads",
+              type=click.IntRange(min=1),
               default=None,
-              help="Path to the file where this specific 'push' is configured.")
+              help="Number of files to upload at once. Overrides MAX_CONCURRENT_UPLOADS in the push-config(s).")
+@click.option("--plan-only",
+              is_flag=True,
+              default=False,
+              help="Print the destinations, file counts, sizes and estimated transfer time of the push and exit "
+              "without creating folders or uploading anything.")
 @click.pass_context
-def push(ctx, user, push_config):
-    """Consume a push-config file, execute described transactions, save record of transactions."""
+def push(ctx, user, push_configs, max_concurrent_uploads, plan_only):
+    """Consume push-config files, execute described transactions, save record of transactions."""
+    import veoibd_synapse.cli.push as _push
 
-    _push.main(ctx, user, push_config)
+    _push.main(ctx, user, push_configs, max_concurrent_uploads, plan_only)
 
 
 @run.command()
@@ -164,11 +171,17 @@ def push(ctx, user, push_config):
               type=str,
               default=None,
               help="Provide the team name in quotes.")
+@click.option("--to-mongo",
+              is_flag=True,
+              default=False,
+              help="Also load the combined subject table into the mongod configured in configs/mongodb.yaml "
+              "(see `mongo start`).")
 @click.pass_context
-def syncdb(ctx, user, team_name):
+def syncdb(ctx, user, team_name, to_mongo):
     """Retrieve and build the most up-to-date metadata database info from Synapse for all Projects shared with ``team-name``."""
+    import veoibd_synapse.cli.syncdb as _syncdb
 
-    _syncdb.main(ctx, user, team_name)
+    _syncdb.main(ctx, user, team_name, to_mongo)
 
 
 @run.group()
@@ -185,6 +198,8 @@ def mongo(ctx):
 @click.pass_context
 def mongo_start(ctx):
     """Start the mongod daemon using the options in configs/mongodb.yaml."""
+    import sh
+
     opt_str = "--config configs/mongodb.yaml"
     cmd_parts = shlex.split(opt_str)
     output = sh.mongod(cmd_parts)
@@ -199,6 +214,8 @@ def mongo_start(ctx):
 @click.pass_context
 def mongo_stop(ctx):
     """Safely stop the mongod daemon."""
+    import sh
+
     opt_str = "--config configs/mongodb.yaml --shutdown"
     cmd_parts = shlex.split(opt_str)
     output = sh.mongod(cmd_parts)
@@ -216,6 +233,8 @@ def mongo_status(ctx):
     
     To cancel the information stream and exit the command press [ctrl+c].
     """
+    import sh
+
     opt_str = ""
     cmd_parts = shlex.split(opt_str)
     output = sh.mongostat(cmd_parts)
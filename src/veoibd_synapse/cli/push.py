@@ -7,18 +7,26 @@ from logzero import logger as log
 from pathlib import Path
 import datetime as dt
 import glob
-from collections import deque
+import json
+import time
+import threading
+from collections import namedtuple, Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, ExitStack
 
 import networkx as nx
 import synapseclient as synapse
 
 from click.utils import echo
 
+from tqdm import tqdm
+
 from munch import Munch, munchify
 
 import veoibd_synapse.errors as e
 from veoibd_synapse.misc import process_config, chunk_md5
 import veoibd_synapse.dag_tools as dtools
+import veoibd_synapse.multipart as multipart
 
 
 # Metadata
@@ -26,14 +34,83 @@ __author__ = "Gus Dunn"
 __email__ = "w.gus.dunn@gmail.com"
 
 
+# Constants
+DEFAULT_MAX_CONCURRENT_UPLOADS = 4
+MAX_UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 5  # seconds; doubled after each failed attempt
+DEFAULT_UPLOAD_RATE = 20  # MB/s; only used to estimate transfer time in a plan
+STREAMED_UPLOAD_MIN_BYTES = 100 * multipart.MB  # larger files use ``multipart.upload_file_handle``
+PUSH_CONFIG_PATTERNS = ("*.yaml", "*.yml")  # push-configs collected from a directory
+DEFAULT_PUSH_REPORTS_DIR = "data/push_reports"  # used when the site config sets no LOCAL_PATHS.PUSH_REPORTS_DIR
+
+# Classes
+UploadResult = namedtuple('UploadResult', ["path", "entity_id", "action", "attempts", "error", "n_bytes", "seconds"])
+PlanEntry = namedtuple('PlanEntry', ["destination", "destination_id", "n_files", "n_bytes", "new_folders"])
+
+
+class PushMetrics(object):
+
+    """Collect the wall-clock time of each phase of a push and the outcome of every file upload."""
+
+    def __init__(self):
+        """Initialize empty metrics."""
+        self.phases = OrderedDict()
+        self.uploads = []
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block and add it to the phase `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def as_dict(self):
+        """Return the metrics as a JSON-serializable dict."""
+        uploaded = [result for result in self.uploads if result.action == "uploaded"]
+        bytes_uploaded = sum(result.n_bytes for result in uploaded)
+        upload_seconds = self.phases.get("uploads", 0.0)
+
+        totals = OrderedDict()
+        totals["files"] = len(self.uploads)
+        totals.update(Counter(result.action for result in self.uploads))
+        totals["bytes_uploaded"] = bytes_uploaded
+        totals["retries"] = sum(result.attempts - 1 for result in self.uploads)
+        totals["transfer_seconds"] = sum(result.seconds for result in uploaded)
+        totals["mb_per_sec"] = mb_per_sec(n_bytes=bytes_uploaded, seconds=upload_seconds)
+
+        files = []
+        for result in sorted(self.uploads, key=lambda result: str(result.path)):
+            files.append(OrderedDict([("path", str(result.path)),
+                                      ("entity_id", result.entity_id),
+                                      ("action", result.action),
+                                      ("bytes", result.n_bytes),
+                                      ("seconds", result.seconds),
+                                      ("mb_per_sec", mb_per_sec(n_bytes=result.n_bytes, seconds=result.seconds)),
+                                      ("retries", result.attempts - 1),
+                                      ("error", None if result.error is None else repr(result.error)),
+                                      ]))
+
+        return OrderedDict([("phases", self.phases), ("totals", totals), ("files", files)])
+
 
 # Functions
 class Push(object):
 
     """Manage interactions with Synapse concerning adding/changing information on the Synapse servers."""
 
-    def __init__(self, main_confs, user, push_config,):
-        """Initialize and validate basic information for a Push."""
+    def __init__(self, main_confs, user, push_config, max_concurrent_uploads=None, synapse_client=None):
+        """Initialize and validate basic information for a Push.
+
+        Args:
+            main_confs (dict-like): reference to main configuration tree.
+            user (str): ID for a user listed in the 'users' config file.
+            push_config (str): path to the push-config file.
+            max_concurrent_uploads (int): number of files uploaded at once. Overrides
+                ``MAX_CONCURRENT_UPLOADS`` in the push-config when given.
+            synapse_client (Synapse): client to use instead of a new ``synapseclient.Synapse()``.
+        """
         log.debug("Initializing Push obj.")
 
         self.main_confs = main_confs
@@ -42,10 +119,17 @@ class Push(object):
         self.push_time = None
         self.push_config_path = push_config
         self.push_config = self._process_push_config(push_config=push_config)
+        self.max_concurrent_uploads = self._process_max_concurrent_uploads(max_concurrent_uploads)
 
         log.info("Initializing Synapse client.")
-        self.syn = synapse.Synapse()
+        self.syn = synapse.Synapse() if synapse_client is None else synapse_client
         self.dag = None
+        self.dag_lock = threading.RLock()
+        self.failed_uploads = []
+        self.plan_entries = None
+        self.missing_folders = None
+        self.metrics = PushMetrics()
+        self.report_path = None
 
         log.info("Creating interaction instances.")
         self._create_interactions()
@@ -83,29 +167,248 @@ class Push(object):
             msg = """The push-config file must have "INTERACTION_TYPE" set in the top level."""
             raise e.ValidationError(msg)
 
-    def login(self):
-        """Log in to Synapse and acquire the project entity."""
+    def _process_max_concurrent_uploads(self, max_concurrent_uploads):
+        """Validate and return the size of the upload worker pool."""
+        if max_concurrent_uploads is None:
+            max_concurrent_uploads = self.push_config.get('MAX_CONCURRENT_UPLOADS', DEFAULT_MAX_CONCURRENT_UPLOADS)
+
+        try:
+            max_concurrent_uploads = int(max_concurrent_uploads)
+        except (TypeError, ValueError):
+            max_concurrent_uploads = 0
+
+        if max_concurrent_uploads < 1:
+            msg = """MAX_CONCURRENT_UPLOADS must be a positive integer."""
+            raise e.ValidationError(msg)
+
+        return max_concurrent_uploads
+
+    def login(self, authenticate=True, create_project=True):
+        """Log in to Synapse and acquire the project entity.
+
+        Args:
+            authenticate (bool): ``False`` skips logging in when ``self.syn`` already holds a session.
+            create_project (bool): create the project if it does not exist. With ``False`` a missing
+                project leaves ``self.project`` and ``self.dag`` as ``None`` so that ``plan()`` can
+                report it without anything being written to Synapse.
+        """
         log.info("Initiating log in to Synapse and acquiring the project entity.")
 
-        self.syn.login(email=self.user.SYN_USERNAME, apiKey=self.user.API_KEY)
+        with self.metrics.phase("login"):
+            if authenticate:
+                self.syn.login(email=self.user.SYN_USERNAME, apiKey=self.user.API_KEY)
 
-        project_name = self.push_config.PROJECT_NAME
-        log.info("""Acquiring Synapse project instance for "{name}".""".format(name=project_name))
+            project_name = self.push_config.PROJECT_NAME
+            log.info("""Acquiring Synapse project instance for "{name}".""".format(name=project_name))
 
-        try:
-            self.project = self.syn.get(synapse.Project(name=project_name))
-        except TypeError:
-            self.project = self.syn.store(synapse.Project(name=project_name))
+            try:
+                self.project = self.syn.get(synapse.Project(name=project_name))
+            except TypeError:
+                if not create_project:
+                    log.info("""Project "{name}" does not exist.""".format(name=project_name))
+                    self.project = None
+                    self.dag = None
+                    return
+
+                self.project = self.syn.store(synapse.Project(name=project_name))
+
+        with self.metrics.phase("dag_build"):
+            self._build_remote_entity_dag()
+
+    def share_session(self, other):
+        """Use the project entity, DAG and DAG lock of `other`, a logged-in ``Push`` to the same project."""
+        if other.push_config.PROJECT_NAME != self.push_config.PROJECT_NAME:
+            msg = """Cannot share the session of a push to "{other}" with a push to "{this}".""".format(
+                other=other.push_config.PROJECT_NAME, this=self.push_config.PROJECT_NAME)
+            raise e.ValidationError(msg)
+
+        self.project = other.project
+        self.dag = other.dag
+        self.dag_lock = other.dag_lock
 
-        self._build_remote_entity_dag()
+    def plan(self, create=True):
+        """Resolve every interaction's destination and files against the DAG before anything is uploaded.
 
+        All missing destination folders are found first and, if `create` is True, created in a single
+        breadth-first pass so that parents always exist before their children.
+
+        Args:
+            create (bool): create missing folders; ``False`` leaves Synapse untouched.
+
+        Returns:
+            list: one ``PlanEntry`` per interaction.
+        """
+        log.info("Planning push interactions.")
+
+        with self.metrics.phase("folder_preparation"):
+            self.plan_entries = self._plan(create=create)
+
+        return self.plan_entries
+
+    def _plan(self, create):
+        """Do the work of ``plan()``."""
+        if (self.project is None) and create:
+            msg = """Project "{name}" does not exist; log in with create_project=True to push to it."""
+            raise e.ValidationError(msg.format(name=self.push_config.PROJECT_NAME))
+
+        missing = set()
+        with self.dag_lock:
+            for interaction in self.interactions:
+                path = interaction.destination_path
+                if self.dag is None:
+                    remaining = tuple(path)
+                else:
+                    parent_id, remaining = self.dag.split_path(path=path)
+
+                if remaining and not interaction.info.get('CREATE_DIR', False):
+                    msg = """REMOTE_DESTINATION_DIR "{path}" does not exist and CREATE_DIR is not set."""
+                    msg = msg.format(path="/".join(path))
+                    raise e.ValidationError(msg)
+
+                found = len(path) - len(remaining)
+                missing.update(path[:depth] for depth in range(found + 1, len(path) + 1))
+
+            self.missing_folders = sorted(missing, key=lambda path: (len(path), path))
+
+            if create:
+                self._create_folders(paths=self.missing_folders)
+                for interaction in self.interactions:
+                    interaction.prepare_destination()
+
+        return [interaction.plan_entry(missing=missing) for interaction in self.interactions]
+
+    def _create_folders(self, paths):
+        """Create the folders in `paths`, which must be ordered parents first."""
+        if paths:
+            log.info("Creating {num} missing folders.".format(num=len(paths)))
+
+        for path in paths:
+            parent_id = self.dag.follow_path_to_folder(path=path[:-1])
+            self.dag.create_folder(parent_id=parent_id, name=path[-1])
+
+    def format_plan(self):
+        """Return a human readable summary of ``self.plan_entries``."""
+        rate = float(self.push_config.get('UPLOAD_RATE_MB_PER_SEC', DEFAULT_UPLOAD_RATE))
+
+        lines = ["""Push plan for "{name}":""".format(name=self.push_config.PROJECT_NAME)]
+        if self.project is None:
+            lines.append("  The project does not exist yet and will be created.")
+        for entry in self.plan_entries:
+            line = "  {dest}: {n} files, {size}".format(dest=entry.destination,
+                                                       n=entry.n_files,
+                                                       size=format_bytes(entry.n_bytes))
+            if entry.new_folders:
+                line += " (creates {n} folders)".format(n=entry.new_folders)
+            lines.append(line)
+
+        n_files = sum(entry.n_files for entry in self.plan_entries)
+        n_bytes = sum(entry.n_bytes for entry in self.plan_entries)
+        eta = dt.timedelta(seconds=round(n_bytes / (rate * 1e6)))
+
+        lines.append("Total: {n} files, {size}, {folders} new folders, ~{eta} at {rate:g} MB/s "
+                     "with {workers} concurrent uploads.".format(n=n_files,
+                                                                 size=format_bytes(n_bytes),
+                                                                 folders=len(self.missing_folders),
+                                                                 eta=eta,
+                                                                 rate=rate,
+                                                                 workers=self.max_concurrent_uploads))
+
+        return "\n".join(lines)
 
     def execute(self):
-        """Execute the configured interactions."""
+        """Execute the configured interactions.
+
+        The push is planned first if ``plan()`` has not been run, so every destination folder exists
+        before the first upload starts.
+
+        Files from every interaction share one pool of ``max_concurrent_uploads`` upload workers.
+        A file that still fails after ``MAX_UPLOAD_ATTEMPTS`` does not stop the others; all such
+        failures are reported together once every upload has finished.
+        """
+        if self.plan_entries is None:
+            self.plan(create=True)
+
         log.info("Executing configured push interations.")
 
-        for interaction in self.interactions:
-            interaction.execute()
+        with self.metrics.phase("uploads"):
+            results, = run_uploads(pushes=[self], max_workers=self.max_concurrent_uploads)
+
+        self.finish(results=results)
+
+    def finish(self, results):
+        """Record `results`, upload the push report and raise if any file failed.
+
+        A failure to write or upload the report is logged; the upload summary is always reported.
+        """
+        self.metrics.uploads.extend(results)
+        try:
+            self.push_report()
+        except Exception as exc:
+            log.error("""Could not write or upload the push report of "{config}": {error!r}""".format(
+                config=self.push_config_path, error=exc))
+
+        self._report_uploads(results=results)
+
+    def write_report(self):
+        """Write the push metrics as JSON to the site's push-reports directory and return its path."""
+        report = OrderedDict([("push_id", self.push_id),
+                              ("push_time", self.push_time),
+                              ("push_config", str(self.push_config_path)),
+                              ("project_name", self.push_config.PROJECT_NAME),
+                              ("max_concurrent_uploads", self.max_concurrent_uploads),
+                              ])
+        report.update(self.metrics.as_dict())
+
+        reports_dir = Path(self.main_confs.SITE.get('LOCAL_PATHS', {}).get('PUSH_REPORTS_DIR',
+                                                                            DEFAULT_PUSH_REPORTS_DIR))
+        reports_dir.mkdir(parents=True, exist_ok=True)
+
+        report_path = reports_dir / "{stem}.{push_id}.report.json".format(stem=Path(self.push_config_path).stem,
+                                                                           push_id=self.push_id)
+        with report_path.open('w') as out:
+            json.dump(report, out, indent=2)
+
+        self.report_path = report_path
+        log.info("""Wrote push report: "{path}".""".format(path=report_path))
+
+        return report_path
+
+    def push_report(self):
+        """Write the push report and upload it to the same folder as the push-history record.
+
+        A failure to upload the report is logged but does not fail the push; ``finish()`` also logs
+        a failure to write it.
+        """
+        report_path = self.write_report()
+
+        record_info = self._history_record_info(local_path=str(report_path), file_type='json')
+        record_info.ANNOTATIONS.push_report = True
+        interaction = PushInteraction(info=record_info, push_obj=self)
+
+        failed = [result for result in interaction.execute() if result.error is not None]
+        for result in failed:
+            log.error("""Could not upload push report "{path}": {error}""".format(path=result.path, error=result.error))
+
+    def _report_uploads(self, results):
+        """Log a summary of upload results and raise if any file failed."""
+        self.failed_uploads = [result for result in results if result.error is not None]
+        actions = Counter(result.action for result in results)
+
+        log.info("Processed {total} files: {uploaded} uploaded, {annotated} re-annotated, "
+                 "{skipped} unchanged, {failed} failed.".format(total=len(results),
+                                                                uploaded=actions['uploaded'],
+                                                                annotated=actions['annotated'],
+                                                                skipped=actions['skipped'],
+                                                                failed=len(self.failed_uploads)))
+
+        if self.failed_uploads:
+            for result in self.failed_uploads:
+                log.error("""Failed to upload "{path}" after {n} attempts: {error}""".format(path=result.path,
+                                                                                           n=result.attempts,
+                                                                                           error=result.error))
+
+            msg = """{n} file(s) could not be uploaded.""".format(n=len(self.failed_uploads))
+            raise e.UploadError(msg)
 
     def _create_interactions(self):
         """Create and store interaction objects based on the push_config."""
@@ -129,15 +432,20 @@ class Push(object):
             self.interactions.append(PushInteraction(info=info, push_obj=self))
 
         # create special interaction to push the config file to the project
+        record_info = self._history_record_info(local_path=self.push_config_path, file_type='yaml')
+        self.interactions.append(PushInteraction(info=record_info, push_obj=self))
+
+    def _history_record_info(self, local_path, file_type):
+        """Return an info tree to upload `local_path` to the project's push_history folder."""
         record_info = Munch()
         record_info.REMOTE_DESTINATION_DIR = "push_history"
         record_info.CREATE_DIR = True
         record_info.ANNOTATIONS = Munch()
-        record_info.ANNOTATIONS.file_type = 'yaml'
+        record_info.ANNOTATIONS.file_type = file_type
         record_info.ANNOTATIONS.push_history = True
-        record_info.LOCAL_PATHS = [self.push_config_path]
+        record_info.LOCAL_PATHS = [local_path]
 
-        self.interactions.append(PushInteraction(info=record_info, push_obj=self))
+        return record_info
 
 
     def __base_info(self):
@@ -155,43 +463,30 @@ class Push(object):
 
         return base_info
 
-    def _get_remote_entity_dicts(self):
-        """Query Synapse for all entity information related to this Project ID."""
-        pid = self.project['id'][3:]
-        q = 'SELECT * FROM entity WHERE projectId=="{pid}"'.format(pid=pid)
-
-        ent_dicts = {ent['entity.id']: ent for ent in self.syn.query(q)['results']}
-
-        # get rid of the 'entity.' prefixes
-        ent_dicts_ = {}
-        for name, d in ent_dicts.items():
-            d_ = {key.replace('entity.', ''): val for key, val in d.items()}
-            ent_dicts_[name] = d_
-
-        self.entity_dicts = ent_dicts_
+    def _iter_remote_entity_dicts(self):
+        """Yield entity information related to this Project ID, one query page at a time."""
+        return dtools.iter_project_entities(syn=self.syn, project_id=self.project['id'])
 
     def _build_remote_entity_dag(self):
         """Build a DAG of the remote project structure."""
         log.info("Building the project's DAG.")
-        self._get_remote_entity_dicts()
 
         dag = dtools.ProjectDAG(project_id=self.project['id'], synapse_session=self.syn)
 
-        # add nodes and edges with nodes being simple id names for now
-        for n_id,node in self.entity_dicts.items():
-            dag.add_edge(u=node['parentId'], v=n_id)
+        # add nodes and edges as query pages arrive; a parent seen first as an
+        # edge end gets its SynNode once its own row comes in.
+        for entity_dict in self._iter_remote_entity_dicts():
+            n_id = entity_dict['id']
+            dag.add_edge(u=entity_dict['parentId'], v=n_id)
+            dag.node[n_id] = dtools.SynNode(entity_dict=entity_dict, synapse_session=self.syn)
 
         # remove Project's parent from the dag bc it is useless to us.
         # we want our project as root.
         dag.remove_node(self.project['parentId'])
 
-        # SynNode objects as values of each node
-        for name in dag.nodes():
-            dag.node[name] = dtools.SynNode(entity_dict=self.entity_dicts[name], synapse_session=self.syn)
-
-
-        # label our project as root
+        # label our project as root, we already hold its entity object
         dag.node[self.project['id']].is_root = True
+        dag.node[self.project['id']].obj = self.project
 
 
         if nx.dag.is_directed_acyclic_graph(dag):
@@ -201,6 +496,96 @@ class Push(object):
 
 
 
+class PushBatch(object):
+
+    """Run several push-configs in one session.
+
+    The client logs in once, each project's entity and DAG are fetched once and shared by every
+    push-config that targets it, and the files of all push-configs go through one pool of upload
+    workers. Each push-config still gets its own push-history record and report.
+    """
+
+    def __init__(self, main_confs, user, push_configs, max_concurrent_uploads=None, synapse_client=None):
+        """Initialize a ``Push`` for each of `push_configs`.
+
+        Args:
+            main_confs (dict-like): reference to main configuration tree.
+            user (str): ID for a user listed in the 'users' config file.
+            push_configs (list): paths to push-config files.
+            max_concurrent_uploads (int): number of files uploaded at once. Defaults to the largest
+                ``MAX_CONCURRENT_UPLOADS`` among the push-configs.
+            synapse_client (Synapse): client to use instead of a new ``synapseclient.Synapse()``.
+        """
+        if not push_configs:
+            raise e.ValidationError('At least one value for PUSH_CONFIG must be provided.')
+
+        self.syn = synapse.Synapse() if synapse_client is None else synapse_client
+        self.pushes = [Push(main_confs=main_confs,
+                            user=user,
+                            push_config=push_config,
+                            max_concurrent_uploads=max_concurrent_uploads,
+                            synapse_client=self.syn) for push_config in push_configs]
+
+        # every push reports the size of the pool it actually shares
+        self.max_concurrent_uploads = max(push.max_concurrent_uploads for push in self.pushes)
+        for push in self.pushes:
+            push.max_concurrent_uploads = self.max_concurrent_uploads
+
+    def login(self, create_project=True):
+        """Log in once and build one DAG per project, shared by all pushes to that project.
+
+        Args:
+            create_project (bool): create missing projects; see ``Push.login()``.
+        """
+        sessions = {}
+
+        for push in self.pushes:
+            project_name = push.push_config.PROJECT_NAME
+
+            if project_name in sessions:
+                push.share_session(other=sessions[project_name])
+            else:
+                push.login(authenticate=not sessions, create_project=create_project)
+                sessions[project_name] = push
+
+    def plan(self, create=True):
+        """Plan every push in turn; see ``Push.plan()``."""
+        for push in self.pushes:
+            push.plan(create=create)
+
+    def format_plan(self):
+        """Return the plans of all pushes as one human readable string."""
+        return "\n\n".join(push.format_plan() for push in self.pushes)
+
+    def execute(self):
+        """Upload the files of every push through one worker pool, then report each push separately.
+
+        Every push's report is uploaded before failures are raised, so one bad push-config does
+        not cost the others their history records.
+        """
+        for push in self.pushes:
+            if push.plan_entries is None:
+                push.plan(create=True)
+
+        log.info("Executing {num} push-configs.".format(num=len(self.pushes)))
+
+        with ExitStack() as stack:
+            for push in self.pushes:
+                stack.enter_context(push.metrics.phase("uploads"))
+
+            all_results = run_uploads(pushes=self.pushes, max_workers=self.max_concurrent_uploads)
+
+        errors = []
+        for push, results in zip(self.pushes, all_results):
+            try:
+                push.finish(results=results)
+            except e.UploadError as exc:
+                errors.append("{config}: {error}".format(config=push.push_config_path, error=exc))
+
+        if errors:
+            raise e.UploadError("; ".join(errors))
+
+
 class BaseInteraction(object):
 
     """Base class to manage information and execution for a single interaction with Synapse."""
@@ -229,43 +614,256 @@ class PushInteraction(BaseInteraction):
         self.push = self._process_push_obj(push_obj)
         self.syn = self.push.syn
         self.info.LOCAL_PATHS = self._process_local_paths()
+        self.destination_path = tuple(name for name in self.info.REMOTE_DESTINATION_DIR.split('/') if name)
+        self.destination = None
+        self.storage_location_id = None
+        self.local_md5s = {}
+        self.remote_annotations = {}  # file synID -> {annotation key: value} at the destination
 
     def prepare_destination(self):
         """Get or create remote destination."""
         log.info("""Preparing destination "{path}".""".format(path=self.info.REMOTE_DESTINATION_DIR))
         # does our destination exist?
         # If not, create Synapse Objects for them and add to the DAG if appropriate.
-        path = deque(self.info.REMOTE_DESTINATION_DIR.split('/'))
-        destination = self.push.dag.follow_path_to_folder(path=path, origin=None, create=self.info.CREATE_DIR)
+        with self.push.dag_lock:
+            destination = self.push.dag.follow_path_to_folder(path=self.destination_path,
+                                                              origin=None,
+                                                              create=self.info.get('CREATE_DIR', False))
 
         self.destination = destination
 
+    def plan_entry(self, missing):
+        """Return a ``PlanEntry`` summarizing this interaction given the set of `missing` folder paths."""
+        path = self.destination_path
+        new_folders = sum(1 for depth in range(1, len(path) + 1) if path[:depth] in missing)
+
+        return PlanEntry(destination="/".join(path),
+                         destination_id=self.destination,
+                         n_files=len(self.info.LOCAL_PATHS),
+                         n_bytes=sum(loc_file.stat().st_size for loc_file in self.info.LOCAL_PATHS),
+                         new_folders=new_folders)
+
     def add_file(self, loc_file):
-        """Create and add Synapse File object to DAG and upload to Synapse."""
+        """Create and add Synapse File object to DAG and upload to Synapse.
+
+        Safe to call from several upload workers at once: only the DAG updates are serialized.
+        """
         log.info("""File: "{name}".""".format(name=loc_file.name))
 
         # Create and add file to Synapse
-        parent_obj = self.push.dag.node[self.destination]
         annotations = self.info.ANNOTATIONS
-        new_file = synapse.File(path=str(loc_file),
-                                parent=parent_obj,
-                                annotations=annotations)
-        new_file = self.syn.store(new_file)
+        n_bytes = loc_file.stat().st_size
+
+        if n_bytes >= STREAMED_UPLOAD_MIN_BYTES:
+            new_file = self.store_streamed(loc_file=loc_file, annotations=annotations)
+            md5_and_size = self.local_md5(loc_file), n_bytes
+        else:
+            new_file = synapse.File(path=str(loc_file),
+                                    parent=self.destination,
+                                    annotations=annotations)
+            new_file = self.syn.store(new_file)
+            md5_and_size = dtools.file_handle_md5_and_size(new_file)
         new_file_id = new_file['id']
 
         # add file to DAG
-        self.push.dag.add_edge(u=self.destination, v=new_file_id, attr_dict=None)
         entity_dict = {k:v  for k,v in new_file.items()}
-        self.push.dag.node[new_file_id] = dtools.SynNode(entity_dict=entity_dict,
-                                                         synapse_session=self.syn,
-                                                         is_root=False)
+        entity_dict['nodeType'] = 'file'
+        entity_dict['md5'], entity_dict['size'] = md5_and_size
+        with self.push.dag_lock:
+            self.push.dag.add_edge(u=self.destination, v=new_file_id, attr_dict=None)
+            self.push.dag.node[new_file_id] = dtools.SynNode(entity_dict=entity_dict,
+                                                             synapse_session=self.syn,
+                                                             is_root=False,
+                                                             obj=new_file)
+
+        return new_file_id
+
+    def store_streamed(self, loc_file, annotations):
+        """Upload `loc_file` in parts and store a File entity pointing at the resulting file handle.
+
+        The md5 from ``local_md5`` is handed to the file service up front, so the file is read
+        once to hash it (shared with ``find_unchanged_remote``) and once to send it; the client
+        never re-reads it because the entity is stored by file handle rather than by path.
+        """
+        if self.storage_location_id is None:
+            self.storage_location_id = multipart.get_storage_location_id(syn=self.syn, parent_id=self.destination)
+
+        file_handle_id = multipart.upload_file_handle(syn=self.syn,
+                                                      path=loc_file,
+                                                      md5=self.local_md5(loc_file),
+                                                      storage_location_id=self.storage_location_id)
+
+        new_file = synapse.File(name=loc_file.name,
+                                parent=self.destination,
+                                dataFileHandleId=file_handle_id,
+                                annotations=annotations)
+
+        return self.syn.store(new_file)
+
+    def local_md5(self, loc_file):
+        """Return the md5-hexdigest of `loc_file`, reading the file only the first time it is asked for."""
+        if loc_file not in self.local_md5s:
+            self.local_md5s[loc_file] = chunk_md5(loc_file)
+
+        return self.local_md5s[loc_file]
+
+    def find_unchanged_remote(self, loc_file):
+        """Return the DAG node of an identical file already at the destination or ``None``.
+
+        Remote files are matched by name and compared by size, then by md5, so that the
+        local file is only read when a same-sized candidate exists.
+        """
+        with self.push.dag_lock:
+            remote_id = self.push.dag.find_file(node_id=self.destination, name=loc_file.name)
+            if remote_id is None:
+                return None
+            remote = self.push.dag.node[remote_id]
+
+        remote_md5, remote_size = remote.md5_and_size()
+
+        if (remote_md5 is None) or (remote_size != loc_file.stat().st_size):
+            return None
+
+        if self.local_md5(loc_file) != remote_md5:
+            return None
+
+        return remote
+
+    def update_annotations(self, remote):
+        """Queue any of this interaction's annotations missing or different on `remote`; return True if it was changed.
+
+        The node is only marked ``needs_update``; ``store_annotations()`` stores it with the other
+        changed nodes once the uploads are done.
+        """
+        if not self.info.ANNOTATIONS:
+            return False
+
+        try:
+            remote_annotations = self.remote_annotations[remote.id]
+        except KeyError:
+            remote_annotations = remote.obj.annotations
+
+        changes = {}
+        for key, value in self.info.ANNOTATIONS.items():
+            if not same_annotation_value(remote_annotations.get(key), value):
+                changes[key] = value
+
+        if not changes:
+            return False
+
+        annotations = remote.obj.annotations
+
+        log.info("""Updating annotations of unchanged file "{name}": {keys}.""".format(name=remote.name,
+                                                                                      keys=sorted(changes.keys())))
+        annotations.update(changes)
+        remote.needs_update = True
+
+        return True
+
+    def push_file(self, loc_file):
+        """Upload `loc_file` unless an identical file is already at the destination.
+
+        Returns:
+            tuple: (action, synID) where action is one of "uploaded", "annotated" or "skipped".
+        """
+        remote = self.find_unchanged_remote(loc_file=loc_file)
+
+        if remote is None:
+            return "uploaded", self.add_file(loc_file=loc_file)
+
+        if self.update_annotations(remote=remote):
+            return "annotated", remote.id
+
+        log.info("""Skipping unchanged file "{name}".""".format(name=loc_file.name))
+        return "skipped", remote.id
+
+    def upload_file(self, loc_file):
+        """Run ``push_file`` on `loc_file`, retrying failures, and return an ``UploadResult``.
+
+        ``seconds`` covers the successful attempt only, or every attempt of a failed file.
+        """
+        n_bytes = loc_file.stat().st_size
+        start = time.perf_counter()
+
+        def timed_push():
+            attempt_start = time.perf_counter()
+            action, entity_id = self.push_file(loc_file=loc_file)
+            return action, entity_id, time.perf_counter() - attempt_start
+
+        try:
+            (action, entity_id, seconds), attempts = dtools.retry_call(
+                func=timed_push,
+                attempts=MAX_UPLOAD_ATTEMPTS,
+                delay=UPLOAD_RETRY_DELAY,
+                description='Upload of "{name}"'.format(name=loc_file.name))
+        except Exception as exc:
+            return UploadResult(path=loc_file, entity_id=None, action="failed", attempts=MAX_UPLOAD_ATTEMPTS,
+                                error=exc, n_bytes=n_bytes, seconds=time.perf_counter() - start)
+
+        return UploadResult(path=loc_file, entity_id=entity_id, action=action, attempts=attempts, error=None,
+                            n_bytes=n_bytes, seconds=seconds)
+
+    def prefetch_destination(self):
+        """Load in bulk what is needed to compare the local files with same-named files already at the destination.
+
+        Sizes and md5s come from batched file-handle requests and this interaction's annotation keys
+        from one query of the destination folder, so no entity object is fetched to find out that a
+        file is unchanged.
+        """
+        names = set(loc_file.name for loc_file in self.info.LOCAL_PATHS)
+
+        with self.push.dag_lock:
+            node_ids = []
+            for name in names:
+                file_id = self.push.dag.find_file(node_id=self.destination, name=name)
+                if file_id is not None:
+                    node_ids.append(file_id)
+
+        if not node_ids:
+            return
+
+        self.push.dag.load_md5_and_size(node_ids=node_ids)
+
+        if self.info.ANNOTATIONS:
+            rows = dtools.iter_child_files(syn=self.syn,
+                                           parent_id=self.destination,
+                                           columns=self.info.ANNOTATIONS.keys())
+            self.remote_annotations = {row.pop('id'): row for row in rows}
+
+    def prepare_uploads(self):
+        """Resolve the destination if ``plan()`` has not, and prefetch what comparing the files needs."""
+        if self.destination is None:
+            self.prepare_destination()
+        self.prefetch_destination()
+
+    def submit_uploads(self, executor):
+        """Prepare the destination and submit each local file to `executor`, returning the futures.
+
+        Preparing is retried like an upload. If it still fails, each local file gets a completed
+        future holding a failed ``UploadResult`` instead, so other interactions go on uploading.
+        """
+        path = self.info.REMOTE_DESTINATION_DIR
+        start = time.perf_counter()
+        try:
+            dtools.retry_call(func=self.prepare_uploads,
+                              attempts=MAX_UPLOAD_ATTEMPTS,
+                              delay=UPLOAD_RETRY_DELAY,
+                              description='Preparing destination "{path}"'.format(path=path))
+        except Exception as exc:
+            log.error("""Could not prepare destination "{path}": {error}""".format(path=path, error=exc))
+            seconds = time.perf_counter() - start
+            return [failed_upload(loc_file=loc_file, error=exc, seconds=seconds) for loc_file in self.info.LOCAL_PATHS]
+
+        return [executor.submit(self.upload_file, loc_file) for loc_file in self.info.LOCAL_PATHS]
 
     def execute(self):
-        """Execute the push interaction."""
-        self.prepare_destination()
+        """Execute the push interaction and return its list of ``UploadResult``."""
+        with ThreadPoolExecutor(max_workers=self.push.max_concurrent_uploads) as executor:
+            uploads = self.submit_uploads(executor=executor)
 
-        for loc_file in self.info.LOCAL_PATHS:
-            self.add_file(loc_file=loc_file)
+        results, = store_annotations(pushes=[self.push], all_results=[[upload.result() for upload in uploads]])
+
+        return results
 
     def _process_push_obj(self, push_obj):
         """Make sure we have what we think we have."""
@@ -292,13 +890,161 @@ class PushInteraction(BaseInteraction):
         return local_paths
 
 
-def main(ctx, user, push_config):
-    """Consume a push-config file, execute described transactions, save record of transactions."""
+def run_uploads(pushes, max_workers):
+    """Upload the files of every interaction of `pushes` through one pool of `max_workers` workers.
+
+    The progress bar counts uploaded bytes only: a file that turns out to be unchanged, re-annotated
+    or failed is taken off its total and counted next to it instead.
+
+    Returns:
+        list: one list of ``UploadResult`` per push, in the order of `pushes`.
+    """
+    total_bytes = sum(entry.n_bytes for push in pushes for entry in push.plan_entries)
+    progress = tqdm(total=total_bytes, unit='B', unit_scale=True, desc="Pushing")
+    not_uploaded = Counter()
+
+    with progress, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        owners = {}
+        for index, push in enumerate(pushes):
+            for interaction in push.interactions:
+                for upload in interaction.submit_uploads(executor=executor):
+                    owners[upload] = index
+
+        all_results = [[] for push in pushes]
+        for upload in as_completed(owners):
+            result = upload.result()
+            all_results[owners[upload]].append(result)
+
+            if result.action == "uploaded":
+                progress.update(result.n_bytes)
+            else:
+                not_uploaded[result.action] += 1
+                progress.total -= result.n_bytes
+                progress.set_postfix(not_uploaded)
+
+    return store_annotations(pushes=pushes, all_results=all_results)
+
+
+def store_annotations(pushes, all_results):
+    """Store the annotation changes queued by re-annotated files, one ``ProjectDAG.flush()`` per DAG.
+
+    Args:
+        pushes (list): the ``Push`` objects that produced `all_results`.
+        all_results (list): one list of ``UploadResult`` per push.
+
+    Returns:
+        list: `all_results` with each file whose annotations could not be stored marked "failed".
+    """
+    dags = OrderedDict()
+    annotated = {}
+    for push, results in zip(pushes, all_results):
+        dags[id(push.dag)] = push.dag
+        annotated.setdefault(id(push.dag), []).extend(result.entity_id for result in results
+                                                       if result.action == "annotated")
+
+    flushed = {}
+    for key, dag in dags.items():
+        if annotated[key]:
+            flushed.update((flush.node_id, flush) for flush in dag.flush(node_ids=annotated[key]))
+
+    updated_results = []
+    for results in all_results:
+        updated = []
+        for result in results:
+            flush = flushed.get(result.entity_id) if result.action == "annotated" else None
+            if (flush is not None) and (flush.error is not None):
+                result = result._replace(action="failed", attempts=flush.attempts, error=flush.error)
+            updated.append(result)
+        updated_results.append(updated)
+
+    return updated_results
+
+
+def failed_upload(loc_file, error, seconds):
+    """Return a completed future holding a failed ``UploadResult`` for `loc_file`, which was never attempted."""
+    upload = Future()
+    upload.set_result(UploadResult(path=loc_file, entity_id=None, action="failed", attempts=MAX_UPLOAD_ATTEMPTS,
+                                   error=error, n_bytes=loc_file.stat().st_size, seconds=seconds))
+
+    return upload
+
+
+def expand_push_configs(push_configs):
+    """Return the push-config files named by `push_configs`, replacing each directory by the configs it holds.
+
+    Directories contribute their ``PUSH_CONFIG_PATTERNS`` files in name order; duplicates are dropped.
+    """
+    paths = []
+    for push_config in push_configs:
+        push_config = Path(push_config)
+
+        if push_config.is_dir():
+            found = sorted(set(p for pattern in PUSH_CONFIG_PATTERNS for p in push_config.glob(pattern)))
+            if not found:
+                msg = """Directory "{d}" holds no push-config files.""".format(d=push_config)
+                raise e.ValidationError(msg)
+            paths.extend(found)
+        else:
+            paths.append(push_config)
+
+    unique = OrderedDict()
+    for path in paths:
+        unique.setdefault(path.resolve(), path)
+
+    return [str(path) for path in unique.values()]
+
+
+def mb_per_sec(n_bytes, seconds):
+    """Return the transfer rate in MB/s, ``None`` if `seconds` is zero."""
+    if not seconds:
+        return None
+
+    return n_bytes / 1e6 / seconds
+
+
+def format_bytes(n_bytes):
+    """Return `n_bytes` as a short human readable string."""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n_bytes < 1000:
+            return "{n:.1f} {unit}".format(n=n_bytes, unit=unit)
+        n_bytes /= 1000.0
+
+    return "{n:.1f} TB".format(n=n_bytes)
+
+
+def same_annotation_value(remote_value, value):
+    """Return True if a remote annotation value matches a configured one.
+
+    Synapse returns annotation values as lists, so single values are compared as one-item lists of strings.
+    """
+    def normalize(x):
+        if not isinstance(x, (list, tuple)):
+            x = [x]
+        return [str(i) for i in x]
+
+    if remote_value is None:
+        return False
+
+    return normalize(remote_value) == normalize(value)
+
+
+def main(ctx, user, push_configs, max_concurrent_uploads=None, plan_only=False):
+    """Consume push-config files, execute described transactions, save record of transactions.
+
+    `push_configs` may name files or directories of push-config files; all of them are run in one session.
+    """
     main_confs = ctx.obj.CONFIG
 
-    push = Push(main_confs=main_confs,
-                user=user,
-                push_config=push_config)
+    push = PushBatch(main_confs=main_confs,
+                     user=user,
+                     push_configs=expand_push_configs(push_configs),
+                     max_concurrent_uploads=max_concurrent_uploads)
+
+    push.login(create_project=not plan_only)
+    push.plan(create=not plan_only)
+    echo(push.format_plan())
+
+    if plan_only:
+        return
 
-    push.login()
     push.execute()
@@ -8,6 +8,13 @@ from pathlib import Path
 # import datetime as dt
 # import glob
 # from collections import deque
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 import networkx as nx
 import synapseclient as synapse
@@ -15,14 +22,28 @@ import synapseclient as synapse
 from munch import Munch, munchify
 
 import veoibd_synapse.errors as e
+from veoibd_synapse.misc import atomic_path, load_csv
+from veoibd_synapse.dag_tools import file_handle_md5_and_size
+from veoibd_synapse.download_cache import cache_from_config
 # from veoibd_synapse.misc import process_config, chunk_md5
-# import veoibd_synapse.dag_tools as dtools
 
 
 # Metadata
 __author__ = "Gus Dunn"
 __email__ = "w.gus.dunn@gmail.com"
 
+# Constants
+SYNC_WORKERS = 8  # concurrent Synapse requests while building project DBs
+COMBINE_CHUNK_SIZE = 50000  # rows read from a site DB file at a time
+COMBINED_DB_NAME = "combined_subjects.parquet"
+MANIFEST_NAME = "manifest.json"
+PARTS_DIR_NAME = "parts"  # one normalized Parquet file per DB file version and md5
+SUBJECT_COLUMN = "subject_id"
+SITE_COLUMN = "site"
+MONGO_DB_NAME = "veoibd"
+MONGO_COLLECTION_NAME = "subjects"
+MONGO_BATCH_SIZE = 5000  # upserts sent to mongod per bulk_write
+MONGO_INDEX_FIELDS = (SUBJECT_COLUMN, SITE_COLUMN, "batch")
 
 
 class SubjectDatabase(object):
@@ -47,17 +68,65 @@ class SubjectDatabase(object):
     # def __repr__(self):
     #     return "%s(main_confs=%r, syn=%r)" % (self.__class__, self.main_confs, self.syn)
 
+class SyncManifest(object):
+
+    """Record which DB file versions the last sync used so that only the work for changed files is redone.
+
+    ``entries`` maps each DB file's entity id to its ``version``, ``md5``, local ``path`` and
+    ``project_id``; ``combined`` records the parts the combined table was last built from.
+    """
+
+    def __init__(self, directory):
+        """Load the manifest kept in `directory`, or start an empty one."""
+        self.path = Path(directory) / MANIFEST_NAME
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.combined = {}
+
+        if self.path.exists():
+            with self.path.open() as manifest_file:
+                content = json.load(manifest_file)
+            self.entries = content.get('entries', {})
+            self.combined = content.get('combined', {})
+
+    def record(self, entity_id, version, md5, path, project_id):
+        """Record that `version` of `entity_id` is on disk at `path`."""
+        with self.lock:
+            self.entries[entity_id] = {'version': version,
+                                       'md5': md5,
+                                       'path': str(path),
+                                       'project_id': project_id,
+                                       }
+
+    def prune(self, keep):
+        """Forget every entry whose entity id is not in `keep`."""
+        with self.lock:
+            for entity_id in set(self.entries) - set(keep):
+                del self.entries[entity_id]
+
+    def save(self):
+        """Write the manifest to ``self.path``."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self.lock, atomic_path(self.path) as tmp_path, tmp_path.open('w') as manifest_file:
+            json.dump({'entries': self.entries, 'combined': self.combined}, manifest_file, indent=2, sort_keys=True)
+
+
 class ProjectSubjectDatabase(SubjectDatabase):
 
     """Manage interactions with Synapse concerning accessing, downloading, and combining subject database files from a single Synapse Project."""
 
-    def __init__(self, main_confs, syn, project_id):
+    def __init__(self, main_confs, syn, project_id, retrieve=True, manifest=None, cache=None):
         """Initialize and validate basic information.
 
         Args:
             main_confs (dict-like): refernce to main configuration tree.
             syn (Synapse): an active synapse connection object.
             project_id (str): Synapse ID for a project.
+            retrieve (bool): fetch the project, its DB file IDs and DB files now. ``False`` leaves
+                that to the caller, as ``TeamSubjectDatabase`` does to run many projects at once.
+            manifest (SyncManifest): record of synced DB file versions; the one in ``SUBJECT_DATABASE_DIR`` by default.
+            cache (DownloadCache): where DB files are downloaded; the one in the site config by default.
 
         """
         super(ProjectSubjectDatabase, self).__init__(main_confs, syn)
@@ -74,13 +143,21 @@ class ProjectSubjectDatabase(SubjectDatabase):
                 else:
                     pass
 
-        self.project = self.syn.get(project_id)
+        self.project_id = project_id
+        self.project = None
+        self.manifest = SyncManifest(directory=self.local_sub_db) if manifest is None else manifest
+        self.cache = cache_from_config(main_confs) if cache is None else cache
         self.data = Munch()
         self.db_files = Munch()
 
-        self.retrieve_db_file_ids()
-        self.get_db_files()
+        if retrieve:
+            self.get_project()
+            self.retrieve_db_file_ids()
+            self.get_db_files()
 
+    def get_project(self):
+        """Retrieve the project entity and store it in ``self.project``."""
+        self.project = self.syn.get(self.project_id)
 
     def retrieve_db_file_ids(self):
         """Perform SQL query and return list of ``file.id`` values that are tagged with ``is_db=='true'`` for this project."""
@@ -92,12 +169,31 @@ class ProjectSubjectDatabase(SubjectDatabase):
         self.data.db_file_ids = [x['file.id'] for x in results]
         log.debug('Retrieved DB file IDs.')
 
+    def get_db_file(self, file_id):
+        """Return the DB file entity `file_id` with ``path`` set to a local copy of its current version.
+
+        Only the entity's metadata is fetched when the download cache already holds this version and
+        md5; otherwise the file is downloaded into the cache. Either way it is recorded in the manifest.
+        """
+        file_entity = self.syn.get(file_id, downloadFile=False)
+        file_entity.path = str(self.cache.get(syn=self.syn, file_entity=file_entity))
+
+        self.manifest.record(entity_id=file_id,
+                             version=file_entity.versionNumber,
+                             md5=file_handle_md5_and_size(file_entity)[0],
+                             path=file_entity.path,
+                             project_id=self.project.id)
+        return file_entity
+
+    def add_db_file(self, file_entity):
+        """Store a downloaded DB file entity in ``self.db_files``."""
+        self.db_files[file_entity.properties.name.replace('.','__')] = file_entity
+
     def get_db_files(self):
         """Iterate through DB file IDs preforming ``sns.get(db_file_id)`` and storing in ``self.db_files``."""
         log.debug('Beginning to download {num} DB files.'.format(num=len(self.data.db_file_ids)))
         for fid in self.data.db_file_ids:
-            file_entity = self.syn.get(fid)
-            self.db_files[file_entity.properties.name.replace('.','__')] = file_entity
+            self.add_db_file(self.get_db_file(fid))
 
         log.debug('Downloaded {num} DB files.'.format(num=len(self.data.db_file_ids)))
 
@@ -105,37 +201,105 @@ class TeamSubjectDatabase(SubjectDatabase):
 
     """Manage interactions with Synapse concerning accessing, downloading, and combining subject database files from all member-sites in a Team."""
 
-    def __init__(self, main_confs, syn, team_name):
+    def __init__(self, main_confs, syn, team_name, max_workers=SYNC_WORKERS):
         """Initialize and validate basic information.
 
         Args:
             main_confs (dict-like): refernce to main configuration tree.
             syn (Synapse): an active synapse connection object.
             team_name (str): the name of a Synapse Team.
+            max_workers (int): number of Synapse requests run at once while building project DBs.
 
         """
         super(TeamSubjectDatabase, self).__init__(main_confs, syn)
         self.team = self.syn.getTeam(team_name)
+        self.max_workers = max_workers
         self.project_ids = None
         self.project_dbs = Munch()
+        self.failures = Munch()
+        self.manifest = SyncManifest(directory=self.local_sub_db)
+        self.cache = cache_from_config(main_confs)
 
         self.retrieve_team_project_ids()
-        self.build_project_dbs()
-        self.combine_project_dbs()
+        with self.cache.lease() as lease:
+            self.build_project_dbs(cache=lease)
+            self.combine_project_dbs()
 
-    def combine_project_dbs(self):
-        """This has not yet been implemented.
+    def combine_project_dbs(self, chunksize=COMBINE_CHUNK_SIZE):
+        """Combine every DB file into one deduplicated subject table, reusing all work that is still current.
 
-        Extra information section
+        Each DB file version is first normalized into its own Parquet part (see ``write_db_part()``);
+        parts already on disk are reused. Parts are then merged onto the union of their columns,
+        keeping each ``subject_id`` the first time it is seen in ``self.project_ids`` order. When the
+        parts are exactly those of the previous sync the combined table is left as it is. Memory use
+        is bounded by `chunksize` rows plus the index of seen subject IDs.
 
-        Args:
-            param1 (type): The first parameter.
-            param2 (type): The second parameter.
+        A DB file that cannot be read is logged and recorded in ``self.failures`` under its
+        project, the remaining files are still combined.
 
         Returns:
-            type: The return value. True for success, False otherwise.
+            Path: the combined table, also stored as ``self.combined_path``.
+        """
+        parts = []
+        for project_id, project_db in self.project_dbs.items():
+            for db_file in project_db.db_files.values():
+                try:
+                    parts.append(self._get_part(db_file=db_file, site=project_db.project.name, chunksize=chunksize))
+                except Exception as exc:
+                    self._record_failure(project_id=project_id, exc=exc)
+
+        part_names = [part.name for part in parts]
+        self.combined_path = Path(self.local_sub_db) / COMBINED_DB_NAME
+
+        if (self.manifest.combined.get('parts') == part_names) and self.combined_path.exists():
+            self.data.n_subjects = self.manifest.combined['n_subjects']
+            log.info("""No DB file changed since the last sync, keeping "{path}".""".format(path=self.combined_path))
+        else:
+            columns = [SUBJECT_COLUMN]
+            for part in parts:
+                columns.extend(c for c in read_part_columns(path=part) if c not in columns + [SITE_COLUMN])
+            columns.append(SITE_COLUMN)
+
+            chunks = (chunk for part in parts for chunk in iter_part_chunks(path=part,
+                                                                             columns=columns,
+                                                                             chunksize=chunksize))
+            self.data.n_subjects = write_subject_table(chunks=chunks, columns=columns, out_path=self.combined_path)
+            self.manifest.combined = {'parts': part_names, 'n_subjects': self.data.n_subjects}
+
+            log.info("""Combined {n} subjects from {files} DB files into "{path}".""".format(n=self.data.n_subjects,
+                                                                                            files=len(parts),
+                                                                                            path=self.combined_path))
+        self._save_manifest()
+
+        return self.combined_path
+
+    def _get_part(self, db_file, site, chunksize):
+        """Return the Parquet part of `db_file`, writing it if this version and md5 have none yet."""
+        part = Path(self.local_sub_db) / PARTS_DIR_NAME / part_name(entity_id=db_file.id,
+                                                                    version=db_file.versionNumber,
+                                                                    md5=file_handle_md5_and_size(db_file)[0])
+        if not part.exists():
+            write_db_part(path=db_file.path, site=site, out_path=part, chunksize=chunksize)
+
+        return part
+
+    def _save_manifest(self):
+        """Drop manifest entries and parts of DB files that are gone, then save the manifest.
+
+        Entries of projects that failed this time are kept for the next sync.
         """
-        raise NotImplementedError()
+        keep = [db_file.id for project_db in self.project_dbs.values() for db_file in project_db.db_files.values()]
+        keep.extend(entity_id for entity_id, entry in self.manifest.entries.items()
+                    if entry['project_id'] in self.failures)
+        self.manifest.prune(keep=keep)
+
+        current = set(part_name(entity_id=entity_id, version=entry['version'], md5=entry['md5'])
+                      for entity_id, entry in self.manifest.entries.items())
+        for part in (Path(self.local_sub_db) / PARTS_DIR_NAME).glob('*.parquet'):
+            if part.name not in current:
+                part.unlink()
+
+        self.manifest.save()
 
     def retrieve_team_project_ids(self):
         """Retrieve info for all projects shared with ``self.team.id``.
@@ -156,19 +320,279 @@ class TeamSubjectDatabase(SubjectDatabase):
 
         self.project_ids = proj_ids
 
-    def build_project_dbs(self):
-        """Iterate through project IDs building DB tables from each, storing the restults.
+    def build_project_dbs(self, cache=None):
+        """Build a ``ProjectSubjectDatabase`` for every team project, storing them in ``self.project_dbs``.
+
+        The project lookups, DB-file queries and DB-file downloads of all projects share one pool of
+        ``self.max_workers`` threads. Only the main thread submits work, so a project waiting on its
+        downloads never holds a worker. Results are gathered in ``self.project_ids`` order whatever
+        order they finish in. A project that fails is logged and recorded in ``self.failures``; the
+        other projects carry on.
 
-        Stored as ``ProjectSubjectDatabase`` objects
+        Args:
+            cache (DownloadCache): where DB files are downloaded, ``self.cache`` by default. Pass a
+                ``Lease`` of it to keep the files from being evicted before they are combined.
         """
+        cache = self.cache if cache is None else cache
+
+        project_dbs = OrderedDict()
         for project_id in self.project_ids:
-            project_db = ProjectSubjectDatabase(main_confs=self.main_confs, syn=self.syn, project_id=project_id)
-            self.project_dbs[project_db.project.id] = project_db
+            project_dbs[project_id] = ProjectSubjectDatabase(main_confs=self.main_confs,
+                                                             syn=self.syn,
+                                                             project_id=project_id,
+                                                             retrieve=False,
+                                                             manifest=self.manifest,
+                                                             cache=cache)
+
+        log.info('Building DBs for {num} projects.'.format(num=len(project_dbs)))
+
+        downloads = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            lookups = {executor.submit(self._look_up_project_db, project_db): project_id
+                       for project_id, project_db in project_dbs.items()}
+
+            for lookup in as_completed(lookups):
+                project_id = lookups[lookup]
+                try:
+                    lookup.result()
+                except Exception as exc:
+                    self._record_failure(project_id=project_id, exc=exc)
+                    continue
+
+                project_db = project_dbs[project_id]
+                downloads[project_id] = [executor.submit(project_db.get_db_file, fid)
+                                         for fid in project_db.data.db_file_ids]
+
+            for project_id, project_db in project_dbs.items():
+                if project_id not in downloads:
+                    continue
+
+                try:
+                    for download in downloads[project_id]:
+                        project_db.add_db_file(download.result())
+                except Exception as exc:
+                    self._record_failure(project_id=project_id, exc=exc)
+                    continue
+
+                self.project_dbs[project_db.project.id] = project_db
+
+        log.info('Built DBs for {ok} of {total} projects.'.format(ok=len(self.project_dbs), total=len(project_dbs)))
+
+    def _look_up_project_db(self, project_db):
+        """Retrieve the project entity and DB file IDs of `project_db`."""
+        project_db.get_project()
+        project_db.retrieve_db_file_ids()
+
+    def _record_failure(self, project_id, exc):
+        """Log that the DB of `project_id` could not be built and remember why."""
+        log.error('Could not build the DB of project {project_id}: {error}'.format(project_id=project_id, error=exc))
+        self.failures[project_id] = exc
+
+
+
+
+def part_name(entity_id, version, md5):
+    """Return the file name of the Parquet part of one version and md5 of a DB file."""
+    return "{id}.{version}.{md5}.parquet".format(id=entity_id, version=version, md5=md5)
+
+
+def normalize_column_name(name):
+    """Return `name` lower-cased with each run of non-alphanumeric characters replaced by one underscore."""
+    return re.sub(r'[^0-9a-z]+', '_', str(name).strip().lower()).strip('_')
+
+
+def read_db_columns(path):
+    """Return the normalized column names of the DB file at `path` without reading its rows."""
+    return [normalize_column_name(c) for c in load_csv(path, nrows=0).columns]
+
+
+def iter_db_chunks(path, columns, site, chunksize=COMBINE_CHUNK_SIZE):
+    """Yield the rows of the DB file at `path` as string-typed frames with exactly `columns`.
+
+    Columns missing from the file are filled with nulls and ``SITE_COLUMN`` is set to `site`.
+    """
+    for chunk in load_csv(path, dtype=str, chunksize=chunksize):
+        chunk.columns = [normalize_column_name(c) for c in chunk.columns]
+        chunk[SITE_COLUMN] = site
+        yield chunk.reindex(columns=columns)
+
+
+def read_part_columns(path):
+    """Return the column names of the Parquet part at `path`."""
+    import pyarrow.parquet as pq
 
+    return pq.read_schema(str(path)).names
 
 
+def iter_part_chunks(path, columns, chunksize=COMBINE_CHUNK_SIZE):
+    """Yield the rows of the Parquet part at `path` in frames of up to `chunksize` rows with exactly `columns`."""
+    import pyarrow.parquet as pq
 
-def main(ctx, user, team_name):
-    """"""
+    for batch in pq.ParquetFile(str(path)).iter_batches(batch_size=chunksize):
+        yield batch.to_pandas().reindex(columns=columns)
+
+
+@contextmanager
+def parquet_writer(out_path, columns):
+    """Yield a ``pyarrow.parquet.ParquetWriter`` of string `columns` to `out_path`, written through ``atomic_path()``."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    with atomic_path(out_path) as tmp_path, pq.ParquetWriter(str(tmp_path), schema) as writer:
+        yield writer
+
+
+def write_frame(writer, frame):
+    """Append `frame` to the ``ParquetWriter`` `writer`."""
+    import pyarrow as pa
+
+    writer.write_table(pa.Table.from_pandas(frame, schema=writer.schema, preserve_index=False))
+
+
+def write_db_part(path, site, out_path, chunksize=COMBINE_CHUNK_SIZE):
+    """Write the DB file at `path` to a Parquet part with normalized, string-typed columns and a ``SITE_COLUMN``."""
+    columns = read_db_columns(path=path)
+    if SUBJECT_COLUMN not in columns:
+        msg = """DB file "{name}" has no "{col}" column.""".format(name=Path(path).name, col=SUBJECT_COLUMN)
+        raise e.ValidationError(msg)
+
+    columns = [c for c in columns if c != SITE_COLUMN] + [SITE_COLUMN]
+    with parquet_writer(out_path=out_path, columns=columns) as writer:
+        for chunk in iter_db_chunks(path=path, columns=columns, site=site, chunksize=chunksize):
+            write_frame(writer=writer, frame=chunk)
+
+
+def write_subject_table(chunks, columns, out_path):
+    """Write the rows of `chunks` with the first occurrence of each subject ID to a Parquet file.
+
+    Rows without a subject ID are dropped. The file is written next to `out_path` and moved into
+    place when complete.
+
+    Args:
+        chunks (iterable): frames with exactly `columns`, in order of precedence.
+        columns (list): output columns, including ``SUBJECT_COLUMN`` and ``SITE_COLUMN``.
+        out_path (Path): where to write the table.
+
+    Returns:
+        int: the number of subjects written.
+    """
+    seen = set()
+    n_dropped = 0
+
+    with parquet_writer(out_path=out_path, columns=columns) as writer:
+        for chunk in chunks:
+            subject_ids = chunk[SUBJECT_COLUMN].str.strip()
+            chunk[SUBJECT_COLUMN] = subject_ids
+
+            keep = []
+            for subject_id in subject_ids:
+                is_new = isinstance(subject_id, str) and bool(subject_id) and (subject_id not in seen)
+                if is_new:
+                    seen.add(subject_id)
+                keep.append(is_new)
+
+            n_dropped += len(keep) - sum(keep)
+            if any(keep):
+                write_frame(writer=writer, frame=chunk[keep])
+
+    if n_dropped:
+        log.debug("""Dropped {n} duplicate or unidentified rows.""".format(n=n_dropped))
+
+    return len(seen)
+
+
+def connect_mongo(main_confs):
+    """Return the subjects collection of the ``mongod`` configured in ``configs/mongodb.yaml``."""
+    import pymongo
+
+    net = main_confs.MONGODB.net
+    client = pymongo.MongoClient(host=net.bindIp, port=net.port)
+
+    return client[MONGO_DB_NAME][MONGO_COLLECTION_NAME]
+
+
+def subject_documents(frame):
+    """Yield one document per row of `frame`, keyed by its subject ID and leaving out null fields."""
+    for record in frame.to_dict(orient='records'):
+        document = {k: v for k, v in record.items() if isinstance(v, str)}
+        document['_id'] = document[SUBJECT_COLUMN]
+        yield document
+
+
+def load_subject_table(path, collection, batch_size=MONGO_BATCH_SIZE):
+    """Upsert every row of the combined subject table at `path` into `collection`, then index it.
+
+    Rows are sent as unordered batches of `batch_size` ``ReplaceOne`` upserts keyed by subject ID,
+    so re-loading the same table leaves the collection unchanged. Indexes on
+    ``MONGO_INDEX_FIELDS`` are built once all rows are in; building them during the load would
+    slow every write. Subjects no longer in the table are not removed.
+
+    Args:
+        path (Path): the combined subject table written by ``TeamSubjectDatabase``.
+        collection (Collection): a ``pymongo`` collection, or a stand-in such as one from
+            ``mongomock.MongoClient()``.
+        batch_size (int): documents per ``bulk_write`` call.
+
+    Returns:
+        Munch: ``documents``, ``inserted``, ``updated``, ``seconds`` and ``docs_per_sec``.
+    """
+    from pymongo import ReplaceOne
+
+    stats = Munch(documents=0, inserted=0, updated=0)
+    start = time.perf_counter()
+
+    for chunk in iter_part_chunks(path=path, columns=read_part_columns(path=path), chunksize=batch_size):
+        requests = [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in subject_documents(chunk)]
+        if not requests:
+            continue
+
+        result = collection.bulk_write(requests, ordered=False)
+        stats.documents += len(requests)
+        stats.inserted += result.upserted_count
+        stats.updated += result.modified_count
+
+    load_seconds = time.perf_counter() - start
+    for field in MONGO_INDEX_FIELDS:
+        collection.create_index(field, unique=(field == SUBJECT_COLUMN))
+
+    stats.seconds = time.perf_counter() - start
+    stats.docs_per_sec = stats.documents / load_seconds if load_seconds else None
+
+    log.info("""Loaded {n} subjects into "{coll}" ({new} new, {changed} changed) at {rate:.0f} documents/sec.""".format(
+        n=stats.documents,
+        coll=collection.full_name,
+        new=stats.inserted,
+        changed=stats.updated,
+        rate=stats.docs_per_sec or 0.0))
+
+    return stats
+
+
+def main(ctx, user, team_name, to_mongo=False):
+    """Download the subject DB files of every project shared with `team_name` and combine them.
+
+    With `to_mongo` the combined table is also loaded into the ``mongod`` of ``configs/mongodb.yaml``.
+    """
     main_confs = ctx.obj.CONFIG
-    raise e.NotImplementedYet()
+
+    try:
+        user = main_confs.USERS[user]
+    except KeyError:
+        raise e.ValidationError('User "{user}" not found in "users.yaml".'.format(user=user))
+
+    syn = synapse.Synapse()
+    syn.login(email=user.SYN_USERNAME, apiKey=user.API_KEY)
+
+    team_db = TeamSubjectDatabase(main_confs=main_confs, syn=syn, team_name=team_name)
+
+    if to_mongo:
+        load_subject_table(path=team_db.combined_path, collection=connect_mongo(main_confs))
+
+    if team_db.failures:
+        msg = """{n} project(s) could not be fully synced: {ids}""".format(n=len(team_db.failures),
+                                                                          ids=", ".join(team_db.failures.keys()))
+        raise e.SyncError(msg)
@@ -4,12 +4,14 @@
 # Imports
 from logzero import logger as log
 
-from functools import partial
-from collections import deque
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import networkx as nx
 
-from munch import Munch, munchify
+from munch import Munch
 
 import synapseclient as synapse
 
@@ -19,42 +21,175 @@ import veoibd_synapse.errors as e
 __author__ = "Gus Dunn"
 __email__ = "w.gus.dunn@gmail.com"
 
+# Constants
+PREFETCH_WORKERS = 8
+FLUSH_WORKERS = 8
+MAX_STORE_ATTEMPTS = 5
+STORE_RETRY_DELAY = 2  # seconds; doubled after each failed attempt
+RATE_LIMIT_DELAY = 30  # seconds; minimum wait when the server says we are going too fast
+RATE_LIMIT_STATUS_CODES = (429, 503)
+QUERY_PAGE_SIZE = 1000
+FILE_HANDLE_BATCH_SIZE = 100  # most file handles the file service returns per request
+DAG_ENTITY_COLUMNS = ("id", "name", "parentId", "nodeType", "dataFileHandleId")
+NODE_FIELDS = ("id", "parentId", "name", "nodeType", "dataFileHandleId", "md5", "size")  # kept on every SynNode
+# SynNode attributes read from the entity object; any other name fails without a round trip to Synapse
+ENTITY_PROPERTIES = ("concreteType", "createdBy", "createdOn", "description", "etag",
+                     "modifiedBy", "modifiedOn", "versionComment", "versionLabel", "versionNumber")
+
 
 # Classes
-class SynNode(Munch):
+FlushResult = namedtuple('FlushResult', ["node_id", "attempts", "error"])
 
-    """Provide methods and attributes to model an entity node in a DAG of Synapse Entities."""
 
-    def __init__(self, entity_dict, synapse_session=None, is_root=False, ):
-        """Initialize an entity node object."""
-        new_dict = self._process_entity_dict(entity_dict=entity_dict)
-        new_dict['is_root'] = is_root
-        Munch.__init__(self, new_dict)
+class SynNode(object):
 
-        self.syn = synapse_session
-        self.obj = self.syn.get(self.id)
+    """Provide methods and attributes to model an entity node in a DAG of Synapse Entities.
+
+    A node only keeps the fields in ``NODE_FIELDS``. The entity properties in ``ENTITY_PROPERTIES``
+    can also be read as attributes; they come from the entity object, which is fetched on first
+    use. Anything else must be read from ``node.obj``. Nodes are hashed and compared by entity id.
+
+    The small mapping interface (``[]``, ``get``, ``keys``, ``items``, ``update``) is what networkx
+    expects of node data; it only covers the fields kept on the node, so it never fetches.
+    """
+
+    __slots__ = NODE_FIELDS + ("is_root", "needs_update", "syn", "_obj")
+
+    def __init__(self, entity_dict, synapse_session=None, is_root=False, obj=None):
+        """Initialize an entity node object.
+
+        Keys of `entity_dict` outside of ``NODE_FIELDS`` are left to the entity object. That object
+        is not fetched here: ``self.obj`` retrieves it from Synapse on first access unless it is
+        provided as `obj` or loaded in bulk by ``ProjectDAG.prefetch()``.
+        """
+        for field in NODE_FIELDS:
+            setattr(self, field, None)
+
+        self.update(entity_dict)
+        self.is_root = is_root
         self.needs_update = False
+        self.syn = synapse_session
+        self._obj = obj
+
+    @property
+    def obj(self):
+        """Return the Synapse entity object, fetching it on first access."""
+        if self._obj is None:
+            self.fetch()
+        return self._obj
+
+    @obj.setter
+    def obj(self, value):
+        self._obj = value
+
+    @property
+    def is_fetched(self):
+        """Return True if the entity object has already been retrieved."""
+        return self._obj is not None
+
+    def fetch(self):
+        """Retrieve the entity object from Synapse and return it."""
+        self._obj = self.syn.get(self.id, downloadFile=False)
+        return self._obj
 
     def store(self):
         """If self.needs_update is True, run sys.store and reset needs_update."""
         if self.needs_update:
-            self.syn.store(self.obj)
+            self.obj = self.syn.store(self.obj)
             self.needs_update = False
 
-    def _process_entity_dict(self, entity_dict):
-        new_dict = {}
-        for name, value in entity_dict.items():
-            attr_name = name.replace('entity.','')
-            new_dict[attr_name] = value
+    def download(self, cache):
+        """Return a local path to this file node's current version, downloading it into `cache` if needed.
+
+        Args:
+            cache (DownloadCache): the shared download cache, or a ``Lease`` of it.
+
+        Returns:
+            Path
+        """
+        return cache.get(syn=self.syn, file_entity=self.obj)
+
+    def md5_and_size(self):
+        """Return ``(md5, size)`` of a file node, ``(None, None)`` if they are not known.
 
-            # if name.startswith('entity.'):
-            #     attr_name = name.replace('entity.','')
-            #     new_dict[attr_name] = value
-            # else:
-            #     msg = """We expect all keys in an entity-query-result dict to begin with 'entity.', \n\tinstead we found: '{key}'.""".format(key=name)
-            #     raise e.ValidationError(msg)
-        return new_dict
+        Values recorded on the node, e.g. by ``ProjectDAG.load_md5_and_size()``, are preferred over
+        those of its entity object.
+        """
+        md5 = self.md5
+        size = self.size
 
+        if (md5 is None) or (size is None):
+            md5, size = file_handle_md5_and_size(self.obj)
+
+        return md5, size
+
+    def __getattr__(self, name):
+        """Return an entity property in ``ENTITY_PROPERTIES`` from the entity object."""
+        if name not in ENTITY_PROPERTIES:
+            raise AttributeError(name)
+
+        try:
+            return self.obj[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    # mapping interface
+    def __getitem__(self, key):
+        """Return field `key`, which must be one kept on the node."""
+        if key not in self.keys():
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        """Set field `key`, which must be one kept on the node."""
+        if key not in self.keys():
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        """Return True if `key` is a field kept on the node."""
+        return key in self.keys()
+
+    def __iter__(self):
+        """Iterate over the fields kept on the node."""
+        return iter(self.keys())
+
+    def __len__(self):
+        """Return the number of fields kept on the node."""
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        """Return field `key` or `default` if the node does not keep it or it is not known."""
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+
+        return default if value is None else value
+
+    def keys(self):
+        """Return the names of the fields kept on the node."""
+        return NODE_FIELDS + ("is_root",)
+
+    def items(self):
+        """Return ``(field, value)`` pairs for the fields kept on the node."""
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def update(self, entity_dict=None, **kwargs):
+        """Set the fields of `entity_dict` and `kwargs` kept on the node, dropping the ``entity.`` key prefix."""
+        for mapping in (entity_dict or {}, kwargs):
+            for name, value in mapping.items():
+                attr_name = name.replace('entity.', '')
+                if attr_name in self.__slots__:
+                    setattr(self, attr_name, value)
+
+    def __repr__(self):
+        """Return a short description of the node."""
+        return "SynNode(id={id!r}, name={name!r}, nodeType={node_type!r})".format(id=self.id,
+                                                                                   name=self.name,
+                                                                                   node_type=self.nodeType)
 
     def __str__(self):
         """Override this."""
@@ -62,31 +197,100 @@ class SynNode(Munch):
 
     def __hash__(self):
         """Return hash value."""
-        return hash(self.__repr__())
+        return hash(self.id)
 
     def __eq__(self, other):
         """Return True if equal."""
-        return self.__hash__() == other.__hash__()
+        if not isinstance(other, SynNode):
+            return NotImplemented
+        return self.id == other.id
 
     def __ne__(self, other):
         """Return True if NOT equal."""
-        return self.__hash__() != other.__hash__()
+        if not isinstance(other, SynNode):
+            return NotImplemented
+        return self.id != other.id
+
+
+class NodeDict(Munch):
+
+    """Provide ``ProjectDAG.node``: a node mapping that tells its DAG when a node is assigned or removed."""
 
+    def __init__(self, dag, *args, **kwargs):
+        """Initialize the mapping and remember `dag` without storing it as a key."""
+        object.__setattr__(self, '_dag', dag)
+        Munch.__init__(self, *args, **kwargs)
 
+    def __setitem__(self, key, value):
+        """Assign node data and index it under its parent(s)."""
+        Munch.__setitem__(self, key, value)
+        self._dag._index_node(node_id=key)
+
+    def __delitem__(self, key):
+        """Remove node data and drop it from the DAG's indexes."""
+        self._dag._unindex_node(node_id=key)
+        Munch.__delitem__(self, key)
 
 
 class ProjectDAG(nx.DiGraph):
 
-    """Class to generate and manage our project structure."""
+    """Class to generate and manage our project structure.
+
+    Children are indexed by ``(parent_id, name)`` as edges are added and nodes are assigned, so
+    resolving a folder path costs one dict lookup per level. Resolved paths are cached.
+    """
 
     def __init__(self, project_id, synapse_session):
         """Set up instance."""
+        self.child_index = {}
+        self._path_cache = {}
+
         super(ProjectDAG, self).__init__()
 
-        self.node = munchify(self.node)
+        self.node = NodeDict(self, self.node)
         self.project_id = project_id
         self.syn = synapse_session
 
+    def add_edge(self, u, v, attr_dict=None, **attr):
+        """Add an edge from parent `u` to child `v` and index `v` under `u`."""
+        super(ProjectDAG, self).add_edge(u, v, attr_dict=attr_dict, **attr)
+        self._index_node(node_id=v)
+
+    def add_node(self, n, attr_dict=None, **attr):
+        """Add or update node `n` and (re-)index it under its parent(s)."""
+        super(ProjectDAG, self).add_node(n, attr_dict=attr_dict, **attr)
+        self._index_node(node_id=n)
+
+    def _index_node(self, node_id):
+        """Record ``(parent_id, name) -> node_id`` for each known parent of a named node."""
+        try:
+            name = self.node[node_id].get('name')
+            parents = self.pred[node_id]
+        except (KeyError, AttributeError):
+            return
+
+        if name is None:
+            return
+
+        for parent_id in parents:
+            self.child_index[(parent_id, name)] = node_id
+
+    def _unindex_node(self, node_id):
+        """Forget a node that is being removed: its index entries, those of its children and paths cached through it."""
+        name = self.node[node_id].get('name')
+
+        for parent_id in self.pred.get(node_id, {}):
+            if self.child_index.get((parent_id, name)) == node_id:
+                del self.child_index[(parent_id, name)]
+
+        for key in [key for key in self.child_index if key[0] == node_id]:
+            del self.child_index[key]
+
+        subtree = nx.descendants(self, node_id) | {node_id}
+        for key, resolved_id in list(self._path_cache.items()):
+            if (key[0] in subtree) or (resolved_id in subtree):
+                del self._path_cache[key]
+
     def check_children(self, node_id, func):
         """Return list of child-ids where `func` returns True."""
         children = self[node_id]
@@ -97,52 +301,314 @@ class ProjectDAG(nx.DiGraph):
 
         return successes
 
+    def flush(self, node_ids=None, max_workers=FLUSH_WORKERS):
+        """Store every node marked ``needs_update`` using up to `max_workers` concurrent requests.
+
+        Each node is retried on failure, waiting longer when Synapse signals rate limiting, and
+        a failing node does not stop the others; it stays marked for a later flush.
+
+        Args:
+            node_ids (iterable): only consider these nodes; all nodes if ``None``.
+            max_workers (int): number of concurrent store requests.
+
+        Returns:
+            list: one ``FlushResult`` per dirty node; ``error`` is ``None`` for nodes that were stored.
+        """
+        if node_ids is None:
+            node_ids = list(self.node.keys())
+
+        dirty = [node_id for node_id in set(node_ids)
+                 if isinstance(self.node.get(node_id), SynNode) and self.node[node_id].needs_update]
+
+        if not dirty:
+            return []
+
+        log.info("Storing {num} updated entities.".format(num=len(dirty)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self._store_node, dirty))
+
+        failed = [result for result in results if result.error is not None]
+        for result in failed:
+            log.error("""Failed to store "{node_id}" after {n} attempts: {error}""".format(node_id=result.node_id,
+                                                                                         n=result.attempts,
+                                                                                         error=result.error))
+
+        log.info("Stored {ok} of {total} updated entities.".format(ok=len(results) - len(failed), total=len(results)))
+
+        return results
+
+    def _store_node(self, node_id):
+        """Run ``store()`` on one node, retrying failures, and return a ``FlushResult``."""
+        try:
+            _, attempts = retry_call(func=self.node[node_id].store,
+                                     attempts=MAX_STORE_ATTEMPTS,
+                                     delay=STORE_RETRY_DELAY,
+                                     description='Storing "{node_id}"'.format(node_id=node_id))
+        except Exception as exc:
+            return FlushResult(node_id=node_id, attempts=MAX_STORE_ATTEMPTS, error=exc)
+
+        return FlushResult(node_id=node_id, attempts=attempts, error=None)
+
+    def find_child(self, node_id, name, node_type=None):
+        """Return the synID of the child of `node_id` called `name` or ``None``.
+
+        If `node_type` is given, a child of any other type does not count.
+        """
+        child_id = self.child_index.get((node_id, name))
+
+        if (child_id is None) or (node_type is None):
+            return child_id
+
+        if self.node[child_id].get('nodeType') == node_type:
+            return child_id
+
+        return None
+
+    def find_file(self, node_id, name):
+        """Return the synID of the file named `name` directly under `node_id` or ``None``."""
+        return self.find_child(node_id=node_id, name=name, node_type='file')
+
     def follow_path_to_folder(self, path, origin=None, create=False):
-        """Return terminal folder's synID after traversing the defined path."""
+        """Return terminal folder's synID after traversing the defined path.
+
+        Args:
+            path (iterable): folder names from `origin` downward.
+            origin (str): synID to start from, the project if ``None``.
+            create (bool): create missing folders instead of raising ``NoResult``.
+        """
         if origin is None:
             origin = self.project_id
 
+        path = tuple(path)
         try:
-            name = path.popleft()
-        except AttributeError:
-            path = deque(path)
-            name = path.popleft()
+            return self._path_cache[(origin, path)]
+        except KeyError:
+            pass
+
+        node_id = origin
+        for name in path:
+            next_node_id = self.find_child(node_id=node_id, name=name, node_type='folder')
+
+            if next_node_id is None:
+                if create:
+                    next_node_id = self.create_folder(parent_id=node_id, name=name)
+                else:
+                    raise e.NoResult()
+
+            node_id = next_node_id
+
+        self._path_cache[(origin, path)] = node_id
+
+        return node_id
+
+    def split_path(self, path, origin=None):
+        """Return the synID of the deepest existing folder along `path` and the tuple of names below it that do not exist."""
+        if origin is None:
+            origin = self.project_id
+
+        path = tuple(path)
+        node_id = origin
+        for depth, name in enumerate(path):
+            next_node_id = self.find_child(node_id=node_id, name=name, node_type='folder')
+
+            if next_node_id is None:
+                return node_id, path[depth:]
+
+            node_id = next_node_id
+
+        return node_id, ()
+
+    def create_folder(self, parent_id, name):
+        """Create a Synapse folder `name` under `parent_id`, add it to the DAG and return its synID."""
+        new_folder = synapse.Folder(name, parent=parent_id)
+        new_folder = self.syn.store(new_folder)
+        new_folder_id = new_folder['id']
+
+        # add new edge to DAG
+        self.add_edge(u=parent_id, v=new_folder_id, attr_dict=None)
+
+        entity_dict = {k:v  for k,v in new_folder.items()}
+        entity_dict['nodeType'] = 'folder'
+        self.node[new_folder_id] = SynNode(entity_dict=entity_dict,
+                                           synapse_session=self.syn,
+                                           is_root=False,
+                                           obj=new_folder)
+
+        return new_folder_id
+
+    def load_md5_and_size(self, node_ids):
+        """Record md5 and size on those file nodes of `node_ids` that lack them.
+
+        Only the file handles are requested, ``FILE_HANDLE_BATCH_SIZE`` per round trip, so the
+        entity objects are not fetched. Nodes whose handle the file service does not return keep
+        ``None`` and fall back to their entity object in ``SynNode.md5_and_size()``.
+        """
+        nodes = [self.node[n] for n in set(node_ids)
+                 if (self.node[n].dataFileHandleId is not None) and None in (self.node[n].md5, self.node[n].size)]
+
+        for start in range(0, len(nodes), FILE_HANDLE_BATCH_SIZE):
+            batch = nodes[start:start + FILE_HANDLE_BATCH_SIZE]
+            file_handles = get_file_handles(syn=self.syn,
+                                            entity_handle_ids=[(node.id, node.dataFileHandleId) for node in batch])
+            for node in batch:
+                node.md5, node.size = handle_md5_and_size(file_handles.get(node.dataFileHandleId))
+
+    def prefetch(self, node_ids, max_workers=PREFETCH_WORKERS):
+        """Fetch the entity objects of `node_ids` concurrently so that later ``.obj`` access is free.
+
+        Nodes that have already been fetched are skipped.
+        """
+        nodes = [self.node[n] for n in set(node_ids) if not self.node[n].is_fetched]
+
+        if not nodes:
+            return
+
+        log.debug("Prefetching {num} entities.".format(num=len(nodes)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(SynNode.fetch, nodes):
+                pass
+
+
+# Functions
+def strip_query_prefixes(row):
+    """Return a copy of a query result row without the ``entity.``/``file.`` style prefixes on its keys."""
+    return {key.split('.', 1)[-1]: value for key, value in row.items()}
+
+
+def iter_entity_query(syn, query, page_size=QUERY_PAGE_SIZE):
+    """Yield the rows of a Synapse entity query one page at a time with their key prefixes stripped.
+
+    Args:
+        syn (Synapse): an active synapse connection object.
+        query (str): query without ``LIMIT``/``OFFSET`` clauses.
+        page_size (int): number of rows requested per round trip.
+
+    Yields:
+        dict
+    """
+    offset = 1  # the query service counts rows from 1
+
+    while True:
+        page = syn.query('{query} LIMIT {limit} OFFSET {offset}'.format(query=query,
+                                                                        limit=page_size,
+                                                                        offset=offset))
+        results = page['results']
+
+        for row in results:
+            yield strip_query_prefixes(row)
 
+        offset += len(results)
+        if (len(results) < page_size) or (offset > page['totalNumberOfResults']):
+            return
+
+
+def iter_project_entities(syn, project_id, columns=DAG_ENTITY_COLUMNS, page_size=QUERY_PAGE_SIZE):
+    """Yield a dict of `columns` for every entity in the project `project_id`.
+
+    Only the columns needed to build a ``ProjectDAG`` are requested by default.
+    """
+    pid = project_id[3:] if project_id.startswith('syn') else project_id
+    query = 'SELECT {columns} FROM entity WHERE projectId=="{pid}"'.format(columns=", ".join(columns), pid=pid)
+
+    return iter_entity_query(syn=syn, query=query, page_size=page_size)
+
+
+def iter_child_files(syn, parent_id, columns, page_size=QUERY_PAGE_SIZE):
+    """Yield a dict of ``id`` and `columns` for every file directly under `parent_id`.
+
+    Columns may name annotations as well as entity properties, so this reads the annotations of a
+    whole folder in one query per page; an annotation a file does not have comes back as ``None``.
+    """
+    columns = ("id",) + tuple(columns)
+    query = 'SELECT {columns} FROM file WHERE parentId=="{parent_id}"'.format(columns=", ".join(columns),
+                                                                             parent_id=parent_id)
+
+    return iter_entity_query(syn=syn, query=query, page_size=page_size)
+
+
+def retry_wait(exc, delay):
+    """Return the seconds to wait before retrying a request that raised `exc`.
+
+    Rate-limited responses wait for the server's ``Retry-After`` value, or at least ``RATE_LIMIT_DELAY``;
+    anything else waits `delay`.
+    """
+    response = getattr(exc, 'response', None)
+
+    if getattr(response, 'status_code', None) not in RATE_LIMIT_STATUS_CODES:
+        return delay
+
+    try:
+        return max(delay, float(response.headers['Retry-After']))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return max(delay, RATE_LIMIT_DELAY)
+
+
+def retry_call(func, attempts, delay, description):
+    """Call `func` until it returns, at most `attempts` times, and return ``(its return value, attempts used)``.
+
+    Failed attempts wait ``retry_wait()`` before the next one, starting from `delay` seconds and
+    doubling; the error of the last attempt is raised.
+
+    Args:
+        func (callable): takes no arguments.
+        attempts (int): calls made before giving up.
+        delay (float): seconds to wait after the first failure.
+        description (str): what `func` does, for the log, e.g. ``'Storing "syn123"'``.
+    """
+    for attempt in range(1, attempts + 1):
         try:
-            is_folder_named_x_partial = partial(is_folder_named_x, name=name)
-            next_node_id = self.check_children(node_id=origin, func=is_folder_named_x_partial)[0]
-        except IndexError:
-            # If no child is found:
-            if create:
-                # create synapse folder object if we were told to
-                parent_obj = self.node[origin].obj
-                new_folder = synapse.Folder(name, parent=parent_obj)
-                new_folder = self.syn.store(new_folder)
-                new_folder_id = new_folder['id']
-
-                # add new edge to DAG and mark for update
-                self.add_edge(u=origin, v=new_folder_id, attr_dict=None)
-
-                entity_dict = {k:v  for k,v in new_folder.items()}
-                self.node[new_folder_id] = SynNode(entity_dict=entity_dict,
-                                                   synapse_session=self.syn,
-                                                   is_root=False)
-
-                # send the final result back up the chain.
-                return new_folder_id
-
-            else:
-                # raise an error otherwise
-                raise e.NoResult()
-
-        # send next_node_id along to next level
-        # or send the final result back up the chain.
-        if path:
-            return self.follow_path_to_folder(path=path, origin=next_node_id, create=create)
-        else:
-            return next_node_id
+            return func(), attempt
+
+        except Exception as exc:
+            if attempt == attempts:
+                raise
+
+            wait = retry_wait(exc=exc, delay=delay)
+            msg = """{description} failed (attempt {n}), retrying in {wait}s: {error}"""
+            log.warning(msg.format(description=description, n=attempt, wait=wait, error=exc))
+            time.sleep(wait)
+            delay *= 2
+
+
+def get_file_handles(syn, entity_handle_ids):
+    """Return ``{file handle id: file handle dict}`` for `entity_handle_ids` in one file-service request.
+
+    Args:
+        syn (Synapse): an active synapse connection object.
+        entity_handle_ids (list): ``(file entity id, file handle id)`` pairs; the entity is what
+            grants access to its handle.
+
+    Returns:
+        dict: handles the service could not return are left out.
+    """
+    body = {"requestedFiles": [{"fileHandleId": handle_id,
+                                "associateObjectId": entity_id,
+                                "associateObjectType": "FileEntity"} for entity_id, handle_id in entity_handle_ids],
+            "includeFileHandles": True,
+            "includePreSignedURLs": False}
 
+    response = syn.restPOST('/fileHandle/batch', json.dumps(body), endpoint=syn.fileHandleEndpoint)
+
+    return {result['fileHandleId']: result['fileHandle'] for result in response['requestedFiles']
+            if result.get('fileHandle') is not None}
+
+
+def handle_md5_and_size(file_handle):
+    """Return ``(md5, size)`` of a file handle dict, ``(None, None)`` if they are missing."""
+    try:
+        return file_handle['contentMd5'], int(file_handle['contentSize'])
+    except (KeyError, TypeError, ValueError):
+        return None, None
+
+
+def file_handle_md5_and_size(entity):
+    """Return ``(md5, size)`` from the file handle of a ``synapseclient.File``, ``(None, None)`` if it has none."""
+    try:
+        file_handle = getattr(entity, '_file_handle')
+    except (KeyError, AttributeError):
+        return None, None
 
+    return handle_md5_and_size(file_handle)
 
 
 
@@ -6,9 +6,11 @@ from logzero import logger as log
 
 import os
 from pathlib import Path
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from itertools import islice
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 
 from munch import Munch, munchify
@@ -22,17 +24,40 @@ __email__ = "w.gus.dunn@gmail.com"
 
 # Constants
 PARSE_FILE_NAME = Munch()
-PARSE_FILE_NAME.REGENERON1 = extract_subids.bch.subject_from_regeneron1_fname
+PARSE_FILE_NAME.REGENERON1 = extract_subids.bch.process_r1
+
+ASSET_BATCH_SIZE = 100000
+
+ASSET_DTYPES = OrderedDict([("path_hash", np.int64),
+                            ("file_name", str),
+                            ("directory", "category"),
+                            ("batch_code", "category"),
+                            ("file_type", "category"),
+                            ("assay_type", "category"),
+                            ("bytes", np.int64),
+                            ("subject_id", "category"),
+                            ])
 
 # Classes
-Row = namedtuple('Row', ["path_hash","file_name",
-                         "directory","batch_code",
-                         "file_type","assay_type",
-                         "bytes","subject_id"], verbose=False, rename=False)
+Row = namedtuple('Row', list(ASSET_DTYPES.keys()), rename=False)
 
 
 
 # Functions
+def iter_asset_paths(patterns):
+    """Yield a ``Path`` for every file matching the path glob patterns in ``patterns``.
+
+    Args:
+        patterns (``list``): path glob patterns from the config file.
+
+    Yields:
+        ``Path``
+    """
+    for i in patterns:
+        p = Path(i)
+        yield from p.parent.glob(p.name)
+
+
 def pathify_assets(FILE_TYPE):
     """Converts the list of path glob patterns in the config file to list of ``Path`` objects.
 
@@ -45,21 +70,114 @@ def pathify_assets(FILE_TYPE):
         ``None``
     """
     for key in FILE_TYPE.keys():
-        paths = []
-        for i in FILE_TYPE[key]:
-            p = Path(i)
-            paths.extend(list(p.parent.glob(p.name)))
+        FILE_TYPE[key] = list(iter_asset_paths(FILE_TYPE[key]))
+
+
+def iter_assets(asset_conf, pathify=True):
+    """Yield one typed ``Row`` per file asset described in ``asset_conf``.
+
+    Paths are globbed lazily so no batch is ever held in memory as a whole.
+    ``subject_id`` is the file stem here; see ``parse_subject_ids()``.
+
+    Args:
+        asset_conf (``dict``-like): configuration tree built from asset_intake configuration file.
+        pathify (``bool``): whether the values in ``FILE_TYPE`` are glob patterns or already ``Path`` objects.
+
+    Yields:
+        ``Row``
+    """
+    for batch_name, batch in asset_conf.BATCHES.items():
+        for ftype, paths in batch.FILE_TYPE.items():
+            if pathify:
+                paths = iter_asset_paths(paths)
+
+            for path in paths:
+                yield Row(path_hash=hash(str(path)),
+                          file_name=path.name,
+                          directory=str(path.parent),
+                          batch_code=batch_name,
+                          file_type=ftype,
+                          assay_type=batch.ASSAY_TYPE,
+                          bytes=path.stat().st_size,
+                          subject_id=path.stem,
+                          )
+
+
+def iter_record_batches(records, size):
+    """Yield lists of at most ``size`` items consumed from the iterable ``records``."""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_subject_id_parser(batch_name, batch):
+    """Return the column-wise file name parser registered in ``PARSE_FILE_NAME`` for a batch.
+
+    The batch may name its parser explicitly with a ``PARSE_FILE_NAME`` key, otherwise
+    ``batch_name`` is used to look one up.
+
+    Args:
+        batch_name (``str``): key of the batch in ``asset_conf.BATCHES``.
+        batch (``dict``-like): configuration tree for the batch.
+
+    Returns:
+        ``callable`` taking and returning a ``pd.Series`` or ``None`` if no parser is registered.
+    """
+    parser_name = batch.get("PARSE_FILE_NAME", batch_name)
+
+    if parser_name is None:
+        return None
+
+    try:
+        return PARSE_FILE_NAME[parser_name.upper()]
+    except KeyError:
+        if "PARSE_FILE_NAME" in batch:
+            msg = """Batch "{batch}" requested unknown PARSE_FILE_NAME value: "{name}".""".format(batch=batch_name,
+                                                                                              name=parser_name)
+            raise e.ValidationError(msg)
+
+        return None
+
+
+def parse_subject_ids(assets, asset_conf):
+    """Replace the ``subject_id`` column of ``assets`` using each batch's file name parser.
+
+    In place conversion. Parsers are applied to the whole ``file_name`` column of a batch at once;
+    batches without a registered parser keep the file stem as their ``subject_id``. File names a
+    parser cannot read get a missing ``subject_id``; the parser logs them.
+
+    Args:
+        assets (``pd.DataFrame``): asset table as built by ``build_asset_table()``.
+        asset_conf (``dict``-like): configuration tree built from asset_intake configuration file.
+
+    Returns:
+        ``None``
+    """
+    for batch_name, batch in asset_conf.BATCHES.items():
+        parser = get_subject_id_parser(batch_name=batch_name, batch=batch)
 
-        FILE_TYPE[key] = paths
+        if parser is None:
+            continue
 
+        in_batch = (assets.batch_code == batch_name).values
+        subject_ids = parser(assets.file_name[in_batch].astype(str))
+        assets.loc[in_batch, "subject_id"] = subject_ids.values
 
-def build_asset_table(asset_conf, pathify=True):
+
+def build_asset_table(asset_conf, pathify=True, batch_size=ASSET_BATCH_SIZE):
     """Return asset table as ``pd.DataFrame`` built from ``asset_conf`` info.
 
+    Rows from ``iter_assets()`` are consumed ``batch_size`` records at a time and converted
+    straight to typed columns, so memory is bounded by the compact table rather than by a
+    list of every row.
+
     Column Discriptions:
         - path_hash (`int`)
         - file_name (`str`)
-        - directory (`str`)
+        - directory (`Category`)
         - batch_code (`Category`)
             - Regeneron1, Merck1, Merck2, etc
         - file_type (`Category`)
@@ -67,53 +185,47 @@ def build_asset_table(asset_conf, pathify=True):
         - assay_type (`Category`)
             - WES, WGS, RNAseq, etc
         - bytes (`int`)
-        - subject_id (`str`)
+        - subject_id (`Category`)
+            - parsed by the batch's ``PARSE_FILE_NAME`` plug-in, file stem otherwise
 
     Args:
         asset_conf (``dict``-like): configuration tree built from asset_intake configuration file.
-        pathify (``bool``): whether or not to run ``pathify_assets()`` on the paths in ``asset_conf``
+        pathify (``bool``): whether the paths in ``asset_conf`` are glob patterns that still need expanding.
+        batch_size (``int``): number of records converted to columns at a time.
 
     Returns:
         ``pd.DataFrame``
     """
-    dtypes = {"path_hash": np.int64,
-              "file_name": str,
-              "directory": str,
-              "batch_code": "category",
-              "file_type": "category",
-              "assay_type": "category",
-              "bytes": np.int64,
-              "subject_id": str,
-              }
-
-    if pathify:
-        for batch in asset_conf.BATCHES.values():
-            pathify_assets(FILE_TYPE=batch.FILE_TYPE)
-
-    rows = []
-    for batch_name, batch in asset_conf.BATCHES.items():
-        for ftype, paths in batch.FILE_TYPE.items():
-            for path in paths:
+    chunks = []
+    for records in iter_record_batches(iter_assets(asset_conf=asset_conf, pathify=pathify), size=batch_size):
+        chunk = pd.DataFrame.from_records(records, columns=Row._fields)
+        parse_subject_ids(assets=chunk, asset_conf=asset_conf)
+        chunks.append(chunk.astype(dtype=ASSET_DTYPES))
+
+    return concat_asset_chunks(chunks=chunks)
+
 
-                path_hash = hash(str(path))
-                file_name = path.name
-                directory = str(path.parent)
-                batch_code = batch_name
-                file_type = ftype
-                assay_type = batch.ASSAY_TYPE
-                bytes = path.stat().st_size
-                subject_id = path.stem
-
-                rows.append(Row(path_hash=path_hash,
-                                file_name=file_name,
-                                directory=directory,
-                                batch_code=batch_code,
-                                file_type=file_type,
-                                assay_type=assay_type,
-                                bytes=bytes,
-                                subject_id=subject_id
-                                )
-                            )
-    assets = pd.DataFrame(data=rows, index=None, columns=None, dtype=None, copy=False).astype(dtype=dtypes, copy=True, raise_on_error=True)
-
-    return assets
+def concat_asset_chunks(chunks):
+    """Return a single asset table built column by column from a list of typed asset table chunks.
+
+    Categorical columns are combined with ``union_categoricals`` so that they never pass through
+    an intermediate ``object`` column.
+
+    Args:
+        chunks (``list``): ``pd.DataFrame`` objects with the columns and dtypes of ``ASSET_DTYPES``.
+
+    Returns:
+        ``pd.DataFrame``
+    """
+    if not chunks:
+        return pd.DataFrame(columns=Row._fields).astype(dtype=ASSET_DTYPES)
+
+    columns = OrderedDict()
+    for name, dtype in ASSET_DTYPES.items():
+        parts = [chunk[name] for chunk in chunks]
+        if dtype == "category":
+            columns[name] = pd.Series(union_categoricals(parts, ignore_order=True))
+        else:
+            columns[name] = pd.concat(parts, ignore_index=True)
+
+    return pd.DataFrame(columns)
@@ -10,10 +10,24 @@ import pandas as pd
 from munch import Munch
 
 
+# Constants
+FAM_LETTER_MAP = {"M": ".2",
+                  "MM": ".2",
+                  "P": ".0",
+                  "S": ".4",  # this is dangerous (there may be more than one sibling)
+                  "B": ".4",  # this is dangerous (there may be more than one sibling)
+                  "F": ".3"}
+
+SUBJECT_FIELD = r"^[^_]*_([^_]*).*$"  # second "_"-delimited field
+
+FAM_SUFFIXES = pd.CategoricalDtype(categories=list(FAM_LETTER_MAP.keys()))
+
+
+# Functions
 def process_r1(file_names):
     """Return the extracted and recoded subject_names from file_names."""
     if not isinstance(file_names, pd.Series):
-        file_names = pd.Series(data=file_names)
+        file_names = pd.Series(data=file_names, dtype=str)
 
     subject_names = extract_subject_names(file_names=file_names)
     masks = make_class_masks(subject_names=subject_names)
@@ -34,79 +48,58 @@ def recode_subject_names(subject_names, masks):
 
 def extract_subject_names(file_names):
     """Extract subject names from file_names and return subject_names."""
-    return file_names.apply(lambda name: name.split('_')[1])
+    return file_names.str.replace(SUBJECT_FIELD, r"\1", regex=True)
 
 
 def make_class_masks(subject_names):
-    """Define masks and store in self._class_masks."""
+    """Define and return the boolean masks used to decide how each subject_name is recoded."""
     masks = Munch()
 
-    masks.has_dash = subject_names.apply(test_dash_in)
-    masks.first_alpha = subject_names.apply(test_starts_letter)
-    masks.last_alpha = subject_names.apply(test_ends_letter)
+    masks.has_dash = subject_names.str.contains('-', regex=False).fillna(False).astype(bool)
+    masks.first_alpha = subject_names.str[:1].str.isalpha().fillna(False).astype(bool)
+    masks.last_alpha = subject_names.str[-1:].str.isalpha().fillna(False).astype(bool)
 
     return masks
 
 
 def recode_dashed_alphas(subject_names, masks):
-    """Recode appropriate indices of self._subject_names."""
+    """Return subject_names with dashes removed from names that start with a letter."""
     subject_names = subject_names.copy()
-    subject_names[masks.first_alpha &
-                  masks.has_dash] = subject_names[masks.first_alpha &
-                                                  masks.has_dash].apply(lambda x: x.replace('-', ''))
+    idx = masks.first_alpha & masks.has_dash
+    subject_names[idx] = subject_names[idx].str.replace('-', '', regex=False)
 
     return subject_names
 
 
 def recode_dashed_dots(subject_names, masks):
-    """Recode appropriate indices of self._subject_names."""
+    """Return subject_names with dashes converted to dots in names that start with a digit."""
     subject_names = subject_names.copy()
-    subject_names[~masks.first_alpha &
-                  masks.has_dash] = subject_names[~masks.first_alpha &
-                                                  masks.has_dash].apply(lambda x: x.replace('-', '.'))
+    idx = ~masks.first_alpha & masks.has_dash
+    subject_names[idx] = subject_names[idx].str.replace('-', '.', regex=False)
 
     return subject_names
 
 
 def recode_fam_letters(subject_names, masks):
-    """Recode appropriate indices of self._subject_names."""
-    subject_names = subject_names.copy()
-    subject_names[masks.last_alpha] = subject_names[masks.last_alpha].apply(translate_fam_letter)
-
-    return subject_names
-
+    """Return subject_names with family-member letter suffixes translated via ``FAM_LETTER_MAP``.
 
-def translate_fam_letter(string):
-    """Return string after translating the suffix correctly."""
-    letter_map = {"M": ".2",
-                  "MM": ".2",
-                  "P": ".0",
-                  "S": ".4", # this is dangerous (there may be more than one sibling)
-                  "B": ".4", # this is dangerous (there may be more than one sibling)
-                  "F": ".3"}
-    string = string.upper()
-
-    if string.endswith("MM"):
-        i = -2
-    else:
-        i = -1
-
-    string = "{prefix}{suffix}".format(prefix=string[:i],
-                                       suffix=letter_map[string[i:]])
-
-    return string
-
-
-def test_dash_in(x):
-    """Return True if x contains a dash."""
-    return '-' in x
+    Names whose suffix is not in ``FAM_LETTER_MAP`` cannot be recoded: they are all logged in one
+    warning and set to ``NaN`` so that one bad file name does not fail the rest of the batch.
+    """
+    subject_names = subject_names.copy()
+    upper = subject_names[masks.last_alpha].str.upper()
 
+    # "MM" is the only multi-letter suffix so it is checked before the single letters.
+    ends_mm = upper.str.endswith("MM")
+    prefixes = upper.str[:-1].where(~ends_mm, upper.str[:-2])
+    suffixes = upper.str[-1:].where(~ends_mm, "MM")
 
-def test_starts_letter(x):
-    """Return True if x starts with a letter."""
-    return x[0].isalpha()
+    known = suffixes.isin(FAM_SUFFIXES.categories)
+    if not known.all():
+        log.warning("Unrecognized family-member suffix in {n} subject names, left without a subject_id: {names}".format(
+            n=(~known).sum(), names=sorted(set(upper[~known]))))
 
+    recoded = prefixes[known] + suffixes[known].astype(FAM_SUFFIXES).map(FAM_LETTER_MAP).astype(str)
+    subject_names[masks.last_alpha] = recoded.reindex(upper.index)
 
-def test_ends_letter(x):
-    """Return True if x ends with a letter."""
-    return x[-1].isalpha()
+    return subject_names
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""Provide code to keep only the VCF records that overlap the regions of a GTF file."""
+
+# Imports
+from logzero import logger as log
+
+import json
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import veoibd_synapse.errors as e
+from veoibd_synapse.misc import atomic_path
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+INDEX_FILES = ("starts.npy", "ends.npy", "chroms.json")
+
+
+# Classes
+class IntervalIndex(object):
+
+    """Sorted, non-overlapping 0-based half-open intervals of every chromosome, kept in two flat arrays.
+
+    ``chroms`` maps each chromosome to the ``(first, stop)`` slice of ``starts`` and ``ends``
+    holding its intervals. Saved indexes are opened as memory maps, so every process reading
+    one shares the same pages instead of holding its own copy.
+    """
+
+    def __init__(self, starts, ends, chroms):
+        """Initialize from the flat arrays and the chromosome slices."""
+        self.starts = starts
+        self.ends = ends
+        self.chroms = chroms
+
+    @classmethod
+    def from_gtf(cls, path):
+        """Build the index of the merged regions of the GTF file at `path`.
+
+        GTF coordinates are 1-based and inclusive; they are stored 0-based and half-open, as
+        ``cyvcf2`` reports record positions.
+        """
+        per_chrom = defaultdict(list)
+        with open(str(path)) as gtf:
+            for line_number, line in enumerate(gtf, start=1):
+                if line.startswith('#') or not line.strip():
+                    continue
+
+                fields = line.split('\t', 5)
+                try:
+                    per_chrom[fields[0]].append((int(fields[3]) - 1, int(fields[4])))
+                except (IndexError, ValueError):
+                    msg = """Line {n} of "{path}" is not a GTF record.""".format(n=line_number, path=path)
+                    raise e.ValidationError(msg)
+
+        starts, ends, chroms = [], [], {}
+        for chrom, intervals in per_chrom.items():
+            first = len(starts)
+            for start, end in sorted(intervals):
+                if (len(starts) > first) and (start <= ends[-1]):
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            chroms[chrom] = (first, len(starts))
+
+        return cls(starts=np.array(starts, dtype=np.int64), ends=np.array(ends, dtype=np.int64), chroms=chroms)
+
+    @classmethod
+    def load(cls, directory):
+        """Open an index written by ``save()``, memory-mapping its arrays."""
+        directory = Path(directory)
+        starts_name, ends_name, chroms_name = INDEX_FILES
+
+        with (directory / chroms_name).open() as chroms_file:
+            chroms = {chrom: tuple(bounds) for chrom, bounds in json.load(chroms_file).items()}
+
+        return cls(starts=np.load(str(directory / starts_name), mmap_mode='r'),
+                   ends=np.load(str(directory / ends_name), mmap_mode='r'),
+                   chroms=chroms)
+
+    def save(self, directory):
+        """Write the index to `directory`, creating it if needed."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        starts_name, ends_name, chroms_name = INDEX_FILES
+
+        np.save(str(directory / starts_name), self.starts)
+        np.save(str(directory / ends_name), self.ends)
+        with (directory / chroms_name).open('w') as chroms_file:
+            json.dump(self.chroms, chroms_file)
+
+    def overlaps(self, chrom, start, end):
+        """Return True if the 0-based half-open region `start`-`end` of `chrom` overlaps any interval."""
+        bounds = self.chroms.get(chrom)
+        if bounds is None:
+            return False
+
+        first, stop = bounds
+        # the last interval starting before `end` is the only one that can reach past `start`
+        i = first + int(np.searchsorted(self.starts[first:stop], end, side='left')) - 1
+
+        return (i >= first) and (self.ends[i] > start)
+
+    def __len__(self):
+        """Return the number of merged intervals."""
+        return len(self.starts)
+
+
+# Functions
+def filter_vcf(vcf_path, out_path, index_dir):
+    """Write the records of `vcf_path` that overlap the index in `index_dir` to bgzipped `out_path`.
+
+    The header is copied unchanged.
+
+    Returns:
+        tuple: ``(out_path, n_kept, n_read)``
+    """
+    import cyvcf2
+
+    index = IntervalIndex.load(directory=index_dir)
+    out_path = Path(out_path)
+
+    n_read = n_kept = 0
+    with atomic_path(out_path) as tmp_path:
+        reader = cyvcf2.VCF(str(vcf_path))
+        writer = cyvcf2.Writer(str(tmp_path), reader, mode='wz')
+        try:
+            for variant in reader:
+                n_read += 1
+                if index.overlaps(chrom=variant.CHROM, start=variant.start, end=variant.end):
+                    writer.write_record(variant)
+                    n_kept += 1
+        finally:
+            writer.close()
+            reader.close()
+
+    return str(out_path), n_kept, n_read
+
+
+def filter_vcfs_by_gtf(gtf_path, vcf_paths, out_paths, processes=4):
+    """Keep the records of each VCF in `vcf_paths` overlapping the regions of `gtf_path`, as bgzipped VCFs.
+
+    The GTF is read and merged once into an ``IntervalIndex`` saved beside the outputs; each of
+    the `processes` workers memory-maps it and streams one VCF at a time with ``cyvcf2``.
+
+    Args:
+        gtf_path (Path): GTF of the regions to keep.
+        vcf_paths (list): input VCFs, plain or compressed.
+        out_paths (list): one output path per input VCF.
+        processes (int): VCFs filtered at once.
+
+    Returns:
+        list: ``(out_path, n_kept, n_read)`` per VCF, in the order of `vcf_paths`.
+    """
+    vcf_paths = [str(p) for p in vcf_paths]
+    out_paths = [str(p) for p in out_paths]
+    if len(vcf_paths) != len(out_paths):
+        raise e.ValidationError("Expected one output path per VCF, got {o} for {v}.".format(o=len(out_paths),
+                                                                                             v=len(vcf_paths)))
+    if not vcf_paths:
+        return []
+
+    index = IntervalIndex.from_gtf(path=gtf_path)
+    log.info("""Keeping records in {n} regions of "{gtf}".""".format(n=len(index), gtf=gtf_path))
+
+    for out_path in out_paths:
+        Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix="gtf_index_", dir=str(Path(out_paths[0]).parent)) as index_dir:
+        index.save(directory=index_dir)
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(filter_vcf, vcf_paths, out_paths, [index_dir] * len(vcf_paths)))
+
+    for out_path, n_kept, n_read in results:
+        log.info("""Kept {kept} of {read} records in "{out}".""".format(kept=n_kept, read=n_read, out=out_path))
+
+    return results
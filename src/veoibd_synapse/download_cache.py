@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Provide a size-capped download cache of Synapse files shared between callers and processes."""
+
+# Imports
+from logzero import logger as log
+
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from veoibd_synapse.dag_tools import file_handle_md5_and_size
+from veoibd_synapse.misc import atomic_path
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+DEFAULT_MAX_BYTES = 50 * 10**9
+INDEX_NAME = "index.json"
+LOCK_NAME = ".lock"
+OBJECTS_DIR_NAME = "objects"  # one sub-directory per cached file version
+TMP_DIR_NAME = "tmp"  # downloads in progress; same file system as OBJECTS_DIR_NAME so moves are atomic
+LEASES_DIR_NAME = "leases"  # one sub-directory per live lease holding an empty file per pinned key
+
+
+# Classes
+class DownloadCache(object):
+
+    """Keep downloaded Synapse files on disk keyed by entity id, version and md5.
+
+    The index of cached files lives next to them and is only changed while holding an exclusive
+    ``flock`` on the cache's lock file, so several processes can share one cache. Files are
+    downloaded into a private temporary directory and moved into place in one rename, so a reader
+    never sees a partial file. When the cached files exceed `max_bytes` the least recently used
+    are removed, by the mtime of their directory, which every hit touches.
+
+    A path is only safe from eviction while it is pinned by a ``Lease``; callers that read a file
+    some time after getting it should get it through ``lease()``.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """Open (creating if needed) the cache in `directory`.
+
+        Args:
+            directory (str): where cached files and the index are kept.
+            max_bytes (int): total size of cached files above which the least recently used are removed.
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.objects_dir = self.directory / OBJECTS_DIR_NAME
+        self.tmp_dir = self.directory / TMP_DIR_NAME
+        self.index_path = self.directory / INDEX_NAME
+        self.lock_path = self.directory / LOCK_NAME
+        self.leases_dir = self.directory / LEASES_DIR_NAME
+        self._thread_lock = threading.RLock()
+
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.leases_dir.mkdir(parents=True, exist_ok=True)
+
+    def lookup(self, entity_id, version, md5, lease=None):
+        """Return the cached path of this file version or ``None``; never touches the network.
+
+        A hit is pinned by `lease`, if given, and marked as used without rewriting the index.
+        """
+        key = cache_key(entity_id=entity_id, version=version, md5=md5)
+
+        with self.locked(shared=True):
+            entry = self._load_index().get(key)
+            if (entry is None) or not (self.directory / entry['path']).exists():
+                return None
+
+            if lease is not None:
+                lease.pin(key)
+            os.utime(str(self.objects_dir / key))
+
+        return self.directory / entry['path']
+
+    def get(self, syn, file_entity, lease=None):
+        """Return a local path to the file of `file_entity`, downloading it into the cache on a miss.
+
+        Args:
+            syn (Synapse): an active synapse connection object, only used on a miss.
+            file_entity (File): the entity's metadata, e.g. from ``syn.get(id, downloadFile=False)``.
+            lease (Lease): pins the file until it is released; see ``lease()``.
+
+        Returns:
+            Path
+        """
+        entity_id = file_entity.id
+        version = file_entity.versionNumber
+        md5, _ = file_handle_md5_and_size(file_entity)
+
+        path = self.lookup(entity_id=entity_id, version=version, md5=md5, lease=lease)
+        if path is not None:
+            return path
+
+        return self._download(syn=syn, entity_id=entity_id, version=version, md5=md5, lease=lease)
+
+    def lease(self):
+        """Return a new ``Lease`` on this cache."""
+        return Lease(cache=self)
+
+    @contextmanager
+    def locked(self, shared=False):
+        """Hold the cache's thread lock and a lock on its lock file, exclusive unless `shared`."""
+        with self._thread_lock, self.lock_path.open('a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _download(self, syn, entity_id, version, md5, lease=None):
+        """Download a file version into the cache, evict if over the cap and return its cached path."""
+        key = cache_key(entity_id=entity_id, version=version, md5=md5)
+        tmp = Path(tempfile.mkdtemp(prefix=key + '.', dir=str(self.tmp_dir)))
+
+        try:
+            log.debug('Downloading {id} version {v} into the download cache.'.format(id=entity_id, v=version))
+            downloaded = Path(syn.get(entity_id, version=version, downloadLocation=str(tmp),
+                                      ifcollision='overwrite.local').path)
+            size = downloaded.stat().st_size
+
+            with self.locked():
+                index = self._load_index()
+                entry = index.get(key)
+
+                if (entry is not None) and (self.directory / entry['path']).exists():
+                    # another caller stored the same version while we were downloading
+                    path = self.directory / entry['path']
+                else:
+                    target = self.objects_dir / key
+                    if target.exists():
+                        shutil.rmtree(str(target))
+                    os.rename(str(tmp), str(target))
+
+                    path = target / downloaded.relative_to(tmp)
+                    entry = {'path': str(path.relative_to(self.directory)), 'size': size}
+                    index[key] = entry
+
+                if lease is not None:
+                    lease.pin(key)
+                os.utime(str(self.objects_dir / key))
+                self._evict(index=index, keep=key)
+                self._save_index(index)
+        finally:
+            if tmp.exists():
+                shutil.rmtree(str(tmp), ignore_errors=True)
+
+        return path
+
+    def _evict(self, index, keep):
+        """Remove least recently used files from `index` and disk until the cache fits ``max_bytes``.
+
+        `keep` and every key pinned by a live lease are skipped; call while holding ``locked()``.
+        """
+        total = sum(entry['size'] for entry in index.values())
+        pinned = self._pinned_keys() | {keep}
+
+        for key in sorted(index, key=self._last_used):
+            if total <= self.max_bytes:
+                break
+            if key in pinned:
+                continue
+
+            log.debug('Evicting {key} from the download cache.'.format(key=key))
+            shutil.rmtree(str(self.objects_dir / key), ignore_errors=True)
+            total -= index.pop(key)['size']
+
+    def _last_used(self, key):
+        """Return when `key` was last handed out, as the mtime of its directory."""
+        try:
+            return (self.objects_dir / key).stat().st_mtime
+        except OSError:
+            return 0.0
+
+    def _pinned_keys(self):
+        """Return the keys pinned by any lease, removing the leases of processes that are gone."""
+        pinned = set()
+        for lease_dir in self.leases_dir.iterdir():
+            if not pid_is_running(int(lease_dir.name.split('.')[0])):
+                shutil.rmtree(str(lease_dir), ignore_errors=True)
+                continue
+
+            try:
+                pinned.update(pin.name for pin in lease_dir.iterdir())
+            except OSError:
+                pass  # released while we looked
+
+        return pinned
+
+    def _load_index(self):
+        """Return the index; call while holding ``locked()``."""
+        if not self.index_path.exists():
+            return {}
+
+        with self.index_path.open() as index_file:
+            return json.load(index_file)
+
+    def _save_index(self, index):
+        """Write the index; call while holding ``locked()``."""
+        with atomic_path(self.index_path) as tmp_path, tmp_path.open('w') as index_file:
+            json.dump(index, index_file, indent=2, sort_keys=True)
+
+
+class Lease(object):
+
+    """Pin the cached files handed out through it so that no process evicts them until it is released.
+
+    ``get()`` has the signature of ``DownloadCache.get()``, so a lease can be passed wherever a
+    cache is expected. Use it as a context manager, or call ``release()``. The lease of a process
+    that died without releasing it is removed at the next eviction.
+    """
+
+    def __init__(self, cache):
+        """Open a lease on `cache`."""
+        self.cache = cache
+        self.directory = Path(tempfile.mkdtemp(prefix='{pid}.'.format(pid=os.getpid()), dir=str(cache.leases_dir)))
+
+    def get(self, syn, file_entity):
+        """Return ``self.cache.get()`` of `file_entity`, pinned until the lease is released."""
+        return self.cache.get(syn=syn, file_entity=file_entity, lease=self)
+
+    def pin(self, key):
+        """Keep `key` from being evicted; call while holding ``self.cache.locked()``."""
+        (self.directory / key).touch()
+
+    def release(self):
+        """Unpin every key of this lease."""
+        shutil.rmtree(str(self.directory), ignore_errors=True)
+
+    def __enter__(self):
+        """Return the lease."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Release the lease."""
+        self.release()
+
+
+# Functions
+def pid_is_running(pid):
+    """Return True if a process with `pid` exists on this machine."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def cache_key(entity_id, version, md5):
+    """Return the key, and directory name, of one version of a file entity."""
+    return "{id}.{version}.{md5}".format(id=entity_id, version=version, md5=md5)
+
+
+def cache_from_config(main_confs):
+    """Return the ``DownloadCache`` configured in the site config.
+
+    ``SITE.LOCAL_PATHS.DOWNLOAD_CACHE_DIR`` defaults to ``download_cache`` inside
+    ``SUBJECT_DATABASE_DIR`` and ``SITE.DOWNLOAD_CACHE_MAX_GB`` to ``DEFAULT_MAX_BYTES``.
+    """
+    local_paths = main_confs.SITE.LOCAL_PATHS
+    directory = local_paths.get('DOWNLOAD_CACHE_DIR') or Path(local_paths.SUBJECT_DATABASE_DIR) / "download_cache"
+
+    max_gb = main_confs.SITE.get('DOWNLOAD_CACHE_MAX_GB')
+    max_bytes = DEFAULT_MAX_BYTES if max_gb is None else int(float(max_gb) * 10**9)
+
+    return DownloadCache(directory=directory, max_bytes=max_bytes)
@@ -36,3 +36,11 @@ class NoResult(VEOIBDSynapseError):
 class ValidationError(VEOIBDSynapseError):
 
     """Raise when a validation/sanity check comes back with unexpected value."""
+
+class UploadError(VEOIBDSynapseError):
+
+    """Raise when one or more files could not be uploaded to Synapse."""
+
+class SyncError(VEOIBDSynapseError):
+
+    """Raise when one or more projects could not be synced from Synapse."""
@@ -12,6 +12,7 @@ from munch import Munch, munchify, unmunchify
 
 
 import veoibd_synapse.errors as e
+from veoibd_synapse.dag_tools import SynNode, iter_project_entities
 
 # Metadata
 __author__ = "Gus Dunn"
@@ -63,32 +64,25 @@ class VEOProject(object):
             else:
                 return munchify(annotations)
 
-    def _get_remote_entity_dicts(self):
-        """Query Synapse for all entity information related to this Project ID."""
-        pid = self.project['id'][3:]
-        q = 'SELECT * FROM entity WHERE projectId=="{pid}"'.format(pid=pid)
-
-        self.remote.entity_dicts = self.syn.query(q)['results']
+    def _iter_remote_entity_dicts(self):
+        """Yield entity information related to this Project ID, one query page at a time."""
+        return iter_project_entities(syn=self.syn, project_id=self.project['id'])
 
     def _build_remote_entity_dag(self):
         """Build a DAG of the remote project structure."""
-        self._get_remote_entity_dicts()
-
         dag = nx.DiGraph()
         dag.node = munchify(dag.node)
 
+        # assign nodes rather than add_node() them: networkx would merge a SynNode into the plain
+        # dict it creates for a parent that was first seen as an edge end.
+        for entity_dict in self._iter_remote_entity_dicts():
+            node = SynNode(entity_dict=entity_dict, synapse_session=self.syn)
+            dag.add_edge(u=node.parentId, v=node.id)
+            dag.node[node.id] = node
 
-        nodes = {ent['entity.id']: SynNode(entity_dict=ent, synapse_session=self.syn) for ent in self.remote.entity_dicts}
-        for node in nodes.values():
-            try:
-                dag.add_node(n=node.id, attr_dict=node)
-                dag.add_edge(u=nodes[node['parentId']].id, v=node.id)
-            except KeyError as exc:
-                if exc.args[0] == self._parent_id:
-                    parent = SynNode(entity_dict={'entity.id': self._parent_id}, is_root=True)
-                    dag.add_node(n=node.id, attr_dict=node)
-                    dag.add_node(n=parent.id, attr_dict=parent)
-                    dag.add_edge(u=parent.id, v=node.id)
+        parent = SynNode(entity_dict={'id': self._parent_id}, is_root=True)
+        dag.add_node(n=parent.id)
+        dag.node[parent.id] = parent
 
         # for n in dag.node.keys():
         #     dag.node[n] = Munch(dag.node[n])
@@ -5,33 +5,101 @@
 from logzero import logger as log
 
 import textwrap
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 
 from pathlib import Path
 import hashlib
-import gzip
-
-import pandas as pd
-import numpy as np
+import os
+import pickle
 
 from munch import Munch, munchify, unmunchify
-import ruamel.yaml as yaml
 
 # Metadata
 __author__ = "Gus Dunn"
 __email__ = "w.gus.dunn@gmail.com"
 
+# Constants
+GZIP_MAGIC = b"\x1f\x8b"  # also the start of bgzip files, which are gzip members with a "BC" extra field
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CONFIG_CACHE_PATH = Path.home() / ".cache" / "veoibd_synapse" / "config_tree.pickle"
+HASH_ALGORITHMS = ("md5", "sha256")
+HASH_BUFFER_SIZE = 8 * 2**20  # bytes read per call; hashlib releases the GIL while digesting them
+HASH_WORKERS = 4
+
 
 # Functions
-def load_csv(csv, **kwargs):
-    csv = str(csv)
+@contextmanager
+def atomic_path(path):
+    """Yield a temporary path beside `path` and move it onto `path` in one rename once the block succeeds.
+
+    The temporary name is unique to the process and thread, so concurrent writers never share it,
+    and readers see either the previous file or the complete new one. If the block raises, the
+    temporary file is removed and `path` is left untouched.
+
+    Example::
+
+        with atomic_path(path) as tmp_path, tmp_path.open('w') as out:
+            json.dump(content, out)
+    """
+    path = Path(path)
+    tmp_path = path.with_name('{name}.{pid}.{thread}.tmp'.format(name=path.name,
+                                                                 pid=os.getpid(),
+                                                                 thread=threading.get_ident()))
     try:
-        return pd.read_csv(gzip.open(csv), **kwargs)
+        yield tmp_path
+        tmp_path.replace(path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
 
-    except (pd.io.common.CParserError, OSError):
-        return pd.read_csv(csv, **kwargs)
+def sniff_compression(path):
+    """Return the ``pandas`` compression of the file at `path` from its first bytes: ``'gzip'``, ``'zstd'`` or ``None``.
 
-    except pd.io.common.EmptyDataError:
+    bgzip files are reported as ``'gzip'``; the gzip decompressor reads their concatenated members.
+    """
+    with open(str(path), 'rb') as handle:
+        magic = handle.read(len(ZSTD_MAGIC))
+
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def load_csv(csv, engine=None, chunksize=None, **kwargs):
+    """Read a plain, gzip, bgzip or zstd compressed CSV file into a ``DataFrame``.
+
+    The compression is sniffed from the file's first bytes, whatever its extension, before
+    ``pandas`` opens the file again to parse it.
+
+    Args:
+        csv (str): path to the file.
+        engine (str): ``pandas`` parser; ``'pyarrow'`` parses on several threads but supports
+            fewer options, ``None`` uses the ``pandas`` default.
+        chunksize (int): return an iterator of ``DataFrame`` objects of this many rows instead of
+            one ``DataFrame``. Not supported by the ``'pyarrow'`` engine.
+        **kwargs: passed on to ``pandas.read_csv``.
+
+    Returns:
+        pandas.DataFrame or pandas.io.parsers.TextFileReader
+    """
+    import pandas as pd
+
+    csv = str(csv)
+    if engine is not None:
+        kwargs['engine'] = engine
+    if chunksize is not None:
+        kwargs['chunksize'] = chunksize
+
+    try:
+        return pd.read_csv(csv, compression=sniff_compression(csv), **kwargs)
+
+    except pd.errors.EmptyDataError:
         msg = "File was empty: {f}.".format(f="/".join(Path(csv).parts[-2:]))
         log.error(msg)
         raise
@@ -54,8 +122,66 @@ def update_configs(directory, to_update=None):
     return to_update
 
 
+def config_sources(directories, files=()):
+    """Return ``(path, mtime_ns, size)`` of each of `files` and each ``*.yaml`` file in `directories`, in load order."""
+    paths = [Path(f) for f in files]
+    for directory in directories:
+        paths.extend(sorted(Path(directory).glob('*.yaml')))
+
+    sources = []
+    for path in paths:
+        stat = path.stat()
+        sources.append((str(path.resolve()), stat.st_mtime_ns, stat.st_size))
+
+    return tuple(sources)
+
+
+def load_config_tree(directories, defaults=None, cache_path=CONFIG_CACHE_PATH):
+    """Return the config tree of `defaults` updated with every ``*.yaml`` file in `directories`, in order.
+
+    The merged tree is pickled to `cache_path` keyed by the path, mtime and size of every
+    contributing file, and loaded from there while none of them is added, removed or changed.
+    A missing, stale or unreadable snapshot is rebuilt from the YAML files.
+
+    Args:
+        directories (list): config directories passed to ``update_configs()``, later ones winning.
+        defaults (dict): ``{name: path}`` of single config files loaded first.
+        cache_path (Path): where the snapshot is kept; ``None`` disables it.
+
+    Returns:
+        Munch
+    """
+    defaults = {} if defaults is None else defaults
+    key = (tuple(defaults), config_sources(directories=directories, files=defaults.values()))
+
+    if (cache_path is not None) and cache_path.exists():
+        try:
+            with cache_path.open('rb') as cache_file:
+                cached_key, tree = pickle.load(cache_file)
+            if cached_key == key:
+                return tree
+        except Exception as exc:
+            log.debug('Ignoring unreadable config cache "{path}": {exc}'.format(path=cache_path, exc=exc))
+
+    tree = Munch({name: process_config(config=path) for name, path in defaults.items()})
+    for directory in directories:
+        tree = update_configs(directory=directory, to_update=tree)
+
+    if cache_path is not None:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_path(cache_path) as tmp_path, tmp_path.open('wb') as cache_file:
+                pickle.dump((key, tree), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as exc:
+            log.debug('Could not write config cache "{path}": {exc}'.format(path=cache_path, exc=exc))
+
+    return tree
+
+
 def process_config(config=None):
     """Prepare single config file."""
+    import ruamel.yaml as yaml
+
     if config is None:
         return Munch()
     else:
@@ -66,17 +192,69 @@ def process_config(config=None):
 
 def chunk_md5(path, size=1024000):
     """Calculate and return the md5-hexdigest of a file in chunks of `size`."""
-    p = Path(path)
-    md5 = hashlib.md5()
+    return file_digests(path=path, algorithms=("md5",), buffer_size=size)["md5"]
+
+
+def file_digests(path, algorithms=HASH_ALGORITHMS, buffer_size=HASH_BUFFER_SIZE):
+    """Return an ``OrderedDict`` of ``{algorithm: hexdigest}`` of the file at `path`, reading it once.
+
+    Each block is read into one reused buffer and fed to every digest in turn.
+
+    Args:
+        path (str): the file to hash.
+        algorithms (tuple): names accepted by ``hashlib.new``.
+        buffer_size (int): bytes read per call.
+    """
+    hashers = [hashlib.new(algorithm) for algorithm in algorithms]
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
 
-    with p.open('rb') as f:
+    with open(str(path), 'rb', buffering=0) as f:
         while 1:
-            data = f.read(size)
-            if not data:
+            n_read = f.readinto(buffer)
+            if not n_read:
                 break
-            md5.update(data)
+            for hasher in hashers:
+                hasher.update(view[:n_read])
 
-    return md5.hexdigest()
+    return OrderedDict((algorithm, hasher.hexdigest()) for algorithm, hasher in zip(algorithms, hashers))
+
+
+def hash_files(paths, algorithms=HASH_ALGORITHMS, workers=HASH_WORKERS, buffer_size=HASH_BUFFER_SIZE):
+    """Hash many files concurrently, yielding ``(path, digests)`` as each one finishes.
+
+    ``digests`` is the result of ``file_digests()``. At most ``2 * workers`` files are queued at
+    once, so `paths` may be a long or lazy iterable and the first results arrive before it is
+    exhausted. Results come in completion order, not the order of `paths`. An unreadable file
+    raises its ``OSError`` from the iteration.
+
+    Args:
+        paths (iterable): the files to hash.
+        algorithms (tuple): names accepted by ``hashlib.new``.
+        workers (int): files hashed at once.
+        buffer_size (int): bytes read per call and per worker.
+
+    Yields:
+        tuple: ``(path, digests)``
+    """
+    paths = iter(paths)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        while 1:
+            for path in paths:
+                future = executor.submit(file_digests, path=path, algorithms=algorithms, buffer_size=buffer_size)
+                pending[future] = path
+                if len(pending) >= 2 * workers:
+                    break
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
 
 
 def nan_to_str(x, replacement=None):
@@ -86,6 +264,8 @@ def nan_to_str(x, replacement=None):
         x (unknown): object to inspect
         replacement (None|str): string to use as replacement (default: "")
     """
+    import pandas as pd
+
     if replacement is None:
         replacement = ""
     if pd.isnull(x):
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Provide a streaming multipart upload of local files to Synapse's file service."""
+
+# Imports
+from logzero import logger as log
+
+import hashlib
+import json
+import math
+import mimetypes
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import veoibd_synapse.errors as e
+from veoibd_synapse.dag_tools import retry_call
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB  # smallest part the file service accepts
+DEFAULT_PART_SIZE = 16 * MB
+MAX_PARTS = 10000
+PART_UPLOAD_WORKERS = 4
+MAX_IN_FLIGHT_PARTS = 6  # bounds memory to MAX_IN_FLIGHT_PARTS * part_size
+MAX_PART_ATTEMPTS = 5
+PART_RETRY_DELAY = 2  # seconds; doubled after each failed attempt
+
+
+# Functions
+def get_storage_location_id(syn, parent_id):
+    """Return the storage location that files uploaded under `parent_id` should use."""
+    destination = syn.restGET('/entity/{id}/uploadDestination'.format(id=parent_id), endpoint=syn.fileHandleEndpoint)
+    return destination['storageLocationId']
+
+
+def upload_file_handle(syn, path, md5, storage_location_id, part_size=DEFAULT_PART_SIZE,
+                       max_workers=PART_UPLOAD_WORKERS, max_in_flight=MAX_IN_FLIGHT_PARTS):
+    """Upload `path` through the multipart API and return the id of the new file handle.
+
+    The file service needs the whole-file md5 before the first part is sent, so `md5` must be
+    computed by the caller. The file is then read exactly once more: each part is hashed as it is
+    read and handed to a pool of `max_workers` uploaders, with at most `max_in_flight` parts held
+    in memory. Parts that an earlier, interrupted upload of the same file already sent are skipped.
+
+    Args:
+        syn (Synapse): an active synapse connection object.
+        path (Path): local file to upload.
+        md5 (str): md5-hexdigest of the whole file.
+        storage_location_id (int): destination storage, see ``get_storage_location_id()``.
+        part_size (int): requested bytes per part; raised if needed to respect the service's limits.
+        max_workers (int): number of parts uploaded at once.
+        max_in_flight (int): number of parts read but not yet uploaded.
+
+    Returns:
+        str
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    part_size = max(part_size, MIN_PART_SIZE, int(math.ceil(size / float(MAX_PARTS))))
+
+    request = {"contentMD5Hex": md5,
+               "fileName": path.name,
+               "contentType": mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+               "partSizeBytes": part_size,
+               "fileSizeBytes": size,
+               "generatePreview": False,
+               "storageLocationId": storage_location_id,
+               }
+    status = syn.restPOST('/file/multipart', json.dumps(request), endpoint=syn.fileHandleEndpoint)
+
+    if status['state'] != 'COMPLETED':
+        send_parts(syn=syn,
+                   upload_id=status['uploadId'],
+                   path=path,
+                   part_size=part_size,
+                   parts_state=status.get('partsState', ''),
+                   max_workers=max_workers,
+                   max_in_flight=max_in_flight)
+
+        status = syn.restPUT('/file/multipart/{id}/complete'.format(id=status['uploadId']),
+                             endpoint=syn.fileHandleEndpoint)
+
+    return status['resultFileHandleId']
+
+
+def send_parts(syn, upload_id, path, part_size, parts_state, max_workers, max_in_flight):
+    """Read `path` sequentially and upload every part not marked done in `parts_state`.
+
+    Once a part has failed all its attempts no more parts are read, the queued ones are cancelled
+    and its error is raised after the parts already being sent finish.
+    """
+    n_parts = max(1, int(math.ceil(path.stat().st_size / float(part_size))))
+    slots = threading.BoundedSemaphore(max_in_flight)
+    failed = threading.Event()
+    futures = []
+
+    def part_done(future):
+        # flag the failure before freeing the slot so the reader never starts another part after it
+        if (not future.cancelled()) and (future.exception() is not None):
+            failed.set()
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, path.open('rb') as f:
+        for part_number in range(1, n_parts + 1):
+            if parts_state[part_number - 1:part_number] == '1':
+                f.seek(part_size, 1)
+                continue
+
+            slots.acquire()
+            if failed.is_set():
+                slots.release()
+                break
+
+            data = f.read(part_size)
+            future = executor.submit(send_part, syn, upload_id, part_number, data)
+            future.add_done_callback(part_done)
+            futures.append(future)
+
+        if failed.is_set():
+            for future in futures:
+                future.cancel()
+
+    # raise the first error, if any
+    for future in futures:
+        if (not future.cancelled()) and (future.exception() is not None):
+            raise future.exception()
+
+    log.debug("""Sent {num} of {total} parts of "{name}".""".format(num=len(futures), total=n_parts, name=path.name))
+
+
+def send_part(syn, upload_id, part_number, data):
+    """Upload one part to a presigned URL and register it with the upload, retrying failures."""
+    part_md5 = hashlib.md5(data).hexdigest()
+
+    def attempt():
+        batch = syn.restPOST('/file/multipart/{id}/presigned/url/batch'.format(id=upload_id),
+                             json.dumps({"uploadId": upload_id, "partNumbers": [part_number]}),
+                             endpoint=syn.fileHandleEndpoint)
+        presigned = batch['partPresignedUrls'][0]
+
+        response = requests.put(presigned['uploadPresignedUrl'],
+                                data=data,
+                                headers=presigned.get('signedHeaders') or {})
+        response.raise_for_status()
+
+        added = syn.restPUT('/file/multipart/{id}/add/{n}?partMD5Hex={md5}'.format(id=upload_id,
+                                                                                   n=part_number,
+                                                                                   md5=part_md5),
+                            endpoint=syn.fileHandleEndpoint)
+        if added['addPartState'] != 'ADD_SUCCESS':
+            raise e.UploadError(added.get('errorMessage', 'Part {n} was not added.'.format(n=part_number)))
+
+    retry_call(func=attempt, attempts=MAX_PART_ATTEMPTS, delay=PART_RETRY_DELAY,
+               description="Part {n}".format(n=part_number))
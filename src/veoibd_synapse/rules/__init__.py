@@ -8,9 +8,14 @@ from snaketools.snaketools import SnakeRun
 from snaketools.snaketools import SnakeRule
 from snaketools.snaketools import recode_graph
 
+from veoibd_synapse.rules.result_cache import ResultCache
+from veoibd_synapse.rules.result_cache import tool_version
+from veoibd_synapse.rules.result_cache import DEFAULT_STORE_DIR as DEFAULT_RESULT_CACHE_DIR
+
 # Metadata
 __author__ = "Gus Dunn"
 __email__ = "w.gus.dunn@gmail.com"
 
 
-__all__ = ["apply_template", "pathify_by_key_ends", "SnakeRun", "SnakeRule", "recode_graph"]
+__all__ = ["apply_template", "pathify_by_key_ends", "SnakeRun", "SnakeRule", "recode_graph", "ResultCache", "tool_version",
+           "DEFAULT_RESULT_CACHE_DIR"]
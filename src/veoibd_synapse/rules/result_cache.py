@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Provide a content-addressed cache of Snakemake rule outputs.
+
+A rule opts in by wrapping the body of its ``run:`` block::
+
+    with RESULT_CACHE.cached(name="SNPEFF", inputs=input, outputs=output,
+                             params=params, tool_version=tool_version("snpEff -version")) as hit:
+        if not hit:
+            shell("snpEff ...")
+"""
+
+# Imports
+from logzero import logger as log
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from veoibd_synapse.misc import atomic_path, file_digests, CONFIG_CACHE_PATH
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+DEFAULT_STORE_DIR = CONFIG_CACHE_PATH.parent / "result_cache"  # shared by every run and output directory of the user
+RESULTS_DIR_NAME = "results"  # one sub-directory of outputs per key
+DIGESTS_DIR_NAME = "digests"  # remembered sha256 of input files, by path, mtime and size
+MANIFEST_NAME = "manifest.json"
+
+_tool_versions = {}
+
+
+# Classes
+class ResultCache(object):
+
+    """Keep rule outputs in a shared store keyed by the content of their inputs, the params and the tool version.
+
+    A hit restores the stored outputs by hard link, or by copy across file systems, so re-running
+    a rule over unchanged inputs costs no more than hashing them. Input digests are remembered
+    by path, mtime and size, so an unchanged input is only read the first time. Results are
+    written to a private directory and renamed into place, so concurrent jobs never see a
+    partial result.
+
+    Restored outputs share their inode with the store, so rules must replace outputs rather
+    than edit them in place.
+    """
+
+    def __init__(self, store_dir=DEFAULT_STORE_DIR):
+        """Open (creating if needed) the store in `store_dir`."""
+        self.store_dir = Path(store_dir)
+        self.results_dir = self.store_dir / RESULTS_DIR_NAME
+        self.digests_dir = self.store_dir / DIGESTS_DIR_NAME
+
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.digests_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def cached(self, name, inputs, outputs, params=None, tool_version=None):
+        """Restore `outputs` and yield True on a hit; otherwise yield False and store `outputs` once the block succeeds.
+
+        Args:
+            name (str): the rule's name.
+            inputs (list): input file paths, e.g. a rule's ``input``.
+            outputs (list): output file paths, e.g. a rule's ``output``.
+            params (dict-like): values that change the outputs, e.g. a rule's ``params``.
+            tool_version (str): version of the tool the rule runs, see ``tool_version()``.
+        """
+        outputs = [str(p) for p in outputs]
+        key = self.key(name=name, inputs=inputs, params=params, tool_version=tool_version)
+
+        if self.restore(key=key, outputs=outputs):
+            log.info("""Restored {n} output(s) of {name} from the result cache.""".format(n=len(outputs), name=name))
+            yield True
+            return
+
+        yield False
+        self.store(key=key, outputs=outputs)
+
+    def key(self, name, inputs, params=None, tool_version=None):
+        """Return the sha256 hex key of a rule run from its name, input contents, params and tool version."""
+        params = {} if params is None else dict(params.items())
+        content = {'name': name,
+                   'inputs': [self.digest(path) for path in inputs],
+                   'params': params,
+                   'tool_version': tool_version}
+
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def digest(self, path):
+        """Return the sha256 of the file at `path`, reading it only if it changed since it was last hashed."""
+        path = Path(path).resolve()
+        stat = path.stat()
+        record_path = self.digests_dir / (hashlib.sha1(str(path).encode()).hexdigest() + ".json")
+
+        if record_path.exists():
+            try:
+                with record_path.open() as record_file:
+                    record = json.load(record_file)
+                if (record['mtime_ns'], record['size']) == (stat.st_mtime_ns, stat.st_size):
+                    return record['sha256']
+            except (ValueError, KeyError):
+                pass
+
+        sha256 = file_digests(path=path, algorithms=("sha256",))["sha256"]
+        with atomic_path(record_path) as tmp_path, tmp_path.open('w') as record_file:
+            json.dump({'path': str(path),
+                       'mtime_ns': stat.st_mtime_ns,
+                       'size': stat.st_size,
+                       'sha256': sha256}, record_file)
+
+        return sha256
+
+    def restore(self, key, outputs):
+        """Link or copy the stored outputs of `key` to `outputs`; return False if `key` is not stored."""
+        result_dir = self.results_dir / key
+        if not (result_dir / MANIFEST_NAME).exists():
+            return False
+
+        with (result_dir / MANIFEST_NAME).open() as manifest_file:
+            if json.load(manifest_file)['n_outputs'] != len(outputs):
+                return False
+
+        for position, out_path in enumerate(outputs):
+            out_path = Path(out_path)
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            if out_path.exists():
+                out_path.unlink()
+
+            link_or_copy(src=result_dir / str(position), dst=out_path)
+            os.utime(str(out_path))  # newer than the inputs, as Snakemake expects
+
+        return True
+
+    def store(self, key, outputs):
+        """Add `outputs` to the store under `key`, unless another job already did."""
+        result_dir = self.results_dir / key
+        if result_dir.exists():
+            return
+
+        tmp_dir = Path(tempfile.mkdtemp(prefix=key + '.', dir=str(self.results_dir)))
+        try:
+            for position, out_path in enumerate(outputs):
+                link_or_copy(src=out_path, dst=tmp_dir / str(position))
+
+            with (tmp_dir / MANIFEST_NAME).open('w') as manifest_file:
+                json.dump({'n_outputs': len(outputs), 'outputs': [str(p) for p in outputs]}, manifest_file)
+
+            os.rename(str(tmp_dir), str(result_dir))
+        except OSError as exc:
+            if not result_dir.exists():
+                log.warning("""Could not store outputs in the result cache: {exc}""".format(exc=exc))
+        finally:
+            if tmp_dir.exists():
+                shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+
+# Functions
+def link_or_copy(src, dst):
+    """Hard link `src` to `dst`, copying it instead when they are on different file systems."""
+    try:
+        os.link(str(src), str(dst))
+    except OSError:
+        shutil.copy2(str(src), str(dst))
+
+
+def tool_version(command):
+    """Return the first line printed by the shell `command`, e.g. ``"snpEff -version"``, running it once per process.
+
+    The output is used as is, so a tool that prints its version only with its usage text still
+    yields a stable value.
+    """
+    if command not in _tool_versions:
+        completed = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        lines = [line.strip() for line in completed.stdout.splitlines() if line.strip()]
+        _tool_versions[command] = lines[0] if lines else ""
+
+    return _tool_versions[command]
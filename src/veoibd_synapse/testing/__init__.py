@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+"""Provide offline stand-ins and benchmarks for code that talks to Synapse."""
+
+# Imports
+from veoibd_synapse.testing.fake_synapse import FakeSynapse
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+
+__all__ = ["FakeSynapse"]
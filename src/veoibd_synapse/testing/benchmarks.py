@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Provide offline benchmarks of DAG building, folder resolution and push throughput against ``FakeSynapse``.
+
+Run with ``python -m veoibd_synapse.testing.benchmarks --help``.
+"""
+
+# Imports
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import logzero
+
+import click
+from click import echo
+
+from munch import Munch
+
+import veoibd_synapse.cli.push as _push
+from veoibd_synapse.testing.fake_synapse import FakeSynapse
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+DEFAULT_SIZES = (10000, 30000, 100000)
+FOLDER_FRACTION = 0.1  # share of the seeded entities that are folders
+FOLDER_FANOUT = 10
+BENCH_USER = "BENCH_USER"
+PROJECT_NAME = "benchmark project"
+
+
+# Functions
+def seed_project_tree(syn, n_entities, fanout=FOLDER_FANOUT, folder_fraction=FOLDER_FRACTION):
+    """Seed `syn` with a project holding `n_entities` folders and files and return ``(project_id, folder_paths)``.
+
+    Folders form a tree in which every folder has up to `fanout` subfolders; files are dealt
+    round-robin into the folders.
+    """
+    project_id = syn.seed_project(name=PROJECT_NAME)
+
+    n_folders = max(1, int(n_entities * folder_fraction))
+    folder_ids = []
+    folder_paths = []
+    for k in range(n_folders):
+        if k < fanout:
+            parent_id, parent_path = project_id, ()
+        else:
+            parent_id, parent_path = folder_ids[k // fanout - 1], folder_paths[k // fanout - 1]
+
+        name = "folder_{k}".format(k=k)
+        folder_ids.append(syn.seed_folder(parent_id=parent_id, name=name))
+        folder_paths.append(parent_path + (name,))
+
+    for k in range(n_entities - n_folders):
+        syn.seed_file(parent_id=folder_ids[k % n_folders], name="file_{k}.txt".format(k=k))
+
+    return project_id, folder_paths
+
+
+def make_push(syn, workdir, interactions, max_concurrent_uploads=_push.DEFAULT_MAX_CONCURRENT_UPLOADS):
+    """Write a push-config for `interactions` in `workdir` and return a ``Push`` bound to `syn`."""
+    push_config = OrderedDict([("PROJECT_ID", None),
+                               ("PROJECT_NAME", PROJECT_NAME),
+                               ("DESCRIPTION", "Benchmark push."),
+                               ("INTERACTION_TYPE", "push"),
+                               ("INTERACTIONS", interactions),
+                               ])
+    config_path = Path(workdir) / "push_{n}.yaml".format(n=len(list(Path(workdir).glob("push_*.yaml"))))
+    with config_path.open('w') as out:
+        json.dump(push_config, out, indent=2)  # JSON is valid YAML
+
+    main_confs = Munch(USERS=Munch({BENCH_USER: Munch(SYN_USERNAME="bench", API_KEY="")}),
+                       SITE=Munch(SITE_NAME="bench site", LOCAL_PATHS=Munch(PUSH_REPORTS_DIR=str(workdir))))
+
+    return _push.Push(main_confs=main_confs,
+                      user=BENCH_USER,
+                      push_config=str(config_path),
+                      max_concurrent_uploads=max_concurrent_uploads,
+                      synapse_client=syn)
+
+
+def write_local_files(directory, n_files, file_size):
+    """Write `n_files` random files of `file_size` bytes to `directory` and return its glob pattern."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    for k in range(n_files):
+        (directory / "local_{k}.bin".format(k=k)).write_bytes(os.urandom(file_size))
+
+    return str(directory / "*.bin")
+
+
+def bench_dag_build(n_entities, latency=0.0):
+    """Return the seconds ``Push.login()`` needs to build the DAG of a project with `n_entities` entities."""
+    syn = FakeSynapse(latency=latency)
+    seed_project_tree(syn=syn, n_entities=n_entities)
+
+    workdir = tempfile.mkdtemp(prefix="bench_dag_")
+    try:
+        local = write_local_files(directory=Path(workdir) / "local", n_files=1, file_size=1)
+        push = make_push(syn=syn, workdir=workdir, interactions=[{"REMOTE_DESTINATION_DIR": "folder_0",
+                                                                  "ANNOTATIONS": {},
+                                                                  "LOCAL_PATHS": [local]}])
+        push.login()
+    finally:
+        shutil.rmtree(workdir)
+
+    return push.metrics.phases["dag_build"]
+
+
+def bench_folder_resolution(n_entities):
+    """Return ``(n_paths, seconds)`` to resolve every folder path of a project with `n_entities` entities.
+
+    Each path is resolved twice, so the result covers both the cold walk and the cached lookup.
+    """
+    syn = FakeSynapse()
+    project_id, folder_paths = seed_project_tree(syn=syn, n_entities=n_entities)
+
+    workdir = tempfile.mkdtemp(prefix="bench_paths_")
+    try:
+        local = write_local_files(directory=Path(workdir) / "local", n_files=1, file_size=1)
+        push = make_push(syn=syn, workdir=workdir, interactions=[{"REMOTE_DESTINATION_DIR": "folder_0",
+                                                                  "ANNOTATIONS": {},
+                                                                  "LOCAL_PATHS": [local]}])
+        push.login()
+    finally:
+        shutil.rmtree(workdir)
+
+    start = time.perf_counter()
+    for _ in range(2):
+        for path in folder_paths:
+            push.dag.follow_path_to_folder(path=path)
+
+    return 2 * len(folder_paths), time.perf_counter() - start
+
+
+def bench_push(n_entities, n_files, file_size, latency, bandwidth, max_concurrent_uploads):
+    """Push `n_files` new files into a project of `n_entities` entities and return the push metrics dict."""
+    syn = FakeSynapse(latency=latency, bandwidth=bandwidth)
+    seed_project_tree(syn=syn, n_entities=n_entities)
+
+    workdir = tempfile.mkdtemp(prefix="bench_push_")
+    try:
+        local = write_local_files(directory=Path(workdir) / "local", n_files=n_files, file_size=file_size)
+        push = make_push(syn=syn,
+                         workdir=workdir,
+                         interactions=[{"REMOTE_DESTINATION_DIR": "bench/uploads",
+                                        "CREATE_DIR": True,
+                                        "ANNOTATIONS": {"benchmark": True},
+                                        "LOCAL_PATHS": [local]}],
+                         max_concurrent_uploads=max_concurrent_uploads)
+        push.login()
+        push.plan(create=True)
+        push.execute()
+    finally:
+        shutil.rmtree(workdir)
+
+    return push.metrics.as_dict()
+
+
+@click.command()
+@click.option('-n', '--sizes', multiple=True, type=int, default=DEFAULT_SIZES, show_default=True,
+              help="Number of entities in the seeded project; repeat for several runs.")
+@click.option('--latency', default=0.005, show_default=True,
+              help="Seconds added to every fake API call.")
+@click.option('--bandwidth', default=50.0, show_default=True,
+              help="Fake transfer rate of each upload in MB/s.")
+@click.option('--files', 'n_files', default=50, show_default=True,
+              help="Number of files pushed in the throughput benchmark.")
+@click.option('--file-size', default=1000000, show_default=True,
+              help="Bytes per pushed file.")
+@click.option('-j', '--max-concurrent-uploads', default=_push.DEFAULT_MAX_CONCURRENT_UPLOADS, show_default=True,
+              help="Number of files uploaded at once.")
+def main(sizes, latency, bandwidth, n_files, file_size, max_concurrent_uploads):
+    """Benchmark DAG build, folder resolution and push throughput against an in-process fake Synapse."""
+    logzero.loglevel(logging.WARNING)
+
+    echo("{:>8}  {:>12}  {:>14}  {:>12}  {:>10}".format("entities", "dag_build s", "paths/s", "push MB/s", "files/s"))
+    for n_entities in sizes:
+        dag_seconds = bench_dag_build(n_entities=n_entities)
+        n_paths, path_seconds = bench_folder_resolution(n_entities=n_entities)
+        metrics = bench_push(n_entities=n_entities,
+                             n_files=n_files,
+                             file_size=file_size,
+                             latency=latency,
+                             bandwidth=bandwidth * 1e6,
+                             max_concurrent_uploads=max_concurrent_uploads)
+
+        upload_seconds = metrics["phases"]["uploads"]
+        echo("{:>8}  {:>12.2f}  {:>14.0f}  {:>12.1f}  {:>10.1f}".format(n_entities,
+                                                                        dag_seconds,
+                                                                        n_paths / path_seconds,
+                                                                        metrics["totals"]["mb_per_sec"] or 0.0,
+                                                                        n_files / upload_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+"""Provide an in-process stand-in for ``synapseclient.Synapse`` to exercise our code without network access."""
+
+# Imports
+from logzero import logger as log
+
+import copy
+import hashlib
+import itertools
+import json
+import math
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from munch import Munch
+
+import requests
+
+import synapseclient as synapse
+
+import veoibd_synapse.errors as e
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+CONCRETE_TYPES = {"project": "org.sagebionetworks.repo.model.Project",
+                  "folder": "org.sagebionetworks.repo.model.Folder",
+                  "file": "org.sagebionetworks.repo.model.FileEntity",
+                  }
+NODE_TYPES = {v: k for k, v in CONCRETE_TYPES.items()}
+
+ROOT_ID = "syn4489"  # parent of every project, as on the real server
+DEFAULT_STORAGE_LOCATION_ID = 1
+PRESIGNED_URL_PATTERN = re.compile(r'^fake://upload/(?P<upload_id>\d+)/(?P<part_number>\d+)$')
+
+QUERY_PATTERN = re.compile(r'^\s*SELECT\s+(?P<columns>.+?)\s+FROM\s+(?P<table>\w+)'
+                           r'(?:\s+WHERE\s+(?P<where>.+?))?'
+                           r'(?:\s+LIMIT\s+(?P<limit>\d+))?(?:\s+OFFSET\s+(?P<offset>\d+))?\s*$',
+                           re.IGNORECASE)
+CONDITION_PATTERN = re.compile(r'^\s*(?P<key>[\w.]+)\s*==\s*"(?P<value>[^"]*)"\s*$')
+
+
+# Classes
+class FakeSynapse(object):
+
+    """Mimic the subset of ``synapseclient.Synapse`` used by this package with an in-memory entity tree.
+
+    Entities are kept as plain property and annotation dicts and handed out as fresh
+    ``synapseclient`` entity objects, so callers can mutate what they get without touching the
+    "server" copy. Every API call sleeps for `latency` seconds and file transfers additionally
+    for ``n_bytes / bandwidth`` seconds.
+
+    The ``seed_*`` methods build large trees directly, skipping the simulated latency.
+
+    Multipart uploads hand out ``fake://`` presigned URLs; route ``requests.put`` to
+    ``put_presigned_url()`` to send parts to them.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, cache_dir=None):
+        """Initialize an empty server.
+
+        Args:
+            latency (float): seconds added to every API call.
+            bandwidth (float): bytes per second for uploads and downloads; ``None`` means instantaneous.
+            cache_dir (str): where downloaded files are written; a temporary directory by default.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.cache_dir = Path(cache_dir or tempfile.mkdtemp(prefix="fake_synapse_"))
+        self.fileHandleEndpoint = "fake://file"
+
+        self.entities = {}  # id -> Munch(properties, annotations, project_id)
+        self.children = {}  # (parentId, name) -> id
+        self.file_handles = {}  # id -> Munch(handle, content)
+        self.teams = {}  # id -> Munch(id, name, project_ids)
+        self.multipart_uploads = {}  # uploadId -> Munch(request, n_parts, staged, parts, result_handle_id)
+        self.part_puts = []  # (uploadId, partNumber) of every part sent to a presigned URL
+        self.calls = Counter()  # API method name -> number of calls
+        self.username = None
+
+        self._query_cache = Munch(key=None, rows=None)
+        self._revision = 0  # bumped on every write so cached query rows go stale
+
+        self._ids = itertools.count(4490)
+        self._handle_ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    # API subset
+    def login(self, email=None, apiKey=None, **kwargs):
+        """Record the user name; any credentials are accepted."""
+        self._call("login")
+        self.username = email
+
+    def get(self, entity, downloadFile=True, downloadLocation=None, **kwargs):
+        """Return the entity identified by `entity`, downloading its file if asked to.
+
+        Like the client we replace, an entity object without an id is looked up by name and
+        parent, and ``TypeError`` is raised when no such entity exists.
+        """
+        self._call("get")
+        entity_id = self._resolve_id(entity)
+
+        with self._lock:
+            record = self.entities[entity_id]
+            properties = copy.deepcopy(record.properties)
+            annotations = copy.deepcopy(record.annotations)
+
+        local_state = {}
+        handle_id = properties.get("dataFileHandleId")
+        if handle_id is not None:
+            file_handle = self.file_handles[handle_id]
+            local_state["_file_handle"] = dict(file_handle.handle)
+            if downloadFile:
+                local_state["path"] = str(self._download(handle_id=handle_id, location=downloadLocation))
+
+        return synapse.Entity.create(properties=properties, annotations=annotations, local_state=local_state)
+
+    def store(self, obj, **kwargs):
+        """Create or update `obj` and return the stored entity.
+
+        As on the server, storing a new entity whose name is already taken under the same parent
+        updates the existing one; a file whose content changed gets a new version.
+        """
+        self._call("store")
+
+        properties = dict(obj.properties)
+        annotations = {k: v if isinstance(v, list) else [v] for k, v in dict(obj.annotations).items()}
+        node_type = NODE_TYPES[properties["concreteType"]]
+
+        path = getattr(obj, "path", None) if node_type == "file" else None
+        if path is not None:
+            properties["dataFileHandleId"] = self._upload(path=path)
+
+        with self._lock:
+            if properties.get("parentId") is None and node_type == "project":
+                properties["parentId"] = ROOT_ID
+
+            entity_id = properties.get("id") or self.children.get((properties["parentId"], properties["name"]))
+            if entity_id is None:
+                entity_id = self._add_entity(properties=properties, annotations=annotations)
+            else:
+                self._update_entity(entity_id=entity_id, properties=properties, annotations=annotations)
+
+        return self.get(entity_id, downloadFile=False)
+
+    def query(self, queryStr):
+        """Run a ``SELECT ... FROM entity|file|folder|project WHERE a=="x" AND ... LIMIT n OFFSET m`` query.
+
+        Only the query shapes issued by this package are understood: equality conditions joined by
+        ``AND``. Offsets count from 1, as they do on the server.
+        """
+        self._call("query")
+
+        match = QUERY_PATTERN.match(queryStr)
+        if match is None:
+            raise e.ValidationError("FakeSynapse cannot parse query: {q}".format(q=queryStr))
+
+        table = match.group("table").lower()
+        columns = [column.strip().split(".", 1)[-1] for column in match.group("columns").split(",")]
+        conditions = self._parse_conditions(match.group("where"))
+
+        with self._lock:
+            key = (table, tuple(columns), tuple(conditions), self._revision)
+            if self._query_cache.key != key:
+                rows = [self._query_row(record=record, table=table, columns=columns)
+                        for record in self.entities.values()
+                        if self._query_matches(record=record, table=table, conditions=conditions)]
+                self._query_cache.update(key=key, rows=rows)
+            rows = self._query_cache.rows
+
+        offset = int(match.group("offset") or 1) - 1
+        limit = int(match.group("limit") or len(rows))
+
+        return {"results": rows[offset:offset + limit], "totalNumberOfResults": len(rows)}
+
+    def getTeam(self, id):
+        """Return the team with name or id `id`."""
+        self._call("getTeam")
+
+        for team in self.teams.values():
+            if id in (team.id, team.name):
+                return Munch(id=team.id, name=team.name)
+
+        raise ValueError('Can\'t find team "{id}"'.format(id=id))
+
+    def restGET(self, uri, endpoint=None, **kwargs):
+        """Answer the GET calls this package makes: team projects and upload destinations."""
+        self._call("restGET")
+
+        match = re.match(r'^/projects/TEAM_PROJECTS/team/(?P<team_id>[^/?]+)', uri)
+        if match:
+            team = self.teams[match.group("team_id")]
+            results = [{"id": pid, "name": self.entities[pid].properties["name"]} for pid in team.project_ids]
+            return {"results": results, "totalNumberOfResults": len(results)}
+
+        if re.match(r'^/entity/[^/]+/uploadDestination$', uri):
+            return {"storageLocationId": DEFAULT_STORAGE_LOCATION_ID}
+
+        raise e.NotImplementedYet("FakeSynapse does not implement GET {uri}".format(uri=uri))
+
+    def restPOST(self, uri, body, endpoint=None, **kwargs):
+        """Answer the POST calls this package makes: batched file-handle lookups and multipart uploads.
+
+        Starting a multipart upload that matches an unfinished one resumes it, as on the server.
+        """
+        self._call("restPOST")
+        body = json.loads(body)
+
+        if uri == '/fileHandle/batch':
+            return {"requestedFiles": [self._file_result(request) for request in body["requestedFiles"]]}
+
+        if uri == '/file/multipart':
+            return self._start_multipart(request=body)
+
+        match = re.match(r'^/file/multipart/(?P<upload_id>\d+)/presigned/url/batch$', uri)
+        if match:
+            urls = [{"partNumber": n,
+                     "uploadPresignedUrl": "fake://upload/{id}/{n}".format(id=match.group("upload_id"), n=n),
+                     "signedHeaders": {}} for n in body["partNumbers"]]
+            return {"partPresignedUrls": urls}
+
+        raise e.NotImplementedYet("FakeSynapse does not implement POST {uri}".format(uri=uri))
+
+    def restPUT(self, uri, body=None, endpoint=None, **kwargs):
+        """Answer the PUT calls this package makes: adding parts to and completing multipart uploads."""
+        self._call("restPUT")
+
+        match = re.match(r'^/file/multipart/(?P<upload_id>\d+)/add/(?P<part_number>\d+)\?partMD5Hex=(?P<md5>\w+)$', uri)
+        if match:
+            return self._add_part(upload_id=match.group("upload_id"),
+                                  part_number=int(match.group("part_number")),
+                                  md5=match.group("md5"))
+
+        match = re.match(r'^/file/multipart/(?P<upload_id>\d+)/complete$', uri)
+        if match:
+            return self._complete_multipart(upload_id=match.group("upload_id"))
+
+        raise e.NotImplementedYet("FakeSynapse does not implement PUT {uri}".format(uri=uri))
+
+    def put_presigned_url(self, url, data, headers=None, **kwargs):
+        """Take a part sent to a presigned URL, standing in for ``requests.put``, and return the response."""
+        match = PRESIGNED_URL_PATTERN.match(url)
+        if match is None:
+            raise e.ValidationError("FakeSynapse did not hand out URL {url}".format(url=url))
+
+        self._transfer(len(data))
+        upload_id, part_number = match.group("upload_id"), int(match.group("part_number"))
+        with self._lock:
+            self.multipart_uploads[upload_id].staged[part_number] = bytes(data)
+            self.part_puts.append((upload_id, part_number))
+
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+
+        return response
+
+    # Seeding
+    def seed_project(self, name):
+        """Create a project named `name` and return its id."""
+        with self._lock:
+            return self._add_entity(properties={"concreteType": CONCRETE_TYPES["project"],
+                                                "name": name,
+                                                "parentId": ROOT_ID})
+
+    def seed_folder(self, parent_id, name):
+        """Create a folder `name` under `parent_id` and return its id."""
+        with self._lock:
+            return self._add_entity(properties={"concreteType": CONCRETE_TYPES["folder"],
+                                                "name": name,
+                                                "parentId": parent_id})
+
+    def seed_file(self, parent_id, name, content=b"", annotations=None):
+        """Create a file `name` holding `content` under `parent_id` and return its id."""
+        handle_id = self._add_file_handle(name=name, content=content)
+
+        with self._lock:
+            return self._add_entity(properties={"concreteType": CONCRETE_TYPES["file"],
+                                                "name": name,
+                                                "parentId": parent_id,
+                                                "dataFileHandleId": handle_id},
+                                    annotations={k: [v] for k, v in (annotations or {}).items()})
+
+    def seed_team(self, name, project_ids):
+        """Create a team named `name` sharing `project_ids` and return its id."""
+        with self._lock:
+            team_id = str(next(self._ids))
+            self.teams[team_id] = Munch(id=team_id, name=name, project_ids=list(project_ids))
+
+        return team_id
+
+    # Internals
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _transfer(self, n_bytes):
+        if self.bandwidth:
+            time.sleep(n_bytes / float(self.bandwidth))
+
+    def _resolve_id(self, entity):
+        if isinstance(entity, int):
+            return "syn{n}".format(n=entity)
+
+        if isinstance(entity, str):
+            return entity if entity.startswith("syn") else "syn{n}".format(n=entity)
+
+        if entity.get("id") is not None:
+            return entity["id"]
+
+        parent_id = entity.get("parentId") or ROOT_ID
+        with self._lock:
+            entity_id = self.children.get((parent_id, entity.get("name")))
+
+        if entity_id is None:
+            raise TypeError('No entity named "{name}" under {parent}.'.format(name=entity.get("name"),
+                                                                               parent=parent_id))
+        return entity_id
+
+    def _add_entity(self, properties, annotations=None):
+        properties = dict(properties)
+        properties["id"] = "syn{n}".format(n=next(self._ids))
+        properties["versionNumber"] = 1
+        properties["etag"] = str(next(self._handle_ids))
+
+        if NODE_TYPES[properties["concreteType"]] == "project":
+            project_id = properties["id"]
+        else:
+            project_id = self.entities[properties["parentId"]].project_id
+
+        self.entities[properties["id"]] = Munch(properties=properties,
+                                                annotations=annotations or {},
+                                                project_id=project_id)
+        self.children[(properties["parentId"], properties["name"])] = properties["id"]
+        self._revision += 1
+
+        return properties["id"]
+
+    def _update_entity(self, entity_id, properties, annotations):
+        record = self.entities[entity_id]
+        old_handle = record.properties.get("dataFileHandleId")
+        new_handle = properties.get("dataFileHandleId", old_handle)
+
+        properties = dict(record.properties, **properties)
+        properties["id"] = entity_id
+        properties["etag"] = str(next(self._handle_ids))
+        if (new_handle != old_handle) and (self._md5(new_handle) != self._md5(old_handle)):
+            properties["versionNumber"] = record.properties["versionNumber"] + 1
+
+        record.properties = properties
+        record.annotations = annotations
+        self._revision += 1
+
+    def _md5(self, handle_id):
+        if handle_id is None:
+            return None
+        return self.file_handles[handle_id].handle["contentMd5"]
+
+    def _add_file_handle(self, name, content):
+        with self._lock:
+            handle_id = str(next(self._handle_ids))
+            handle = {"id": handle_id,
+                      "concreteType": "org.sagebionetworks.repo.model.file.S3FileHandle",
+                      "fileName": name,
+                      "contentMd5": hashlib.md5(content).hexdigest(),
+                      "contentSize": str(len(content)),
+                      "storageLocationId": DEFAULT_STORAGE_LOCATION_ID,
+                      }
+            self.file_handles[handle_id] = Munch(handle=handle, content=content)
+
+        return handle_id
+
+    def _upload(self, path):
+        path = Path(path)
+        content = path.read_bytes()
+        self._transfer(len(content))
+
+        return self._add_file_handle(name=path.name, content=content)
+
+    def _download(self, handle_id, location=None):
+        file_handle = self.file_handles[handle_id]
+        directory = Path(location) if location else self.cache_dir / handle_id
+        directory.mkdir(parents=True, exist_ok=True)
+
+        path = directory / file_handle.handle["fileName"]
+        self._transfer(len(file_handle.content))
+        path.write_bytes(file_handle.content)
+        log.debug('FakeSynapse downloaded "{path}".'.format(path=path))
+
+        return path
+
+    def _start_multipart(self, request):
+        with self._lock:
+            for upload_id, upload in self.multipart_uploads.items():
+                if upload.request == request:
+                    return self._multipart_status(upload_id)
+
+            upload_id = str(next(self._handle_ids))
+            n_parts = max(1, int(math.ceil(request["fileSizeBytes"] / float(request["partSizeBytes"]))))
+            self.multipart_uploads[upload_id] = Munch(request=request, n_parts=n_parts, staged={}, parts={},
+                                                      result_handle_id=None)
+
+            return self._multipart_status(upload_id)
+
+    def _multipart_status(self, upload_id):
+        upload = self.multipart_uploads[upload_id]
+        status = {"uploadId": upload_id,
+                  "partsState": "".join("1" if n in upload.parts else "0" for n in range(1, upload.n_parts + 1))}
+
+        if upload.result_handle_id is None:
+            status["state"] = "UPLOADING"
+        else:
+            status.update(state="COMPLETED", resultFileHandleId=upload.result_handle_id)
+
+        return status
+
+    def _add_part(self, upload_id, part_number, md5):
+        with self._lock:
+            upload = self.multipart_uploads[upload_id]
+            data = upload.staged.pop(part_number, None)
+
+            if (data is None) or (hashlib.md5(data).hexdigest() != md5):
+                return {"uploadId": upload_id, "partNumber": part_number, "addPartState": "ADD_FAILED",
+                        "errorMessage": "Part {n} does not match its md5.".format(n=part_number)}
+
+            upload.parts[part_number] = data
+
+        return {"uploadId": upload_id, "partNumber": part_number, "addPartState": "ADD_SUCCESS"}
+
+    def _complete_multipart(self, upload_id):
+        with self._lock:
+            upload = self.multipart_uploads[upload_id]
+            missing = [n for n in range(1, upload.n_parts + 1) if n not in upload.parts]
+            if missing:
+                raise e.UploadError("Multipart upload {id} is missing parts {n}.".format(id=upload_id, n=missing))
+
+            if upload.result_handle_id is None:
+                content = b"".join(upload.parts[n] for n in range(1, upload.n_parts + 1))
+                if hashlib.md5(content).hexdigest() != upload.request["contentMD5Hex"]:
+                    raise e.UploadError("Multipart upload {id} does not match its md5.".format(id=upload_id))
+
+                upload.result_handle_id = self._add_file_handle(name=upload.request["fileName"], content=content)
+
+            return self._multipart_status(upload_id)
+
+    def _file_result(self, request):
+        handle_id = request["fileHandleId"]
+        with self._lock:
+            record = self.entities.get(request["associateObjectId"])
+            granted = (record is not None) and (record.properties.get("dataFileHandleId") == handle_id)
+
+        if not granted:
+            return {"fileHandleId": handle_id, "failureCode": "UNAUTHORIZED"}
+
+        return {"fileHandleId": handle_id, "fileHandle": dict(self.file_handles[handle_id].handle)}
+
+    def _parse_conditions(self, where):
+        conditions = []
+        if not where:
+            return conditions
+
+        for clause in re.split(r'\s+AND\s+', where, flags=re.IGNORECASE):
+            match = CONDITION_PATTERN.match(clause)
+            if match is None:
+                raise e.ValidationError("FakeSynapse cannot parse condition: {c}".format(c=clause))
+            conditions.append((match.group("key").split(".", 1)[-1], match.group("value")))
+
+        return conditions
+
+    def _query_matches(self, record, table, conditions):
+        node_type = NODE_TYPES[record.properties["concreteType"]]
+        if table != "entity" and table != node_type:
+            return False
+
+        for key, value in conditions:
+            if key == "projectId" and value.startswith("syn"):
+                value = value[3:]
+            if str(value) not in [str(v) for v in self._query_values(record=record, key=key)]:
+                return False
+
+        return True
+
+    def _query_values(self, record, key):
+        if key == "projectId":
+            return [record.project_id[3:]]
+        if key == "nodeType":
+            return [NODE_TYPES[record.properties["concreteType"]]]
+        if key in record.properties:
+            return [record.properties[key]]
+
+        return record.annotations.get(key, [])
+
+    def _query_row(self, record, table, columns):
+        row = {}
+        for column in columns:
+            values = self._query_values(record=record, key=column)
+            if column == "projectId":
+                values = ["syn" + values[0]]
+            row["{table}.{column}".format(table=table, column=column)] = values[0] if values else None
+
+        return row
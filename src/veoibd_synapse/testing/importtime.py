@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Provide a start-up benchmark of the import cost of each CLI command, from ``python -X importtime``.
+
+Run with ``python -m veoibd_synapse.testing.importtime --help``.
+"""
+
+# Imports
+import ast
+import importlib
+import inspect
+import re
+import subprocess
+import sys
+import textwrap
+from collections import OrderedDict, defaultdict
+
+import click
+from click import echo
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+CLI_MODULE = "veoibd_synapse.cli.main"
+CLI_GROUP = "run"
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s+)(?P<name>\S+)$")
+
+
+# Functions
+def function_imports(func):
+    """Return the modules imported inside the body of `func`, in order, without running it."""
+    source = textwrap.dedent(inspect.getsource(inspect.unwrap(func)))
+    definition = ast.parse(source).body[0]
+
+    modules = []
+    for statement in definition.body:
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and (node.level == 0):
+                names = [node.module]
+            else:
+                continue
+            modules.extend(name for name in names if name not in modules)
+
+    return tuple(modules)
+
+
+def command_imports(command=None, path=(), inherited=()):
+    """Return ``{command: modules}`` for every runnable command of the CLI, read from the command functions.
+
+    The CLI imports its heavy dependencies inside the commands that use them, so a command pays
+    for the imports of its own function and of the group functions above it. The top-level group
+    on its own is listed as ``--home``, its only option that runs without a sub-command.
+    """
+    if command is None:
+        command = getattr(importlib.import_module(CLI_MODULE), CLI_GROUP)
+
+    modules = inherited + tuple(m for m in function_imports(command.callback) if m not in inherited)
+    imports = OrderedDict()
+
+    subcommands = getattr(command, 'commands', None)
+    if (not path) or (not subcommands):
+        imports[" ".join(path) or "--home"] = modules
+
+    for name, subcommand in sorted((subcommands or {}).items()):
+        imports.update(command_imports(command=subcommand, path=path + (name,), inherited=modules))
+
+    return imports
+
+
+def measure_imports(modules):
+    """Import the CLI and `modules` in a fresh interpreter and return ``(total_us, {package: self_us})``.
+
+    ``total_us`` is the summed cumulative time of all top-level imports, interpreter start-up
+    imports included; the dict sums the time spent in each top-level package's own modules.
+    Raises ``ImportError`` with the interpreter's last error line if an import fails.
+    """
+    statement = "; ".join("import {m}".format(m=m) for m in (CLI_MODULE,) + tuple(modules))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+
+    total = 0
+    by_package = defaultdict(int)
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+
+        if len(match.group("indent")) == 1:
+            total += int(match.group("cumulative"))
+        by_package[match.group("name").split(".")[0]] += int(match.group("self"))
+
+    return total, dict(by_package)
+
+
+def bench_command(modules, repeats):
+    """Return the fastest of `repeats` import measurements of `modules`."""
+    return min((measure_imports(modules) for _ in range(repeats)), key=lambda m: m[0])
+
+
+@click.command()
+@click.option('-c', '--command', 'commands', multiple=True,
+              help="Command to measure, e.g. \"push\" or \"mongo start\"; repeat for several. Defaults to all.")
+@click.option('-r', '--repeats', default=5, show_default=True,
+              help="Interpreter starts per command; the fastest is reported.")
+@click.option('--top', default=3, show_default=True,
+              help="Number of most expensive packages listed per command.")
+def main(commands, repeats, top):
+    """Report the import time each CLI command pays before it starts working."""
+    imports = command_imports()
+
+    unknown = [command for command in commands if command not in imports]
+    if unknown:
+        raise click.BadParameter("unknown command(s) {unknown}; choose from {known}".format(
+            unknown=", ".join(unknown), known=", ".join(imports)), param_hint="--command")
+
+    echo("{:>14}  {:>10}  {}".format("command", "import ms", "most expensive packages (ms)"))
+    for command in commands or imports:
+        try:
+            total, by_package = bench_command(modules=imports[command], repeats=repeats)
+        except ImportError as exc:
+            echo("{:>14}  {:>10}  {}".format(command, "-", exc))
+            continue
+
+        heaviest = sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+
+        echo("{:>14}  {:>10.1f}  {}".format(command,
+                                           total / 1000,
+                                           ", ".join("{p} {ms:.0f}".format(p=p, ms=us / 1000) for p, us in heaviest)))
+
+
+if __name__ == '__main__':
+    main()
@@ -89,6 +89,20 @@ def test(ctx):
         ctx.run(f"pytest")
 
 
+@task
+def benchmark(ctx):
+    """Benchmark DAG build, folder resolution and push throughput against a fake Synapse."""
+    with ctx.prefix(ACTIVATE):
+        ctx.run(f"python -m {PACKAGE_NAME}.testing.benchmarks")
+
+
+@task
+def importtime(ctx):
+    """Report the import time each CLI command pays at start-up."""
+    with ctx.prefix(ACTIVATE):
+        ctx.run(f"python -m {PACKAGE_NAME}.testing.importtime")
+
+
 @task
 def test_all(ctx):
     """Run tests on every Python version with tox."""
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Provide fixtures shared by the tests: an in-process Synapse and local files to push."""
+
+# Imports
+import fractions
+import math
+
+import pytest
+
+# networkx 1.x, whose graph API the DAG code relies on, imports ``fractions.gcd``, which
+# Python 3.9 removed; put it back before anything imports networkx.
+if not hasattr(fractions, "gcd"):
+    fractions.gcd = math.gcd
+
+import veoibd_synapse.multipart as multipart
+from veoibd_synapse.testing import FakeSynapse
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+
+# Fixtures
+@pytest.fixture
+def syn():
+    """Return an empty ``FakeSynapse``."""
+    return FakeSynapse()
+
+
+@pytest.fixture
+def local_dir(tmp_path):
+    """Return a directory holding three small files to push."""
+    directory = tmp_path / "local"
+    directory.mkdir()
+
+    for k in range(3):
+        (directory / "file_{k}.txt".format(k=k)).write_text("content of file {k}\n".format(k=k))
+
+    return directory
+
+
+@pytest.fixture
+def presigned_puts(syn, monkeypatch):
+    """Send multipart parts to `syn` instead of the network and return its record of ``(uploadId, partNumber)`` puts."""
+    monkeypatch.setattr(multipart.requests, "put", syn.put_presigned_url)
+
+    return syn.part_puts
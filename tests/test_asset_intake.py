@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""Test parsing subject IDs out of asset file names with ``veoibd_synapse.data``."""
+
+# Imports
+import pandas as pd
+
+from veoibd_synapse.data.extract_subids.utils.bch import process_r1
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+
+# Tests
+def test_process_r1_recodes_family_members_and_dashes():
+    file_names = ["R1_123P_1.bam", "R1_AB-12M_1.bam", "R1_55-3_1.vcf", "R1_99MM_1.bam"]
+
+    assert process_r1(file_names).tolist() == ["123.0", "AB12.2", "55.3", "99.2"]
+
+
+def test_process_r1_leaves_unknown_family_suffixes_without_a_subject_id():
+    subject_ids = process_r1(["R1_77Q_1.bam", "R1_123P_1.bam", "R1_88Z_1.bam"])
+
+    assert pd.isnull(subject_ids[0]) and pd.isnull(subject_ids[2])
+    assert subject_ids[1] == "123.0"
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Test the child index, path cache and flushing of ``veoibd_synapse.dag_tools.ProjectDAG``."""
+
+# Imports
+import pytest
+
+import veoibd_synapse.errors as e
+import veoibd_synapse.dag_tools as dtools
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+PROJECT_ID = "syn1"
+
+
+# Helpers
+def add_folder(dag, parent_id, node_id, name):
+    """Add folder `node_id` called `name` below `parent_id`."""
+    dag.add_edge(u=parent_id, v=node_id)
+    dag.node[node_id] = dtools.SynNode(entity_dict={"id": node_id, "parentId": parent_id,
+                                                    "name": name, "nodeType": "folder"})
+
+
+# Fixtures
+@pytest.fixture
+def dag():
+    """Return a DAG holding ``data/raw/reads`` below the project."""
+    dag = dtools.ProjectDAG(project_id=PROJECT_ID, synapse_session=None)
+    dag.add_node(PROJECT_ID)
+    dag.node[PROJECT_ID] = dtools.SynNode(entity_dict={"id": PROJECT_ID, "name": "project", "nodeType": "project"},
+                                          is_root=True)
+    add_folder(dag, PROJECT_ID, "syn2", "data")
+    add_folder(dag, "syn2", "syn3", "raw")
+    add_folder(dag, "syn3", "syn4", "reads")
+
+    return dag
+
+
+# Tests
+def test_remove_node_forgets_its_children_and_cached_paths(dag):
+    assert dag.follow_path_to_folder(["data", "raw", "reads"]) == "syn4"
+    assert dag.follow_path_to_folder(["reads"], origin="syn3") == "syn4"
+
+    dag.remove_node("syn2")
+
+    assert dag.find_child(PROJECT_ID, "data") is None
+    assert dag.find_child("syn2", "raw") is None
+    assert (PROJECT_ID, ("data", "raw", "reads")) not in dag._path_cache
+    with pytest.raises(e.NoResult):
+        dag.follow_path_to_folder(["data", "raw", "reads"])
+
+
+def test_remove_node_keeps_cached_paths_outside_its_subtree(dag):
+    add_folder(dag, PROJECT_ID, "syn5", "docs")
+    dag.follow_path_to_folder(["docs"])
+    dag.follow_path_to_folder(["data", "raw"])
+
+    dag.remove_node("syn3")
+
+    assert dag._path_cache == {(PROJECT_ID, ("docs",)): "syn5"}
+    assert dag.find_child("syn3", "reads") is None
+
+
+def test_flush_stores_dirty_nodes_and_keeps_failed_ones_dirty(syn, monkeypatch):
+    project_id = syn.seed_project(name="project")
+    folder_ids = [syn.seed_folder(parent_id=project_id, name=name) for name in ("a", "b", "c")]
+    dag = dtools.ProjectDAG(project_id=project_id, synapse_session=syn)
+    for folder_id in folder_ids:
+        dag.add_edge(u=project_id, v=folder_id)
+        dag.node[folder_id] = dtools.SynNode(entity_dict={"id": folder_id, "nodeType": "folder"}, synapse_session=syn)
+    for folder_id in folder_ids[:2]:
+        dag.node[folder_id].obj["description"] = "changed"
+        dag.node[folder_id].needs_update = True
+
+    store = syn.store
+
+    def failing_store(obj, **kwargs):
+        if obj["id"] == folder_ids[1]:
+            raise ConnectionError("store failed")
+        return store(obj, **kwargs)
+
+    monkeypatch.setattr(syn, "store", failing_store)
+    monkeypatch.setattr(dtools.time, "sleep", lambda seconds: None)
+    results = {result.node_id: result for result in dag.flush()}
+
+    assert sorted(results) == sorted(folder_ids[:2])
+    assert results[folder_ids[0]].error is None
+    assert syn.entities[folder_ids[0]].properties["description"] == "changed"
+    assert results[folder_ids[1]].attempts == dtools.MAX_STORE_ATTEMPTS
+    assert dag.node[folder_ids[1]].needs_update
+    assert dag.flush(node_ids=[folder_ids[0], folder_ids[2]]) == []
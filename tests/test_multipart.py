@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Test streaming a file in parts to ``FakeSynapse`` with ``veoibd_synapse.multipart``."""
+
+# Imports
+import hashlib
+
+import pytest
+
+import requests
+
+import veoibd_synapse.multipart as multipart
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+PART_SIZE = 1000
+N_PARTS = 10
+
+
+# Helpers
+def upload(syn, path, **kwargs):
+    """Upload `path` in ``PART_SIZE`` parts and return the new file handle's id."""
+    return multipart.upload_file_handle(syn=syn,
+                                        path=path,
+                                        md5=hashlib.md5(path.read_bytes()).hexdigest(),
+                                        storage_location_id=1,
+                                        part_size=PART_SIZE,
+                                        **kwargs)
+
+
+def fail_part(monkeypatch, syn, bad_part):
+    """Make every put of part `bad_part` answer HTTP 500 and return the list of seconds waited between attempts."""
+    put = syn.put_presigned_url
+
+    def flaky_put(url, data, headers=None):
+        response = put(url, data, headers=headers)
+        if url.endswith("/{n}".format(n=bad_part)):
+            response.status_code = 500
+        return response
+
+    waits = []
+    monkeypatch.setattr(multipart.requests, "put", flaky_put)
+    monkeypatch.setattr("veoibd_synapse.dag_tools.time.sleep", waits.append)
+
+    return waits
+
+
+# Fixtures
+@pytest.fixture
+def big_file(tmp_path, monkeypatch):
+    """Return a file of ``N_PARTS`` parts whose last part is short, allowing parts that small."""
+    monkeypatch.setattr(multipart, "MIN_PART_SIZE", 1)
+
+    path = tmp_path / "big.bin"
+    path.write_bytes(bytes(bytearray(k % 251 for k in range(PART_SIZE * (N_PARTS - 1) + 123))))
+
+    return path
+
+
+# Tests
+def test_upload_reassembles_parts_in_order(syn, big_file, presigned_puts):
+    handle_id = upload(syn=syn, path=big_file, max_workers=4, max_in_flight=3)
+
+    file_handle = syn.file_handles[handle_id]
+    assert file_handle.content == big_file.read_bytes()
+    assert file_handle.handle["contentMd5"] == hashlib.md5(big_file.read_bytes()).hexdigest()
+    assert sorted(part for _, part in presigned_puts) == list(range(1, N_PARTS + 1))
+
+
+def test_upload_stops_reading_parts_after_a_part_fails(syn, big_file, presigned_puts, monkeypatch):
+    waits = fail_part(monkeypatch=monkeypatch, syn=syn, bad_part=3)
+
+    with pytest.raises(requests.HTTPError):
+        upload(syn=syn, path=big_file, max_workers=1, max_in_flight=1)
+
+    assert [part for _, part in presigned_puts] == [1, 2] + [3] * multipart.MAX_PART_ATTEMPTS
+    assert len(waits) == multipart.MAX_PART_ATTEMPTS - 1
+    assert not syn.file_handles
+
+
+def test_upload_resumes_without_resending_added_parts(syn, big_file, presigned_puts, monkeypatch):
+    fail_part(monkeypatch=monkeypatch, syn=syn, bad_part=3)
+    with pytest.raises(requests.HTTPError):
+        upload(syn=syn, path=big_file, max_workers=1, max_in_flight=1)
+    monkeypatch.setattr(multipart.requests, "put", syn.put_presigned_url)
+    del presigned_puts[:]
+
+    handle_id = upload(syn=syn, path=big_file)
+
+    assert sorted(part for _, part in presigned_puts) == list(range(3, N_PARTS + 1))
+    assert syn.file_handles[handle_id].content == big_file.read_bytes()
+
+
+def test_completing_an_upload_checks_the_whole_file_md5(syn, big_file, presigned_puts):
+    with pytest.raises(multipart.e.UploadError):
+        multipart.upload_file_handle(syn=syn, path=big_file, md5=hashlib.md5(b"other").hexdigest(),
+                                     storage_location_id=1, part_size=PART_SIZE)
+
+    assert not syn.file_handles
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""Test pushing files to a project with ``veoibd_synapse.cli.push`` against ``FakeSynapse``."""
+
+# Imports
+import pytest
+
+import requests
+
+import veoibd_synapse.errors as e
+import veoibd_synapse.cli.push as _push
+from veoibd_synapse.testing.benchmarks import make_push, BENCH_USER, PROJECT_NAME
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+DESTINATION = "data/raw"
+
+
+# Helpers
+def interaction(local_dir, destination=DESTINATION, annotations=None, create_dir=True):
+    """Return one push-config interaction uploading every file of `local_dir` to `destination`."""
+    return {"REMOTE_DESTINATION_DIR": destination,
+            "CREATE_DIR": create_dir,
+            "ANNOTATIONS": annotations or {},
+            "LOCAL_PATHS": [str(local_dir / "*")]}
+
+
+def run_push(syn, workdir, interactions):
+    """Log in, push `interactions` and return the ``Push``."""
+    push = make_push(syn=syn, workdir=workdir, interactions=interactions)
+    push.login()
+    push.execute()
+
+    return push
+
+
+def actions(push, local_dir):
+    """Return ``{file name: action}`` of the files of `local_dir` in the last run of `push`."""
+    return {result.path.name: result.action for result in push.metrics.uploads if result.path.parent == local_dir}
+
+
+def child_id(syn, parent_id, *names):
+    """Return the id of the entity at `names` below `parent_id`, or ``None``."""
+    for name in names:
+        parent_id = syn.children.get((parent_id, name))
+        if parent_id is None:
+            return None
+
+    return parent_id
+
+
+def fail_annotation_stores(syn, monkeypatch, local_dir, n_failures):
+    """Answer the first `n_failures` stores of each file of `local_dir` with HTTP 429, every store if ``None``.
+
+    Returns:
+        list: the seconds waited between attempts, filled in as the push runs.
+    """
+    names = set(local_file.name for local_file in local_dir.iterdir())
+    failures = {}
+    store = syn.store
+
+    def rate_limited_store(obj, **kwargs):
+        name = obj.properties.get("name")
+        if (name in names) and (obj.properties.get("id") is not None):
+            failures[name] = failures.get(name, 0) + 1
+            if (n_failures is None) or (failures[name] <= n_failures):
+                response = requests.Response()
+                response.status_code = 429
+                raise requests.HTTPError("429 Too Many Requests", response=response)
+        return store(obj, **kwargs)
+
+    waits = []
+    monkeypatch.setattr(syn, "store", rate_limited_store)
+    monkeypatch.setattr(_push.dtools.time, "sleep", waits.append)
+
+    return waits
+
+
+# Tests
+def test_push_uploads_new_files(syn, tmp_path, local_dir):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    assert set(actions(push, local_dir).values()) == {"uploaded"}
+    for local_file in local_dir.iterdir():
+        assert child_id(syn, project_id, "data", "raw", local_file.name) is not None
+    assert push.report_path.parent == tmp_path
+
+
+def test_push_skips_unchanged_files(syn, tmp_path, local_dir):
+    syn.seed_project(name=PROJECT_NAME)
+    run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    assert set(actions(push, local_dir).values()) == {"skipped"}
+
+
+def test_push_compares_files_without_fetching_their_entities(syn, tmp_path, local_dir, monkeypatch):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+    run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+    file_ids = {child_id(syn, project_id, "data", "raw", local_file.name) for local_file in local_dir.iterdir()}
+
+    fetched = []
+    get = syn.get
+    monkeypatch.setattr(syn, "get", lambda entity, **kwargs: fetched.append(entity) or get(entity, **kwargs))
+    syn.calls.clear()
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    assert set(actions(push, local_dir).values()) == {"skipped"}
+    assert not file_ids & set(entity for entity in fetched if isinstance(entity, str))
+    assert syn.calls["restPOST"] <= len(push.interactions) + 1  # one file-handle batch per destination
+
+
+def test_push_progress_counts_only_uploaded_bytes(syn, tmp_path, local_dir, monkeypatch):
+    syn.seed_project(name=PROJECT_NAME)
+    run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+    (local_dir / "file_1.txt").write_text("new content\n")
+
+    bars = []
+    tqdm = _push.tqdm
+    monkeypatch.setattr(_push, "tqdm", lambda **kwargs: bars.append(tqdm(**kwargs)) or bars[-1])
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    uploaded = [result for result in push.metrics.uploads if result.action == "uploaded"]
+    assert bars[0].n == bars[0].total == sum(result.n_bytes for result in uploaded)
+    assert bars[0].postfix == "skipped=2"
+
+
+def test_push_streams_large_files_in_parts(syn, tmp_path, local_dir, presigned_puts, monkeypatch):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+    monkeypatch.setattr(_push, "STREAMED_UPLOAD_MIN_BYTES", 0)
+
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    assert set(actions(push, local_dir).values()) == {"uploaded"}
+    for local_file in local_dir.iterdir():
+        file_id = child_id(syn, project_id, "data", "raw", local_file.name)
+        handle_id = syn.entities[file_id].properties["dataFileHandleId"]
+        assert syn.file_handles[handle_id].content == local_file.read_bytes()
+    assert len(syn.multipart_uploads) == len(presigned_puts) == len(push.metrics.uploads) + 1  # and the report
+
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    assert set(actions(push, local_dir).values()) == {"skipped"}
+
+
+def test_push_uploads_only_changed_files(syn, tmp_path, local_dir):
+    syn.seed_project(name=PROJECT_NAME)
+    run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+    (local_dir / "file_1.txt").write_text("new content\n")
+
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    assert actions(push, local_dir) == {"file_0.txt": "skipped", "file_1.txt": "uploaded", "file_2.txt": "skipped"}
+
+
+def test_push_reannotates_unchanged_files(syn, tmp_path, local_dir):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+    run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir, annotations={"batch": "b2"})])
+
+    assert set(actions(push, local_dir).values()) == {"annotated"}
+    file_id = child_id(syn, project_id, "data", "raw", "file_0.txt")
+    assert syn.entities[file_id].annotations["batch"] == ["b2"]
+
+
+def test_push_goes_on_when_one_destination_cannot_be_prepared(syn, tmp_path, local_dir, monkeypatch):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+    prefetch_destination = _push.PushInteraction.prefetch_destination
+
+    def flaky_prefetch(interaction):
+        if interaction.destination_path == ("broken",):
+            raise ConnectionError("destination unavailable")
+        prefetch_destination(interaction)
+
+    monkeypatch.setattr(_push.PushInteraction, "prefetch_destination", flaky_prefetch)
+    monkeypatch.setattr(_push.dtools.time, "sleep", lambda seconds: None)
+    push = make_push(syn=syn, workdir=tmp_path,
+                     interactions=[interaction(local_dir, destination="broken"), interaction(local_dir)])
+    push.login()
+
+    with pytest.raises(e.UploadError):
+        push.execute()
+
+    failed = {(result.path.name, result.action, result.attempts) for result in push.failed_uploads}
+    assert failed == {(local_file.name, "failed", _push.MAX_UPLOAD_ATTEMPTS) for local_file in local_dir.iterdir()}
+    for local_file in local_dir.iterdir():
+        assert child_id(syn, project_id, "data", "raw", local_file.name) is not None
+        assert child_id(syn, project_id, "broken", local_file.name) is None
+    assert push.report_path.exists()
+
+
+def test_push_retries_rate_limited_annotation_updates(syn, tmp_path, local_dir, monkeypatch):
+    syn.seed_project(name=PROJECT_NAME)
+    run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+    waits = fail_annotation_stores(syn=syn, monkeypatch=monkeypatch, local_dir=local_dir, n_failures=1)
+
+    push = run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir, annotations={"batch": "b2"})])
+
+    assert set(actions(push, local_dir).values()) == {"annotated"}
+    assert waits == [_push.dtools.RATE_LIMIT_DELAY] * 3
+
+
+def test_push_fails_annotation_updates_after_every_store_attempt(syn, tmp_path, local_dir, monkeypatch):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+    run_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+    fail_annotation_stores(syn=syn, monkeypatch=monkeypatch, local_dir=local_dir, n_failures=None)
+
+    push = make_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir, annotations={"batch": "b2"})])
+    push.login()
+    with pytest.raises(e.UploadError):
+        push.execute()
+
+    failed = {(result.path.name, result.action, result.attempts) for result in push.failed_uploads}
+    attempts = _push.dtools.MAX_STORE_ATTEMPTS
+    assert failed == {(local_file.name, "failed", attempts) for local_file in local_dir.iterdir()}
+    file_id = child_id(syn, project_id, "data", "raw", "file_0.txt")
+    assert "batch" not in syn.entities[file_id].annotations
+
+
+def test_plan_only_does_not_create_missing_project(syn, tmp_path, local_dir):
+    push = make_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    push.login(create_project=False)
+    entries = push.plan(create=False)
+
+    assert push.project is None
+    assert syn.calls["store"] == 0
+    assert not syn.entities
+    assert entries[0].new_folders == 2
+    assert "will be created" in push.format_plan()
+
+
+def test_plan_only_does_not_create_missing_folders(syn, tmp_path, local_dir):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+    push = make_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir)])
+
+    push.login(create_project=False)
+    push.plan(create=False)
+
+    assert set(push.missing_folders) == {("data",), ("data", "raw"), ("push_history",)}
+    assert syn.calls["store"] == 0
+    assert child_id(syn, project_id, "data") is None
+
+
+def test_plan_rejects_missing_destination_without_create_dir(syn, tmp_path, local_dir):
+    syn.seed_project(name=PROJECT_NAME)
+    push = make_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir, create_dir=False)])
+    push.login()
+
+    with pytest.raises(e.ValidationError):
+        push.plan(create=False)
+
+
+def test_batch_logs_in_once_and_runs_every_push(syn, tmp_path, local_dir):
+    project_id = syn.seed_project(name=PROJECT_NAME)
+    pushes = [make_push(syn=syn, workdir=tmp_path, interactions=[interaction(local_dir, destination=destination)])
+              for destination in ("batch/one", "batch/two")]
+
+    batch = _push.PushBatch(main_confs=pushes[0].main_confs,
+                            user=BENCH_USER,
+                            push_configs=[push.push_config_path for push in pushes],
+                            synapse_client=syn)
+    batch.login()
+    batch.execute()
+
+    assert syn.calls["login"] == 1
+    assert batch.pushes[0].dag is batch.pushes[1].dag
+    for push, destination in zip(batch.pushes, ("one", "two")):
+        assert set(actions(push, local_dir).values()) == {"uploaded"}
+        assert child_id(syn, project_id, "batch", destination, "file_0.txt") is not None
+        assert push.report_path.exists()
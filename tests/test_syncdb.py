@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Test combining and incrementally re-syncing subject DB files with ``veoibd_synapse.cli.syncdb``."""
+
+# Imports
+import pytest
+
+from munch import Munch
+
+import mongomock
+
+import pandas as pd
+
+import veoibd_synapse.cli.syncdb as syncdb
+
+# Metadata
+__author__ = "Gus Dunn"
+__email__ = "w.gus.dunn@gmail.com"
+
+# Constants
+TEAM_NAME = "veoibd"
+
+
+# Helpers
+def db_file(syn, project_id, name, content):
+    """Add a subject DB file holding `content` to `project_id` and return its id."""
+    return syn.seed_file(parent_id=project_id, name=name, content=content.encode(), annotations={"is_db": "true"})
+
+
+def replace_content(syn, file_id, content):
+    """Give `file_id` new content without changing its version, as an edited file handle would."""
+    name = syn.entities[file_id].properties["name"]
+    syn.entities[file_id].properties["dataFileHandleId"] = syn._add_file_handle(name=name, content=content.encode())
+    syn._revision += 1
+
+
+def sync(syn, database_dir):
+    """Run one sync of the team's projects and return the ``TeamSubjectDatabase``."""
+    main_confs = Munch(SITE=Munch(LOCAL_PATHS=Munch(SUBJECT_DATABASE_DIR=str(database_dir))))
+
+    return syncdb.TeamSubjectDatabase(main_confs=main_confs, syn=syn, team_name=TEAM_NAME)
+
+
+def subjects(team_db):
+    """Return the combined table as ``{subject_id: row dict}``."""
+    table = pd.read_parquet(str(team_db.combined_path))
+    return {row[syncdb.SUBJECT_COLUMN]: row for row in table.to_dict(orient="records")}
+
+
+def parts(database_dir):
+    """Return the names of the Parquet parts on disk."""
+    return sorted(part.name for part in (database_dir / syncdb.PARTS_DIR_NAME).iterdir())
+
+
+# Fixtures
+@pytest.fixture
+def team(syn):
+    """Seed two site projects shared with one team and return ``Munch(site_a=file id, site_b=file id)``."""
+    site_a = syn.seed_project(name="site_a")
+    site_b = syn.seed_project(name="site_b")
+    syn.seed_team(name=TEAM_NAME, project_ids=[site_a, site_b])
+
+    return Munch(site_a=db_file(syn, site_a, "subjects.csv", "Subject ID,Age\nS1,3\nS2,5\n"),
+                 site_b=db_file(syn, site_b, "subjects.csv", "subject_id,Sex\nS2,F\nS3,M\n"))
+
+
+# Tests
+def test_combine_keeps_first_site_and_unions_columns(syn, team, tmp_path):
+    team_db = sync(syn=syn, database_dir=tmp_path)
+
+    combined = subjects(team_db)
+
+    assert not team_db.failures
+    assert team_db.data.n_subjects == 3
+    assert sorted(combined) == ["S1", "S2", "S3"]
+    assert (combined["S2"]["age"], combined["S2"][syncdb.SITE_COLUMN]) == ("5", "site_a")
+    assert (combined["S3"]["sex"], combined["S3"][syncdb.SITE_COLUMN]) == ("M", "site_b")
+    assert pd.isnull(combined["S1"]["sex"])
+
+
+def test_resync_of_unchanged_files_reuses_everything(syn, team, tmp_path, monkeypatch):
+    first = sync(syn=syn, database_dir=tmp_path)
+    combined_mtime = first.combined_path.stat().st_mtime_ns
+
+    downloads = []
+    monkeypatch.setattr(syn, "_download", lambda **kwargs: downloads.append(kwargs))
+    second = sync(syn=syn, database_dir=tmp_path)
+
+    assert not downloads
+    assert second.combined_path.stat().st_mtime_ns == combined_mtime
+    assert second.data.n_subjects == 3
+
+
+def test_resync_rebuilds_only_the_changed_file(syn, team, tmp_path):
+    sync(syn=syn, database_dir=tmp_path)
+    parts_before = parts(tmp_path)
+    replace_content(syn=syn, file_id=team.site_b, content="subject_id,Sex\nS3,F\nS4,M\n")
+
+    team_db = sync(syn=syn, database_dir=tmp_path)
+
+    combined = subjects(team_db)
+    assert sorted(combined) == ["S1", "S2", "S3", "S4"]
+    assert combined["S3"]["sex"] == "F"
+
+    parts_after = parts(tmp_path)
+    assert len(parts_after) == 2
+    assert len(set(parts_before) & set(parts_after)) == 1  # site_a's part was kept, site_b's old part pruned
+
+
+def test_resync_drops_files_no_longer_tagged(syn, team, tmp_path):
+    sync(syn=syn, database_dir=tmp_path)
+    syn.entities[team.site_b].annotations = {}
+    syn._revision += 1
+
+    team_db = sync(syn=syn, database_dir=tmp_path)
+
+    assert sorted(subjects(team_db)) == ["S1", "S2"]
+    assert [part.split(".")[0] for part in parts(tmp_path)] == [team.site_a]
+    assert list(team_db.manifest.entries) == [team.site_a]
+
+
+def test_loading_the_table_twice_leaves_the_collection_unchanged(syn, team, tmp_path):
+    team_db = sync(syn=syn, database_dir=tmp_path)
+    collection = mongomock.MongoClient()["veoibd"]["subjects"]
+
+    first = syncdb.load_subject_table(path=team_db.combined_path, collection=collection, batch_size=2)
+    documents = sorted(collection.find(), key=lambda doc: doc["_id"])
+    indexes = collection.index_information()
+    second = syncdb.load_subject_table(path=team_db.combined_path, collection=collection, batch_size=2)
+
+    assert (first.documents, first.inserted) == (3, 3)
+    assert (second.documents, second.inserted, second.updated) == (3, 0, 0)
+    assert collection.count_documents({}) == 3
+    assert sorted(collection.find(), key=lambda doc: doc["_id"]) == documents
+    assert collection.index_information() == indexes
+    assert indexes[syncdb.SUBJECT_COLUMN + "_1"]["unique"]